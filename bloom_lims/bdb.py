@@ -3,9 +3,26 @@ import ast
 import json
 import sys
 import re
+import copy
+import itertools
+import base64
+import csv
+import gzip
+import io
+import tarfile
+import tempfile
+import zipfile
 
 import random
+import bisect
 import string
+import threading
+import time
+import contextvars
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from uuid import uuid4, UUID as PyUUID
 
 import yaml
 
@@ -57,17 +74,22 @@ import pytz
 
 import socket
 import boto3
+import hashlib
 import requests
-from botocore.exceptions import NoCredentialsError, PartialCredentialsError
+from urllib.parse import urlencode
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError, NoCredentialsError, PartialCredentialsError
 
 boto3.set_stream_logger(name="botocore")
 
 from sqlalchemy import (
     and_,
     create_engine,
+    inspect as sqla_inspect,
     MetaData,
     event,
     desc,
+    insert,
     text,
     FetchedValue,
     BOOLEAN,
@@ -83,6 +105,8 @@ from sqlalchemy import (
     ForeignKey,
     or_,
     and_,
+    cast,
+    func,
 )
 
 from sqlalchemy.ext.automap import automap_base
@@ -95,7 +119,10 @@ from sqlalchemy.orm import (
     configure_mappers,
     foreign,
     backref,
+    make_transient_to_detached,
+    contains_eager,
 )
+from sqlalchemy.orm.util import identity_key
 
 from sqlalchemy.sql import func
 from sqlalchemy.dialects.postgresql import UUID
@@ -161,6 +188,26 @@ def unique_non_empty_strings(arr):
     return list(unique_strings)
 
 
+def _keyset_cursor(changed_at, uuid):
+    """Opaque next page cursor for the row keyset paginated on (a timestamp, uuid)."""
+    return base64.urlsafe_b64encode(f"{changed_at.isoformat()}|{uuid}".encode()).decode()
+
+
+def _parse_keyset_cursor(cursor):
+    """(datetime, uuid str) back from a _keyset_cursor(), ValueError if cursor is not one."""
+    try:
+        at, uuid = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(at), str(PyUUID(uuid))
+    except ValueError:  # also binascii.Error and UnicodeDecodeError
+        raise ValueError(f"Invalid page cursor: {cursor}")
+
+
+def _month_start(dt, months=0):
+    """The first instant (UTC) of the month months after the one dt is in."""
+    n = dt.year * 12 + dt.month - 1 + months
+    return datetime(n // 12, n % 12 + 1, 1, tzinfo=pytz.utc)
+
+
 Base = sqla_orm.declarative_base()
 
 
@@ -572,6 +619,56 @@ class file_instance_lineage(generic_instance_lineage):
     }
 
 
+# The engine (and its connection pool) and the automap reflection of the schema are expensive to build,
+# and used to be rebuilt for every BLOOMdb3() ... which main.py does on every request.
+# They are now built once per process and shared, BLOOMdb3 is a cheap per-request session factory.
+_ENGINE_CACHE = {}
+_BASE_CACHE = {}
+_DB_CACHE_LOCK = threading.Lock()
+
+# The BLOOMdb3s opened inside a close_bloomdb_sessions() block (ie: one web request), closed when it ends
+_OPEN_BLOOMDBS = contextvars.ContextVar("bloom_open_bloomdbs", default=None)
+
+BLOOM_ORM_CLASSES = [
+    generic_template,
+    generic_instance,
+    generic_instance_lineage,
+    container_template,
+    container_instance,
+    container_instance_lineage,
+    content_template,
+    content_instance,
+    content_instance_lineage,
+    workflow_template,
+    workflow_instance,
+    workflow_instance_lineage,
+    workflow_step_template,
+    workflow_step_instance,
+    workflow_step_instance_lineage,
+    equipment_template,
+    equipment_instance,
+    equipment_instance_lineage,
+    data_template,
+    data_instance,
+    data_instance_lineage,
+    test_requisition_template,
+    test_requisition_instance,
+    test_requisition_instance_lineage,
+    actor_template,
+    actor_instance,
+    actor_instance_lineage,
+    action_template,
+    action_instance,
+    action_instance_lineage,
+    file_template,
+    file_instance,
+    file_instance_lineage,
+    health_event_template,
+    health_event_instance,
+    health_event_instance_lineage,
+]
+
+
 class BLOOMdb3:
     def __init__(
         self,
@@ -588,67 +685,580 @@ class BLOOMdb3:
         self.logger = logging.getLogger(__name__)
         self.logger.debug("STARTING BLOOMDB3")
         self.app_username = app_username
-        self.engine = create_engine(
-            f"{db_url_prefix}{db_user}:{db_pass}@{db_hostname}/{db_name}", echo=echo_sql
+        self.engine = self._get_engine(
+            f"{db_url_prefix}{db_user}:{db_pass}@{db_hostname}/{db_name}", echo_sql
         )
-        metadata = MetaData()
-        self.Base = automap_base(metadata=metadata)
+
+        # reflect and load the support tables just in case they are needed, this now only happens once per process
+        self.Base = self._get_reflected_base(self.engine)
 
         self.session = sessionmaker(bind=self.engine)()
 
-        # This is so the database can log a user if changes are made
-        set_current_username_sql = text("SET session.current_username = :username")
-        self.session.execute(set_current_username_sql, {"username": self.app_username})
-        self.session.commit()
+        # This is so the database can log a user if changes are made.
+        # Pooled connections are shared by all users, so the username is set each time this session checks one out.
+        # The listener is a plain function reading session.info, a bound method would tie the session and this
+        # object in a reference cycle and keep an unclosed session's connection out of the pool until the gc ran.
+        self.session.info["app_username"] = app_username
+        event.listen(self.session, "after_begin", _set_current_username)
 
-        # reflect and load the support tables just in case they are needed, but this can prob be disabled in prod
-        self.Base.prepare(autoload_with=self.engine)
-
-        classes_to_register = [
-            generic_template,
-            generic_instance,
-            generic_instance_lineage,
-            container_template,
-            container_instance,
-            container_instance_lineage,
-            content_template,
-            content_instance,
-            content_instance_lineage,
-            workflow_template,
-            workflow_instance,
-            workflow_instance_lineage,
-            workflow_step_template,
-            workflow_step_instance,
-            workflow_step_instance_lineage,
-            equipment_template,
-            equipment_instance,
-            equipment_instance_lineage,
-            data_template,
-            data_instance,
-            data_instance_lineage,
-            test_requisition_template,
-            test_requisition_instance,
-            test_requisition_instance_lineage,
-            actor_template,
-            actor_instance,
-            actor_instance_lineage,
-            action_template,
-            action_instance,
-            action_instance_lineage,
-            file_template,
-            file_instance,
-            file_instance_lineage,
-            health_event_template,
-            health_event_instance,
-            health_event_instance_lineage,
-        ]
-        for cls in classes_to_register:
-            class_name = cls.__name__
-            setattr(self.Base.classes, class_name, cls)
+        # Keep the get_by_euid read cache honest about what this session writes
+        event.listen(self.session, "after_flush", _evict_flushed_euids)
+        event.listen(self.session, "after_commit", _reset_flushed_flag)
+        event.listen(self.session, "after_rollback", _reset_flushed_flag)
+
+        open_bdbs = _OPEN_BLOOMDBS.get()
+        if open_bdbs is not None:
+            open_bdbs.append(self)
+
+    @staticmethod
+    def _get_engine(db_url, echo_sql=False):
+        engine_key = (db_url, bool(echo_sql))
+        with _DB_CACHE_LOCK:
+            if engine_key not in _ENGINE_CACHE:
+                _ENGINE_CACHE[engine_key] = create_engine(
+                    db_url,
+                    echo=echo_sql,
+                    pool_size=int(os.environ.get("BLOOM_DB_POOL_SIZE", 10)),
+                    max_overflow=int(os.environ.get("BLOOM_DB_MAX_OVERFLOW", 20)),
+                    pool_recycle=int(os.environ.get("BLOOM_DB_POOL_RECYCLE", 1800)),
+                    pool_pre_ping=True,
+                )
+            return _ENGINE_CACHE[engine_key]
+
+    @staticmethod
+    def _get_reflected_base(engine):
+        base_key = engine.url.render_as_string(hide_password=False)
+        with _DB_CACHE_LOCK:
+            if base_key not in _BASE_CACHE:
+                base = automap_base(metadata=MetaData())
+                base.prepare(autoload_with=engine)
+                for cls in BLOOM_ORM_CLASSES:
+                    setattr(base.classes, cls.__name__, cls)
+                _BASE_CACHE[base_key] = base
+            return _BASE_CACHE[base_key]
+
+    @classmethod
+    def refresh_reflected_metadata(cls):
+        """Drop the cached schema reflection, the next BLOOMdb3() will reflect the database again.
+        Call this after schema changes (ie: new support tables) in a long running process.
+        """
+        with _DB_CACHE_LOCK:
+            _BASE_CACHE.clear()
+
+    @classmethod
+    def dispose_engines(cls):
+        """Close all pooled connections (ie: at shutdown, or in a forked worker)."""
+        with _DB_CACHE_LOCK:
+            for engine in _ENGINE_CACHE.values():
+                engine.dispose()
+            _ENGINE_CACHE.clear()
+            _BASE_CACHE.clear()
 
     def close(self):
+        # The engine is shared by the process, only this session is closed
         self.session.close()
-        self.engine.dispose()
+
+
+def _set_current_username(session, transaction, connection):
+    set_current_username_sql = text("SET session.current_username = :username")
+    connection.execute(set_current_username_sql, {"username": session.info["app_username"]})
+
+
+@contextmanager
+def close_bloomdb_sessions():
+    """Closes every BLOOMdb3 created in the block (and in threads started from it with the context copied, as
+    run_in_threadpool does) when it ends, so their connections go back to the pool.  main.py wraps each request in one.
+    """
+    token = _OPEN_BLOOMDBS.set([])
+    try:
+        yield
+    finally:
+        open_bdbs = _OPEN_BLOOMDBS.get()
+        _OPEN_BLOOMDBS.reset(token)
+        for bdb in open_bdbs:
+            try:
+                bdb.close()
+            except Exception as e:
+                logging.getLogger(__name__).error(f"Error closing BLOOMdb3 session: {e}")
+
+
+# EUID prefix -> table routing.  Templates are GT*, lineages are GL* (see postgres_schema_v3.sql) and instances use
+# the prefixes declared in config/*/metadata.json (which set_generic_instance_euid() builds instance euids from).
+# Prefixes not found here (ie: templates added outside the config files) are learned on first lookup.
+BLOOM_CONFIG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config")
+EUID_PREFIX_RE = re.compile(r"^([A-Za-z]+)[0-9]+$")
+
+
+def load_euid_prefix_routes(config_dir=BLOOM_CONFIG_DIR):
+    routes = {"GT": "generic_template", "GL": "generic_instance_lineage"}
+    for md_file in sorted(Path(config_dir).glob("*/metadata.json")):
+        with open(md_file) as f:
+            md_json = json.load(f)
+        for prefix in md_json.get("euid_prefixes", {}).values():
+            routes[prefix] = "generic_instance"
+    return routes
+
+
+EUID_PREFIX_ROUTES = load_euid_prefix_routes()
+
+
+
+def _snapshot_columns(obj):
+    return {
+        attr.key: copy.deepcopy(getattr(obj, attr.key))
+        for attr in sqla_inspect(obj).mapper.column_attrs
+    }
+
+
+def _merge_snapshot(session, cls, cols):
+    """Returns a persistent object for a column snapshot without a query.  An object already in the session wins."""
+    obj = session.identity_map.get(identity_key(cls, cols["uuid"]))
+    if obj is not None:
+        return obj
+    obj = cls(**copy.deepcopy(cols))
+    make_transient_to_detached(obj)
+    return session.merge(obj, load=False)
+
+
+# Optional read-through cache for get_by_euid(), for the objects every page resolves (AY1, queues, workflow steps).
+# Entries hold the column values (and modified_dt) of an object, a hit rebuilds it and merges it into the
+# caller's session without a query. Entries are dropped when this process flushes a change to them, and at most
+# every BLOOM_EUID_CACHE_CHECK_SEC seconds audit_log (changed_at is indexed) is checked for changes made elsewhere,
+# any audit row newer than the cached modified_dt drops the entry. changed_at is the writing transaction's start
+# time (not its commit time), so each check looks back BLOOM_EUID_CACHE_OVERLAP_SEC past the last one.
+class EuidReadCache:
+    def __init__(self, max_size=None, check_sec=None, overlap_sec=None):
+        self.max_size = int(
+            max_size or os.environ.get("BLOOM_EUID_CACHE_SIZE", 2048)
+        )
+        self.check_sec = float(
+            check_sec
+            if check_sec is not None
+            else os.environ.get("BLOOM_EUID_CACHE_CHECK_SEC", 1.0)
+        )
+        self.overlap_sec = float(
+            overlap_sec
+            if overlap_sec is not None
+            else os.environ.get("BLOOM_EUID_CACHE_OVERLAP_SEC", 60)
+        )
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._watermark = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._watermark = None
+            self._checked_at = 0.0
+
+    def evict(self, euids):
+        with self._lock:
+            for euid in euids:
+                self._entries.pop(euid, None)
+
+    def sync(self, session):
+        """Drop entries changed (per audit_log) since the last check. Returns without a query if checked recently."""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_sec:
+            return
+        self._checked_at = now
+
+        if self._watermark is None:
+            watermark = session.execute(
+                text("SELECT COALESCE(MAX(changed_at), now()) FROM audit_log")
+            ).scalar()
+            with self._lock:
+                self._entries.clear()
+                self._watermark = watermark
+            return
+
+        rows = session.execute(
+            text(
+                "SELECT rel_table_euid_fk, MAX(changed_at) FROM audit_log "
+                "WHERE changed_at > :since GROUP BY rel_table_euid_fk"
+            ),
+            {"since": self._watermark - timedelta(seconds=self.overlap_sec)},
+        ).all()
+        with self._lock:
+            for euid, changed_at in rows:
+                # the version cached was written at modified_dt, its own audit rows share that timestamp
+                entry = self._entries.get(euid)
+                if entry is not None and (entry[1] is None or changed_at > entry[1]):
+                    del self._entries[euid]
+                if changed_at > self._watermark:
+                    self._watermark = changed_at
+
+    def get(self, session, euid):
+        self.sync(session)
+        with self._lock:
+            entry = self._entries.get(euid)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(euid)
+            self.hits += 1
+        return _merge_snapshot(session, entry[0], entry[2])
+
+    def put(self, session, obj):
+        # Never cache values this session has flushed but not yet committed
+        if session.info.get("bloom_flushed") or obj in session.dirty:
+            return
+        cols = _snapshot_columns(obj)
+        with self._lock:
+            entry = self._entries.get(obj.euid)
+            if (
+                entry is not None
+                and entry[1] is not None
+                and obj.modified_dt is not None
+                and entry[1] > obj.modified_dt
+            ):
+                return
+            self._entries[obj.euid] = (type(obj), obj.modified_dt, cols)
+            self._entries.move_to_end(obj.euid)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+
+_EUID_CACHES = {}
+
+
+def get_euid_cache(engine):
+    cache_key = engine.url.render_as_string(hide_password=False)
+    with _DB_CACHE_LOCK:
+        if cache_key not in _EUID_CACHES:
+            _EUID_CACHES[cache_key] = EuidReadCache()
+        return _EUID_CACHES[cache_key]
+
+
+# Templates are seeded once and (nearly) never change, yet every instance creation looked them up, and
+# _create_action_ds() re-ran every action_imports pattern for every instance.  All live templates are held
+# here, keyed by (super_type, btype, b_sub_type, version) for exact lookups (wildcard matches scan them in memory),
+# and the action_groups built from an action_imports block are kept.
+# It is reloaded when max(modified_dt)/count(*) of generic_template moves (checked at most every
+# BLOOM_TEMPLATE_CATALOG_CHECK_SEC seconds), or when this process flushes a template change.
+class TemplateCatalog:
+    def __init__(self, check_sec=None):
+        self.check_sec = float(
+            check_sec
+            if check_sec is not None
+            else os.environ.get("BLOOM_TEMPLATE_CATALOG_CHECK_SEC", 5.0)
+        )
+        # Only guards swapping the loaded state in and out, the database is never queried while holding it
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._templates = None  # [(cls, cols), ...] in query order
+            self._by_euid = {}
+            self._by_key = {}  # (super_type, btype, b_sub_type, version): [(cls, cols), ...]
+            self._action_groups = {}
+            self._signature = None
+            self._checked_at = 0.0
+            self._generation = getattr(self, "_generation", 0) + 1
+
+    @staticmethod
+    def _query_signature(session):
+        return tuple(
+            session.execute(
+                text("SELECT MAX(modified_dt), COUNT(*) FROM generic_template")
+            ).one()
+        )
+
+    def _sync(self, session, base):
+        """(templates, by_euid, by_key) current as of the last check, reloaded if the table has moved."""
+        now = time.monotonic()
+        with self._lock:
+            state = (self._templates, self._by_euid, self._by_key)
+            if self._templates is not None and now - self._checked_at < self.check_sec:
+                return state
+            # the other threads carry on with what is loaded while this one checks
+            self._checked_at = now
+            signature = self._signature
+            generation = self._generation
+
+        new_signature = self._query_signature(session)
+        if state[0] is not None and new_signature == signature:
+            return state
+
+        gt = base.classes.generic_template
+        templates = [
+            (type(t), _snapshot_columns(t))
+            for t in session.query(gt).filter(gt.is_deleted == False).all()
+        ]
+        by_euid = {cols["euid"]: (cls, cols) for cls, cols in templates}
+        by_key = {}
+        for cls, cols in templates:
+            key = (cols["super_type"], cols["btype"], cols["b_sub_type"], cols["version"])
+            by_key.setdefault(key, []).append((cls, cols))
+
+        with self._lock:
+            # a clear() while loading means a template changed meanwhile, keep the catalog empty for the next caller
+            if generation == self._generation:
+                self._templates, self._by_euid, self._by_key = templates, by_euid, by_key
+                self._action_groups = {}
+                self._signature = new_signature
+        return templates, by_euid, by_key
+
+    def match(self, session, base, super_type=None, btype=None, b_sub_type=None, version=None):
+        templates, by_euid, by_key = self._sync(session, base)
+        if None not in (super_type, btype, b_sub_type, version):
+            matches = by_key.get((super_type, btype, b_sub_type, version), [])
+        else:
+            matches = [
+                (cls, cols)
+                for cls, cols in templates
+                if (super_type is None or cols["super_type"] == super_type)
+                and (btype is None or cols["btype"] == btype)
+                and (b_sub_type is None or cols["b_sub_type"] == b_sub_type)
+                and (version is None or cols["version"] == version)
+            ]
+        return [_merge_snapshot(session, cls, cols) for cls, cols in matches]
+
+    def get_by_euid(self, session, base, euid):
+        templates, by_euid, by_key = self._sync(session, base)
+        entry = by_euid.get(euid)
+        return None if entry is None else _merge_snapshot(session, *entry)
+
+    def get_action_groups(self, action_imports, build):
+        key = json.dumps(action_imports, sort_keys=True, default=str)
+        with self._lock:
+            action_groups = self._action_groups.get(key)
+        if action_groups is None:
+            action_groups = build(action_imports)
+            with self._lock:
+                action_groups = self._action_groups.setdefault(key, action_groups)
+        return copy.deepcopy(action_groups)
+
+
+_TEMPLATE_CATALOGS = {}
+
+
+def get_template_catalog(engine):
+    cache_key = engine.url.render_as_string(hide_password=False)
+    with _DB_CACHE_LOCK:
+        if cache_key not in _TEMPLATE_CATALOGS:
+            _TEMPLATE_CATALOGS[cache_key] = TemplateCatalog()
+        return _TEMPLATE_CATALOGS[cache_key]
+
+
+# The DAG explorer used to write every regenerated graph to ./dags/dag_<user>_<depth>_<timestamp>_dagv2.json and
+# read it back for /get_dagv2.  Graphs are now kept in memory as compact JSON, keyed by the caller on
+# (root euid, depth, last audit_log changed_at), so any write to the database makes new keys and everyone looking
+# at the same graph shares one build.  The least recently used graphs are dropped past BLOOM_DAG_CACHE_SIZE.
+class DagCache:
+    def __init__(self, max_entries=None):
+        self.max_entries = int(
+            max_entries
+            if max_entries is not None
+            else os.environ.get("BLOOM_DAG_CACHE_SIZE", 64)
+        )
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._building = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, build):
+        """The JSON text cached for key, on a miss build() (returning a json-able object) is called to make it.
+        Concurrent misses on the same key wait for one build rather than each running their own.
+        """
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key]
+                building = self._building.get(key)
+                if building is None:
+                    building = self._building[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # if that build fails, the next waiter through takes over
+            building.wait()
+
+        try:
+            data = json.dumps(build(), separators=(",", ":"), default=str)
+            with self._lock:
+                self._entries[key] = data
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return data
+        finally:
+            with self._lock:
+                self._building.pop(key, None)
+            building.set()
+
+
+_DAG_CACHES = {}
+
+
+def get_dag_cache(engine):
+    cache_key = engine.url.render_as_string(hide_password=False)
+    with _DB_CACHE_LOCK:
+        if cache_key not in _DAG_CACHES:
+            _DAG_CACHES[cache_key] = DagCache()
+        return _DAG_CACHES[cache_key]
+
+
+def _evict_flushed_euids(session, flush_context):
+    session.info["bloom_flushed"] = True
+    changed = list(session.new) + list(session.dirty) + list(session.deleted)
+    euids = [obj.euid for obj in changed if getattr(obj, "euid", None)]
+    if euids:
+        get_euid_cache(session.get_bind()).evict(euids)
+    if any(isinstance(obj, generic_template) for obj in changed):
+        session.info["bloom_templates_flushed"] = True
+        get_template_catalog(session.get_bind()).clear()
+
+
+def _reset_flushed_flag(session, *args):
+    session.info.pop("bloom_flushed", None)
+    session.info.pop("bloom_templates_flushed", None)
+
+
+# Raw SQL used to be built with f-strings, so every call sent the server a new statement to parse and plan.
+# Raw queries are now registered once, by name, with bound parameters.  On postgres each pooled connection
+# PREPAREs a statement the first time it runs it and EXECUTEs the prepared plan after that (BLOOM_SQL_PREPARE=0
+# sends the plain statement instead).  Calls and time are counted per statement, see get_sql_stats().
+_SQL_STATEMENTS = {}
+_SQL_STATS_LOCK = threading.Lock()
+_SQL_PARAM_RE = re.compile(r"(?<![:\w]):([A-Za-z_]\w*)")
+
+
+class NamedStatement:
+    def __init__(self, name, sql, param_types=None):
+        """
+        Args:
+            name str(): unique, used for the server side prepared statement name (bloom_<name>)
+            sql str(): the statement, with :named bound parameters
+            param_types {}: {param name: postgres type} for every parameter in the statement
+        """
+        self.name = name
+        self.sql = sql
+        self.param_types = dict(param_types or {})
+        self.text = text(sql)
+
+        missing = set(_SQL_PARAM_RE.findall(sql)) - set(self.param_types)
+        if missing:
+            raise ValueError(f"No types given for {name} parameters: {sorted(missing)}")
+
+        positions = {p: i + 1 for i, p in enumerate(self.param_types)}
+        types_sql = (
+            f" ({', '.join(self.param_types.values())})" if self.param_types else ""
+        )
+        self.prepare_sql = f"PREPARE bloom_{name}{types_sql} AS " + _SQL_PARAM_RE.sub(
+            lambda m: f"${positions[m.group(1)]}", sql
+        )
+        args_sql = (
+            f"({', '.join(':' + p for p in self.param_types)})" if self.param_types else ""
+        )
+        self.execute_text = text(f"EXECUTE bloom_{name}{args_sql}")
+
+        self.calls = 0
+        self.prepares = 0
+        self.total_sec = 0.0
+        self.max_sec = 0.0
+
+    def execute(self, session, **params):
+        """Run the statement in the session's current transaction, returns the sqlalchemy Result."""
+        start = time.monotonic()
+        prepared = False
+        if (
+            os.environ.get("BLOOM_SQL_PREPARE", "1") != "0"
+            and session.get_bind().dialect.name == "postgresql"
+        ):
+            conn = session.connection()
+            # .info lives as long as the DBAPI connection (and is cleared if the pool replaces it)
+            prepared_names = conn.connection.info.setdefault("bloom_prepared", set())
+            if self.name not in prepared_names:
+                conn.exec_driver_sql(self.prepare_sql)
+                prepared_names.add(self.name)
+                prepared = True
+            result = session.execute(self.execute_text, params)
+        else:
+            result = session.execute(self.text, params)
+
+        elapsed = time.monotonic() - start
+        with _SQL_STATS_LOCK:
+            self.calls += 1
+            self.prepares += int(prepared)
+            self.total_sec += elapsed
+            self.max_sec = max(self.max_sec, elapsed)
+        return result
+
+
+def register_sql(name, sql, param_types=None):
+    if name in _SQL_STATEMENTS:
+        raise ValueError(f"SQL statement {name} is already registered")
+    _SQL_STATEMENTS[name] = NamedStatement(name, sql, param_types)
+    return _SQL_STATEMENTS[name]
+
+
+def get_sql_stats():
+    """{statement name: {calls, prepares, total_ms, mean_ms, max_ms}} since start (or reset_sql_stats())."""
+    with _SQL_STATS_LOCK:
+        return {
+            name: {
+                "calls": s.calls,
+                "prepares": s.prepares,
+                "total_ms": round(s.total_sec * 1000, 3),
+                "mean_ms": round(s.total_sec * 1000 / s.calls, 3) if s.calls else 0.0,
+                "max_ms": round(s.max_sec * 1000, 3),
+            }
+            for name, s in sorted(_SQL_STATEMENTS.items())
+        }
+
+
+def reset_sql_stats():
+    with _SQL_STATS_LOCK:
+        for s in _SQL_STATEMENTS.values():
+            s.calls = s.prepares = 0
+            s.total_sec = s.max_sec = 0.0
+
+
+# Printer config (which may probe the network), label styles and the fedex client are only needed to print or
+# track a package, so they are built on first use, shared by all BloomObj instances and reloaded after
+# BLOOM_HW_CACHE_TTL_SEC seconds.  Each one is loaded under its own lock, a slow or unreachable printer only
+# holds up the threads waiting for the printer config.
+_HW_CACHE = {}
+_HW_CACHE_LOCKS = {}
+_HW_CACHE_LOCK = threading.Lock()
+
+
+def _get_cached_integration(name, loader):
+    ttl = float(os.environ.get("BLOOM_HW_CACHE_TTL_SEC", 600))
+    with _HW_CACHE_LOCK:
+        cached = _HW_CACHE.get(name)
+        if cached is not None and time.monotonic() - cached[0] <= ttl:
+            return cached[1]
+        name_lock = _HW_CACHE_LOCKS.setdefault(name, threading.RLock())
+
+    with name_lock:
+        # another thread may have loaded it while this one waited
+        with _HW_CACHE_LOCK:
+            cached = _HW_CACHE.get(name)
+        if cached is None or time.monotonic() - cached[0] > ttl:
+            cached = (time.monotonic(), loader())
+            with _HW_CACHE_LOCK:
+                _HW_CACHE[name] = cached
+        return cached[1]
+
+
+def reset_hardware_integrations():
+    """Forget the cached printer config, label styles and fedex client, they are rebuilt on next use."""
+    with _HW_CACHE_LOCK:
+        _HW_CACHE.clear()
 
 
 class BloomObj:
@@ -658,45 +1268,78 @@ class BloomObj:
         self.logger = logging.getLogger(__name__ + ".BloomObj")
         self.logger.debug("Instantiating BloomObj")
 
-        # Zebra Day Print Manager
-        self.zpld = zdpm.zpl()
-        self._config_printers()
-
-        try:
-            self.track_fedex = FTD.FedexTrack()
-        except Exception as e:
-            self.track_fedex = None
+        # Zebra Day Print Manager and fedex are lazy, see the properties below
+        self._selected_lab = None
+        self.selected_label_style = "tube_2inX1in"
 
         self.is_deleted = is_deleted
         self.session = bdb.session
         self.Base = bdb.Base
 
-    def _rebuild_printer_json(self, lab="BLOOM"):
-        self.zpld.probe_zebra_printers_add_to_printers_json(lab=lab)
-        self.zpld.save_printer_json(self.zpld.printers_filename.split("zebra_day")[-1])
-        self._config_printers()
+    @property
+    def zpld(self):
+        return _get_cached_integration("zpld", self._load_zpld)
 
-    def _config_printers(self):
-        if len(self.zpld.printers["labs"].keys()) == 0:
-            self.logger.warning(
-                "No printers found, attempting to rebuild printer json\n\n"
-            )
-            self.logger.warning(
-                'This may take a few minutes, lab code will be set to "BLOOM" ... please sit tight...\n\n'
-            )
-            self._rebuild_printer_json()
+    @property
+    def track_fedex(self):
+        return _get_cached_integration("track_fedex", self._load_track_fedex)
 
-        self.printer_labs = self.zpld.printers["labs"].keys()
-        self.selected_lab = sorted(self.printer_labs)[0]
-        self.site_printers = self.zpld.printers["labs"][self.selected_lab].keys()
+    @property
+    def zpl_label_styles(self):
+        return _get_cached_integration("zpl_label_styles", self._load_zpl_label_styles)
+
+    @property
+    def printer_labs(self):
+        return self.zpld.printers["labs"].keys()
+
+    @property
+    def selected_lab(self):
+        if self._selected_lab is None:
+            return sorted(self.printer_labs)[0]
+        return self._selected_lab
+
+    @selected_lab.setter
+    def selected_lab(self, lab):
+        self._selected_lab = lab
+
+    @property
+    def site_printers(self):
+        return self.zpld.printers["labs"][self.selected_lab].keys()
+
+    def _load_zpld(self):
+        zpld = zdpm.zpl()
+        self._config_printers(zpld)
+        return zpld
+
+    def _load_track_fedex(self):
+        try:
+            return FTD.FedexTrack()
+        except Exception as e:
+            return None
+
+    def _load_zpl_label_styles(self):
         _zpl_label_styles = []
         for zpl_f in os.listdir(
             os.path.dirname(self.zpld.printers_filename) + "/label_styles/"
         ):
             if zpl_f.endswith(".zpl"):
                 _zpl_label_styles.append(zpl_f.removesuffix(".zpl"))
-        self.zpl_label_styles = sorted(_zpl_label_styles)
-        self.selected_label_style = "tube_2inX1in"
+        return sorted(_zpl_label_styles)
+
+    def _rebuild_printer_json(self, lab="BLOOM", zpld=None):
+        zpld = self.zpld if zpld is None else zpld
+        zpld.probe_zebra_printers_add_to_printers_json(lab=lab)
+        zpld.save_printer_json(zpld.printers_filename.split("zebra_day")[-1])
+
+    def _config_printers(self, zpld):
+        if len(zpld.printers["labs"].keys()) == 0:
+            self.logger.warning(
+                "No printers found, attempting to rebuild printer json\n\n"
+            )
+            self.logger.warning(
+                'This may take a few minutes, lab code will be set to "BLOOM" ... please sit tight...\n\n'
+            )
+            self._rebuild_printer_json(zpld=zpld)
 
     def set_printers_lab(self, lab):
         self.selected_lab = lab
@@ -704,7 +1347,7 @@ class BloomObj:
     def get_lab_printers(self, lab):
         self.selected_lab = lab
         try:
-            self.site_printers = self.zpld.printers["labs"][self.selected_lab].keys()
+            return self.site_printers
         except Exception as e:
             self.logger.error(f"Error getting printers for lab {lab}")
             self.logger.error(e)
@@ -745,9 +1388,11 @@ class BloomObj:
 
     # For use by the cytoscape UI in order to determine if the dag needs regenerating
     def get_most_recent_schema_audit_log_entry(self):
+        # only changed_at is used, so the old/new values of the row are not loaded
+        audit_log = self.Base.classes.audit_log
         return (
-            self.session.query(self.Base.classes.audit_log)
-            .order_by(desc(self.Base.classes.audit_log.changed_at))
+            self.session.query(audit_log.changed_at)
+            .order_by(desc(audit_log.changed_at))
             .first()
         )
 
@@ -769,17 +1414,36 @@ class BloomObj:
             self.logger.debug(f"No template found with euid: " + template_euid)
             return
 
+        parent_instance = self._build_instance(template, json_addl_overrides)
+        try:
+            self.session.add(parent_instance)
+            ##self.session.flush()
+            self.session.commit()
+        except Exception as e:
+            self.logger.error(f"Error creating instance from template {template_euid}")
+            self.logger.error(e)
+            self.session.rollback()
+            raise Exception(
+                f"Error creating instance from template {template_euid} ... {e} .. Likely Singleton Violation"
+            )
+
+        return parent_instance
+
+    def _build_instance(self, template, json_addl_overrides={}, action_groups=None):
+        """Returns a new (not yet added) instance of template.  action_groups may be passed in
+        when many instances of the same template are being built, rather than resolved each time.
+        """
         is_singleton = (
             False if template.json_addl.get("singleton", "0") in [0, "0"] else True
         )
 
         cname = template.polymorphic_discriminator.replace("_template", "_instance")
-        parent_instance = getattr(self.Base.classes, f"{cname}")(
+        new_instance = getattr(self.Base.classes, f"{cname}")(
             name=template.name,
             btype=template.btype,
             b_sub_type=template.b_sub_type,
             version=template.version,
-            json_addl=template.json_addl,
+            json_addl=copy.deepcopy(template.json_addl),
             template_uuid=template.uuid,
             bstatus=template.bstatus,
             super_type=template.super_type,
@@ -789,26 +1453,17 @@ class BloomObj:
             ),
         )
         # Lots of fun stuff happening when instantiating action_imports!
-        ai = (
-            self._create_action_ds(parent_instance.json_addl["action_imports"])
-            if "action_imports" in parent_instance.json_addl
-            else {}
-        )
-        try:
-            json_addl_overrides["action_groups"] = ai
-            _update_recursive(parent_instance.json_addl, json_addl_overrides)
-            self.session.add(parent_instance)
-            ##self.session.flush()
-            self.session.commit()
-        except Exception as e:
-            self.logger.error(f"Error creating instance from template {template_euid}")
-            self.logger.error(e)
-            self.session.rollback()
-            raise Exception(
-                f"Error creating instance from template {template_euid} ... {e} .. Likely Singleton Violation"
+        if action_groups is None:
+            action_groups = (
+                self._create_action_ds(new_instance.json_addl["action_imports"])
+                if "action_imports" in new_instance.json_addl
+                else {}
             )
+        overrides = dict(json_addl_overrides)
+        overrides["action_groups"] = copy.deepcopy(action_groups)
+        _update_recursive(new_instance.json_addl, overrides)
 
-        return parent_instance
+        return new_instance
 
     def create_instances_from_uuid(self, uuid):
         return self.create_instances(self.get(uuid).euid)
@@ -838,27 +1493,52 @@ class BloomObj:
         """
 
         self.logger.debug(f"Creating instances from template EUID {template_euid}")
-        template = self.get_by_euid(
-            template_euid
-        )  # needed to get this for the child recrods if any
-        parent_instance = self.create_instance(template_euid)
-        ret_objs = [[], []]
-        ret_objs[0].append(parent_instance)
-
-        # template_json_addl = template.json_addl
-        if "instantiation_layouts" in template.json_addl:
+        t_start = time.monotonic()
+        template = self.get_by_euid(template_euid)
+        if "instantiation_layouts" not in template.json_addl:
+            return [[self.create_instance(template_euid)], []]
+
+        # A plate is the parent, all of its wells and their lineages, built and inserted in one transaction.
+        # Each distinct child template (and its action imports) is resolved once, rows are inserted with
+        # batched INSERT .. RETURNING (uuid, euid, ...) on flush.
+        try:
+            parent_instance = self._build_instance(template)
+            self.session.add(parent_instance)
+            self.session.flush()
             ret_objs = self._process_instantiation_layouts(
                 template.json_addl["instantiation_layouts"],
                 parent_instance,
-                ret_objs,
+                [[parent_instance], []],
+            )
+            self.session.commit()
+        except Exception as e:
+            self.logger.error(f"Error creating instances from template {template_euid}")
+            self.logger.error(e)
+            self.session.rollback()
+            raise Exception(
+                f"Error creating instances from template {template_euid} ... {e} .. Likely Singleton Violation"
             )
-        ##self.session.flush()
-        self.session.commit()
+
+        self.last_instantiation_timing = {
+            "template_euid": template_euid,
+            "euid": parent_instance.euid,
+            "n_children": len(ret_objs[1]),
+            "seconds": time.monotonic() - t_start,
+        }
+        self.logger.info(
+            f"Instantiated {parent_instance.euid} ({template_euid}) with {len(ret_objs[1])} children in {self.last_instantiation_timing['seconds']:.3f}s"
+        )
 
         return ret_objs
 
     # I am of two minds re: if actions should be full objects, or pseudo-objects as they are now...
     def _create_action_ds(self, action_imports):
+        catalog = self._template_catalog()
+        if catalog is None:
+            return self._build_action_ds(action_imports)
+        return catalog.get_action_groups(action_imports, self._build_action_ds)
+
+    def _build_action_ds(self, action_imports):
         ret_ds = {}
         for group in action_imports:
             ret_ds[group] = {}
@@ -906,32 +1586,109 @@ class BloomObj:
     ):
         # Revisit the lineage set creation, this will not behave as expected if the json templates define more than 1 level deep children.
         ## or is this desireable, and the referenced children should reference thier children... crazy town begins at this level...
+        # Nothing is committed here, children and lineages are flushed together (the caller commits).
+        templates = {}
+        children = []
         for row in instantiation_layouts:
             for ds in row:
-                for i in ds:
-                    layout_str = i
-                    layout_ds = ds[i]
-                    child_instance = self._create_child_instance(layout_str, layout_ds)
-                    lineage_record = self.Base.classes.generic_instance_lineage(
-                        parent_instance_uuid=parent_instance.uuid,
-                        child_instance_uuid=child_instance.uuid,
-                        name=f"{parent_instance.name} :: {child_instance.name}",
-                        btype=parent_instance.btype,
-                        b_sub_type=parent_instance.b_sub_type,
-                        version=parent_instance.version,
-                        json_addl=parent_instance.json_addl,
-                        bstatus=parent_instance.bstatus,
-                        super_type=parent_instance.super_type,
-                        parent_type=parent_instance.polymorphic_discriminator,
-                        child_type=child_instance.polymorphic_discriminator,
-                        polymorphic_discriminator=f"{parent_instance.super_type}_instance_lineage",
+                for layout_str in ds:
+                    layout_ds = ds[layout_str]
+                    (
+                        super_type,
+                        btype,
+                        b_sub_type,
+                        version,
+                        defaults,
+                    ) = self._parse_layout_string(layout_str)
+                    if version == "*":
+                        version = "1.0"
+                    tkey = (super_type, btype, b_sub_type, version)
+                    if tkey not in templates:
+                        template = self.query_template_by_component_v2(*tkey)[0]
+                        action_groups = (
+                            self._create_action_ds(template.json_addl["action_imports"])
+                            if "action_imports" in template.json_addl
+                            else {}
+                        )
+                        templates[tkey] = (template, action_groups)
+
+                    template, action_groups = templates[tkey]
+                    child_instance = self._build_instance(
+                        template, action_groups=action_groups
+                    )
+                    _update_recursive(
+                        child_instance.json_addl, layout_ds.get("json_addl", {})
                     )
-                    self.session.add(lineage_record)
-                    ##self.session.flush()
-                    ret_objs[1].append(child_instance)
+                    children.append(child_instance)
+
+        new_children = self._bulk_insert_instances(children)
+
+        gil_table = self.Base.classes.generic_instance_lineage.__table__
+        lineage_rows = [
+            {
+                "parent_instance_uuid": parent_instance.uuid,
+                "child_instance_uuid": child.uuid,
+                "name": f"{parent_instance.name} :: {child.name}",
+                "btype": parent_instance.btype,
+                "b_sub_type": parent_instance.b_sub_type,
+                "version": parent_instance.version,
+                "json_addl": parent_instance.json_addl,
+                "bstatus": parent_instance.bstatus,
+                "super_type": parent_instance.super_type,
+                "parent_type": parent_instance.polymorphic_discriminator,
+                "child_type": child.polymorphic_discriminator,
+                "polymorphic_discriminator": f"{parent_instance.super_type}_instance_lineage",
+            }
+            for child in new_children
+        ]
+        if lineage_rows:
+            self.session.execute(
+                insert(gil_table).returning(gil_table.c.uuid, gil_table.c.euid),
+                lineage_rows,
+            )
+
+        ret_objs[1].extend(new_children)
 
         return ret_objs
 
+    def _bulk_insert_instances(self, instances):
+        """INSERT instances built by _build_instance (not added to the session) and return them as ORM
+        objects, in the same order.
+        """
+        # Core executemany INSERTs are batched into multi row VALUES .. RETURNING statements, the ORM unit of
+        # work would send one statement per row (it can not batch a server generated pk with RETURNING).
+        if len(instances) == 0:
+            return []
+
+        gi_table = self.Base.classes.generic_instance.__table__
+        cols = [
+            "uuid",
+            "name",
+            "btype",
+            "b_sub_type",
+            "version",
+            "json_addl",
+            "template_uuid",
+            "bstatus",
+            "super_type",
+            "is_singleton",
+            "polymorphic_discriminator",
+        ]
+        rows = []
+        for instance in instances:
+            # client side uuid, so the rows can be matched back to the input order
+            instance.uuid = str(uuid4())
+            rows.append({c: getattr(instance, c) for c in cols})
+        self.session.execute(insert(gi_table), rows)
+
+        # and one query to hand them back as (polymorphic) ORM objects
+        gi = self.Base.classes.generic_instance
+        by_uuid = {
+            str(o.uuid): o
+            for o in self.session.query(gi).filter(gi.uuid.in_([r["uuid"] for r in rows]))
+        }
+        return [by_uuid[r["uuid"]] for r in rows]
+
     def create_generic_instance_lineage_by_euids(
         self, parent_instance_euid, child_instance_euid, relationship_type="generic"
     ):
@@ -958,6 +1715,105 @@ class BloomObj:
 
         return lineage_record
 
+    def create_generic_instance_lineages(self, edges, skip_existing=True):
+        """Batch create_generic_instance_lineage_by_euids.
+
+        Args:
+            edges [(parent, child) or (parent, child, relationship_type)]: parent/child may be euids or
+                already loaded instances.  All euids are resolved with one query.
+            skip_existing bool(): edges which already exist (same parent, child and relationship_type, not
+                deleted), or are repeated in edges, are not created again.  This is checked in the INSERT.
+
+        Returns:
+            [] : the lineages created, in edges order
+        """
+        edges = [e if len(e) == 3 else (e[0], e[1], "generic") for e in edges]
+        if len(edges) == 0:
+            return []
+
+        euids = [x for e in edges for x in e[:2] if isinstance(x, str)]
+        by_euid = {o.euid: o for o in self.get_many_by_euid(euids)} if euids else {}
+
+        rows = []
+        for parent, child, relationship_type in edges:
+            parent_instance = by_euid[parent] if isinstance(parent, str) else parent
+            child_instance = by_euid[child] if isinstance(child, str) else child
+            rows.append(
+                {
+                    "ord": len(rows),
+                    "parent_instance_uuid": str(parent_instance.uuid),
+                    "child_instance_uuid": str(child_instance.uuid),
+                    "name": f"{parent_instance.name} :: {child_instance.name}",
+                    "btype": parent_instance.btype,
+                    "b_sub_type": parent_instance.b_sub_type,
+                    "version": parent_instance.version,
+                    "json_addl": parent_instance.json_addl,
+                    "bstatus": parent_instance.bstatus,
+                    "super_type": "generic",
+                    "parent_type": f"{parent_instance.super_type}:{parent_instance.btype}:{parent_instance.b_sub_type}:{parent_instance.version}",
+                    "child_type": f"{child_instance.super_type}:{child_instance.btype}:{child_instance.b_sub_type}:{child_instance.version}",
+                    "polymorphic_discriminator": "generic_instance_lineage",
+                    "relationship_type": relationship_type,
+                }
+            )
+
+        # the objects may be pending in this session
+        self.session.flush()
+
+        cols = "parent_instance_uuid, child_instance_uuid, name, btype, b_sub_type, version, json_addl, bstatus, super_type, parent_type, child_type, polymorphic_discriminator, relationship_type"
+        skip_sql = (
+            """
+            WHERE NOT EXISTS (
+                SELECT 1 FROM generic_instance_lineage gil
+                WHERE gil.parent_instance_uuid = r.parent_instance_uuid
+                  AND gil.child_instance_uuid = r.child_instance_uuid
+                  AND gil.relationship_type IS NOT DISTINCT FROM r.relationship_type
+                  AND gil.is_deleted = FALSE)
+            """
+            if skip_existing
+            else ""
+        )
+        distinct_sql = (
+            "DISTINCT ON (r.parent_instance_uuid, r.child_instance_uuid, r.relationship_type)"
+            if skip_existing
+            else ""
+        )
+        insert_q = text(
+            f"""
+            WITH new_rows AS (
+                SELECT {distinct_sql} r.*
+                FROM jsonb_to_recordset(CAST(:rows AS JSONB)) AS r(
+                    ord INTEGER, parent_instance_uuid UUID, child_instance_uuid UUID, name TEXT, btype TEXT,
+                    b_sub_type TEXT, version TEXT, json_addl JSONB, bstatus TEXT, super_type TEXT,
+                    parent_type TEXT, child_type TEXT, polymorphic_discriminator TEXT, relationship_type TEXT)
+                {skip_sql}
+                ORDER BY r.parent_instance_uuid, r.child_instance_uuid, r.relationship_type, r.ord
+            )
+            INSERT INTO generic_instance_lineage ({cols})
+            SELECT {cols} FROM new_rows ORDER BY ord
+            RETURNING uuid
+            """
+        )
+        new_uuids = [
+            r[0]
+            for r in self.session.execute(
+                insert_q, {"rows": json.dumps(rows, default=str)}
+            )
+        ]
+        if len(new_uuids) < len(rows):
+            self.logger.debug(
+                f"Skipped {len(rows) - len(new_uuids)} existing or repeated lineages"
+            )
+        if len(new_uuids) == 0:
+            return []
+
+        gil = self.Base.classes.generic_instance_lineage
+        by_uuid = {
+            lin.uuid: lin
+            for lin in self.session.query(gil).filter(gil.uuid.in_(new_uuids))
+        }
+        return [by_uuid[u] for u in new_uuids]
+
     def create_instance_by_code(self, layout_str, layout_ds):
         ret_obj = self._create_child_instance(layout_str, layout_ds)
 
@@ -1045,9 +1901,32 @@ class BloomObj:
     get methods.  get() assumes a uuid, which is funny as its rarely used. get_by_euid() is the workhorse.
     """
 
-    # It is VERY nice to be able to query all three instance related tables in one go.
-    # Admitedly, this is a far scaled back remnant of a far more elaborate and hair rasising situation when there were more tables.
-    # There is benefit
+    # It used to be VERY nice to be able to query all three instance related tables in one go.
+    # Now the euid prefix tells us which one table to look in, and uuids are located with one indexed UNION.
+    _EUID_TABLES = ["generic_instance", "generic_template", "generic_instance_lineage"]
+    _LOCATE_UUID_SQL = register_sql(
+        "locate_uuid",
+        " UNION ALL ".join(
+            f"SELECT '{t}' AS table_name FROM {t} WHERE uuid = :uuid AND is_deleted = :is_deleted"
+            for t in _EUID_TABLES
+        ),
+        {"uuid": "uuid", "is_deleted": "boolean"},
+    )
+
+    def _route_euid(self, euid):
+        """Returns the table name an euid lives in, per its prefix, or None if the prefix is unknown."""
+        m = EUID_PREFIX_RE.match(str(euid))
+        return EUID_PREFIX_ROUTES.get(m.group(1)) if m else None
+
+    def _query_table_by_euids(self, table_name, euids):
+        table_cls = getattr(self.Base.classes, table_name)
+        query = self.session.query(table_cls).filter(
+            table_cls.is_deleted == self.is_deleted
+        )
+        if len(euids) == 1:
+            return query.filter(table_cls.euid == euids[0]).all()
+        return query.filter(table_cls.euid.in_(euids)).all()
+
     def get(self, uuid):
         """Global query for uuid across all tables in schema with 'uuid' field
             note does not handle is_deleted!
@@ -1057,129 +1936,251 @@ class BloomObj:
         Returns:
             [] : Array of rows
         """
-        res = (
-            self.session.query(self.Base.classes.generic_instance)
-            .filter(
-                self.Base.classes.generic_instance.uuid == uuid,
-                self.Base.classes.generic_instance.is_deleted == self.is_deleted,
-            )
-            .all()
-        )
-        res2 = (
-            self.session.query(self.Base.classes.generic_template)
-            .filter(
-                self.Base.classes.generic_template.uuid == uuid,
-                self.Base.classes.generic_template.is_deleted == self.is_deleted,
+        tables = [
+            r[0]
+            for r in self._LOCATE_UUID_SQL.execute(
+                self.session, uuid=str(uuid), is_deleted=self.is_deleted
             )
-            .all()
-        )
-        res3 = (
-            self.session.query(self.Base.classes.generic_instance_lineage)
-            .filter(
-                self.Base.classes.generic_instance_lineage.uuid == uuid,
-                self.Base.classes.generic_instance_lineage.is_deleted
-                == self.is_deleted,
-            )
-            .all()
-        )
-
-        combined_result = res + res2 + res3
+        ]
 
-        if len(combined_result) > 1:
-            raise Exception(
-                f"Multiple {len(combined_results)} templates found for {uuid}"
-            )
-        elif len(combined_result) == 0:
-            self.logger.debug(f"No template found with uuid:", uuid)
+        if len(tables) > 1:
+            raise Exception(f"Multiple {len(tables)} templates found for {uuid}")
+        elif len(tables) == 0:
+            self.logger.debug(f"No template found with uuid: {uuid}")
             self.logger.debug(
-                f"On second thought, if we are using a UUID and there is no match.. exception:",
-                uuid,
+                f"On second thought, if we are using a UUID and there is no match.. exception: {uuid}"
             )
             raise Exception(f"No template found with uuid:", uuid)
-        else:
-            return combined_result[0]
 
-    # It is VERY nice to be able to query all three instance related tables in one go.
-    # Admitedly, this is a far scaled back remnant of a far more elaborate and hair rasising situation when there were more tables.
-    # There is benefit
-    def get_by_euid(self, euid):
+        table_cls = getattr(self.Base.classes, tables[0])
+        return (
+            self.session.query(table_cls)
+            .filter(table_cls.uuid == uuid, table_cls.is_deleted == self.is_deleted)
+            .one()
+        )
+
+    def get_by_euid(self, euid, use_cache=None):
         """Global query for euid across all tables in schema with 'euid' field
            note: does not handle is_deleted!
         Args:
             euid str(): euid string
+            use_cache bool(): serve from the EuidReadCache, defaults to the BLOOM_EUID_CACHE env var (off)
 
         Returns:
             [] : Array of rows
         """
-        res = (
-            self.session.query(self.Base.classes.generic_instance)
-            .filter(
-                self.Base.classes.generic_instance.euid == euid,
-                self.Base.classes.generic_instance.is_deleted == self.is_deleted,
-            )
-            .all()
-        )
-        res2 = (
-            self.session.query(self.Base.classes.generic_template)
-            .filter(
-                self.Base.classes.generic_template.euid == euid,
-                self.Base.classes.generic_template.is_deleted == self.is_deleted,
-            )
-            .all()
-        )
-        res3 = (
-            self.session.query(self.Base.classes.generic_instance_lineage)
-            .filter(
-                self.Base.classes.generic_instance_lineage.euid == euid,
-                self.Base.classes.generic_instance_lineage.is_deleted
-                == self.is_deleted,
+        if use_cache is None:
+            use_cache = os.environ.get("BLOOM_EUID_CACHE", "0") not in ["0", ""]
+        use_cache = use_cache and not self.is_deleted
+        if use_cache:
+            cache = get_euid_cache(self.session.get_bind())
+            obj = cache.get(self.session, euid)
+            if obj is not None:
+                return obj
+
+        table_name = self._route_euid(euid)
+        if table_name == "generic_template" and self._template_catalog() is not None:
+            template = self._template_catalog().get_by_euid(
+                self.session, self.Base, euid
             )
-            .all()
-        )
+            if template is not None:
+                return template
 
-        combined_result = res + res2 + res3
+        if table_name is not None:
+            combined_result = self._query_table_by_euids(table_name, [euid])
+        else:
+            combined_result = self._get_by_euid_all_tables(euid)
 
         if len(combined_result) > 1:
             raise Exception(
                 f"Multiple {len(combined_result)} templates found for {euid}"
             )
         elif len(combined_result) == 0:
-            self.logger.debug(f"No template found with euid: " + euid)
-            raise Exception(f"No template found with euid: " + euid)
+            self.logger.debug(f"No template found with euid: " + str(euid))
+            raise Exception(f"No template found with euid: " + str(euid))
         else:
+            if use_cache:
+                cache.put(self.session, combined_result[0])
             return combined_result[0]
 
-    # This is the mechanism for finding the database object(s) which math the template reference pattern
-    # V2... why?
-    def query_instance_by_component_v2(
-        self, super_type=None, btype=None, b_sub_type=None, version=None
-    ):
-        query = self.session.query(self.Base.classes.generic_instance)
+    def _get_by_euid_all_tables(self, euid):
+        # Unknown prefix, look everywhere and remember where it was found for next time
+        combined_result = []
+        for table_name in self._EUID_TABLES:
+            res = self._query_table_by_euids(table_name, [euid])
+            if res:
+                m = EUID_PREFIX_RE.match(str(euid))
+                if m:
+                    EUID_PREFIX_ROUTES.setdefault(m.group(1), table_name)
+            combined_result += res
+        return combined_result
+
+    def get_many_by_euid(self, euids):
+        """Bulk get_by_euid, one IN query per table the euids route to (usually just one).
 
-        # Apply filters conditionally
-        if super_type is not None:
-            query = query.filter(
-                self.Base.classes.generic_instance.super_type == super_type
-            )
-        if btype is not None:
-            query = query.filter(self.Base.classes.generic_instance.btype == btype)
-        if b_sub_type is not None:
-            query = query.filter(
-                self.Base.classes.generic_instance.b_sub_type == b_sub_type
-            )
-        if version is not None:
-            query = query.filter(self.Base.classes.generic_instance.version == version)
+        Args:
+            euids [str()]: euids to fetch, duplicates and empty strings are ignored
 
-        query = query.filter(
-            self.Base.classes.generic_instance.is_deleted == self.is_deleted
-        )
+        Returns:
+            [] : objects in the order of euids
+        """
+        euids = list(dict.fromkeys(e for e in euids if e))
+        by_table = {}
+        unrouted = []
+        for euid in euids:
+            table_name = self._route_euid(euid)
+            if table_name is None:
+                unrouted.append(euid)
+            else:
+                by_table.setdefault(table_name, []).append(euid)
+
+        found = {}
+        for table_name, table_euids in by_table.items():
+            for obj in self._query_table_by_euids(table_name, table_euids):
+                found[obj.euid] = obj
+        for euid in unrouted:
+            for obj in self._get_by_euid_all_tables(euid):
+                found[obj.euid] = obj
+
+        missing = [euid for euid in euids if euid not in found]
+        if missing:
+            self.logger.debug(f"No objects found with euids: {missing}")
+            raise Exception(f"No objects found with euids: {missing}")
+
+        return [found[euid] for euid in euids]
+
+    """
+    lineage traversal.  parent_of_lineages / child_of_lineages are lazy="dynamic", so walking them and touching
+    lin.child_instance is a query per lineage AND per instance.  These fetch one level of lineages for a whole
+    set of instances, with the instance on the far side loaded in the same query (contains_eager).
+    """
+
+    def get_lineage_children(
+        self, instances, btype=None, super_type=None, depth=1, include_deleted=False
+    ):
+        """Lineages where instances are the parent, lin.child_instance is already loaded.
+
+        Args:
+            instances: an instance or list of instances (or their uuids)
+            btype, super_type: str() or [str()], only follow lineages to instances of this btype/super_type
+            depth int(): levels to descend, each level is one query (and only continues through matching children)
+            include_deleted bool(): also follow soft deleted lineages and instances, as the parent_of_lineages /
+                child_of_lineages relationships do
+
+        Returns:
+            [] : lineages, level by level
+        """
+        return self._walk_lineages(
+            instances, "child", btype, super_type, depth, include_deleted
+        )
+
+    def get_lineage_parents(
+        self, instances, btype=None, super_type=None, depth=1, include_deleted=False
+    ):
+        """Lineages where instances are the child, lin.parent_instance is already loaded.  See get_lineage_children."""
+        return self._walk_lineages(
+            instances, "parent", btype, super_type, depth, include_deleted
+        )
+
+    def _walk_lineages(
+        self, instances, direction, btype, super_type, depth, include_deleted
+    ):
+        gil = self.Base.classes.generic_instance_lineage
+        gi = self.Base.classes.generic_instance
+        if direction == "child":
+            from_col, to_col, to_rel = (
+                gil.parent_instance_uuid,
+                gil.child_instance_uuid,
+                gil.child_instance,
+            )
+        else:
+            from_col, to_col, to_rel = (
+                gil.child_instance_uuid,
+                gil.parent_instance_uuid,
+                gil.parent_instance,
+            )
+
+        if not isinstance(instances, (list, tuple, set)):
+            instances = [instances]
+        frontier = [getattr(i, "uuid", i) for i in instances]
+        seen = set(frontier)
+        ret_lineages = []
+        for level in range(depth):
+            if len(frontier) == 0:
+                break
+            query = (
+                self.session.query(gil)
+                .join(gi, gi.uuid == to_col)
+                .options(contains_eager(to_rel.of_type(gi)))
+                .filter(from_col.in_(frontier))
+            )
+            if not include_deleted:
+                query = query.filter(gil.is_deleted == False, gi.is_deleted == False)
+            if btype is not None:
+                query = query.filter(
+                    gi.btype.in_([btype] if isinstance(btype, str) else btype)
+                )
+            if super_type is not None:
+                query = query.filter(
+                    gi.super_type.in_(
+                        [super_type] if isinstance(super_type, str) else super_type
+                    )
+                )
+
+            frontier = []
+            for lin in query.all():
+                ret_lineages.append(lin)
+                to_uuid = getattr(lin, to_col.key)
+                if to_uuid not in seen:
+                    seen.add(to_uuid)
+                    frontier.append(to_uuid)
+
+        return ret_lineages
+
+    # This is the mechanism for finding the database object(s) which math the template reference pattern
+    # V2... why?
+    def query_instance_by_component_v2(
+        self, super_type=None, btype=None, b_sub_type=None, version=None
+    ):
+        query = self.session.query(self.Base.classes.generic_instance)
+
+        # Apply filters conditionally
+        if super_type is not None:
+            query = query.filter(
+                self.Base.classes.generic_instance.super_type == super_type
+            )
+        if btype is not None:
+            query = query.filter(self.Base.classes.generic_instance.btype == btype)
+        if b_sub_type is not None:
+            query = query.filter(
+                self.Base.classes.generic_instance.b_sub_type == b_sub_type
+            )
+        if version is not None:
+            query = query.filter(self.Base.classes.generic_instance.version == version)
+
+        query = query.filter(
+            self.Base.classes.generic_instance.is_deleted == self.is_deleted
+        )
 
         # Execute the query
         return query.all()
 
+    def _template_catalog(self):
+        # The catalog only holds committed, live templates.  Flushed instances (ie: the parent create_instances()
+        # flushes before laying out its children) do not matter to it, flushed templates do.
+        if self.is_deleted or self.session.info.get("bloom_templates_flushed"):
+            return None
+        return get_template_catalog(self.session.get_bind())
+
     def query_template_by_component_v2(
         self, super_type=None, btype=None, b_sub_type=None, version=None
     ):
+        catalog = self._template_catalog()
+        if catalog is not None:
+            return catalog.match(
+                self.session, self.Base, super_type, btype, b_sub_type, version
+            )
+
         query = self.session.query(self.Base.classes.generic_template)
 
         # Apply filters conditionally
@@ -1203,66 +2204,170 @@ class BloomObj:
         return query.all()
 
    
-    def query_user_audit_logs(self, username):
-        logging.debug(f"Querying audit log for user: {username}")
+    _USER_AUDIT_LOGS_SQL = register_sql(
+        "user_audit_logs",
+        """
+        SELECT
+            al.rel_table_euid_fk AS euid,
+            al.changed_by,
+            al.operation_type,
+            al.changed_at,
+            obj.name,
+            obj.polymorphic_discriminator,
+            obj.super_type,
+            obj.btype,
+            obj.b_sub_type,
+            obj.bstatus AS status,
+            al.old_value,
+            al.new_value,
+            al.json_addl AS json_patch,
+            al.rel_table_name,
+            al.column_name,
+            al.uuid
+        FROM
+            audit_log al
+            -- only the table rel_table_name names is looked in, the other branches are skipped by their one time filter
+            LEFT JOIN LATERAL (
+                SELECT name, polymorphic_discriminator, super_type, btype, b_sub_type, bstatus
+                FROM generic_template
+                WHERE al.rel_table_name = 'generic_template' AND uuid = al.rel_table_uuid_fk
+                UNION ALL
+                SELECT name, polymorphic_discriminator, super_type, btype, b_sub_type, bstatus
+                FROM generic_instance
+                WHERE al.rel_table_name = 'generic_instance' AND uuid = al.rel_table_uuid_fk
+                UNION ALL
+                SELECT name, polymorphic_discriminator, super_type, btype, b_sub_type, bstatus
+                FROM generic_instance_lineage
+                WHERE al.rel_table_name = 'generic_instance_lineage' AND uuid = al.rel_table_uuid_fk
+            ) obj ON TRUE
+        WHERE
+            al.changed_by = :username
+            -- audit_log is partitioned by changed_at, only the partitions in the range are read
+            AND al.changed_at >= COALESCE(CAST(:since AS TIMESTAMPTZ), '-infinity')
+            AND al.changed_at < COALESCE(CAST(:until AS TIMESTAMPTZ), 'infinity')
+            AND (CAST(:tables AS TEXT[]) IS NULL OR al.rel_table_name = ANY(CAST(:tables AS TEXT[])))
+            -- keyset pagination, the rows after the last one of the previous page
+            AND (al.changed_at, al.uuid) < (
+                COALESCE(CAST(:after_changed_at AS TIMESTAMPTZ), 'infinity'),
+                COALESCE(CAST(:after_uuid AS UUID), 'ffffffff-ffff-ffff-ffff-ffffffffffff')
+            )
+        ORDER BY
+            al.changed_at DESC, al.uuid DESC
+        LIMIT CAST(:limit AS INTEGER);
+        """,
+        {
+            "username": "text",
+            "since": "timestamptz",
+            "until": "timestamptz",
+            "tables": "text[]",
+            "after_changed_at": "timestamptz",
+            "after_uuid": "text",
+            "limit": "integer",
+        },
+    )
 
-        q = text(
-            """
-            SELECT
-                al.rel_table_euid_fk AS euid,
-                al.changed_by,
-                al.operation_type,
-                al.changed_at,
-                COALESCE(gt.name, gi.name, gil.name) AS name,
-                COALESCE(gt.polymorphic_discriminator, gi.polymorphic_discriminator, gil.polymorphic_discriminator) AS polymorphic_discriminator,
-                COALESCE(gt.super_type, gi.super_type, gil.super_type) AS super_type,
-                COALESCE(gt.btype, gi.btype, gil.btype) AS btype,
-                COALESCE(gt.b_sub_type, gi.b_sub_type, gil.b_sub_type) AS b_sub_type,
-                COALESCE(gt.bstatus, gi.bstatus, gil.bstatus) AS status,
-                al.old_value,
-                al.new_value
-            FROM
-                audit_log al
-                LEFT JOIN generic_template gt ON al.rel_table_uuid_fk = gt.uuid
-                LEFT JOIN generic_instance gi ON al.rel_table_uuid_fk = gi.uuid
-                LEFT JOIN generic_instance_lineage gil ON al.rel_table_uuid_fk = gil.uuid
-            WHERE
-                al.changed_by = :username
-            ORDER BY
-                al.changed_at DESC;
-            """
+    def _user_audit_log_result(self, username, since=None, until=None, tables=None, after=None, limit=None):
+        after_changed_at, after_uuid = _parse_keyset_cursor(after) if after else (None, None)
+        return self._USER_AUDIT_LOGS_SQL.execute(
+            self.session,
+            username=username,
+            since=since,
+            until=until,
+            tables=list(tables) if tables else None,
+            after_changed_at=after_changed_at,
+            after_uuid=after_uuid,
+            limit=limit,
         )
 
-        logging.debug(f"Executing query: {q}")
+    def query_user_audit_logs(self, username, since=None, until=None, tables=None, after=None, limit=None):
+        """audit_log rows written by username, newest first.
+
+        Args:
+            since, until datetime(): only changed_at in [since, until), and only those audit_log partitions are read
+            tables [str]: only rows for these rel_table_names
+            after str(): the next page cursor from query_user_audit_log_page()
+            limit int(): at most this many rows
+        """
+        logging.debug(f"Querying audit log for user: {username}")
 
-        result = self.session.execute(q, {'username': username})
-        rows = result.fetchall()
+        rows = self._user_audit_log_result(username, since, until, tables, after, limit).fetchall()
 
         logging.debug(f"Query returned {len(rows)} rows")
 
         return rows
+
+    def query_user_audit_log_page(self, username, page_size=None, **filters):
+        """(rows, next page cursor) of query_user_audit_logs(username, **filters), keyset paginated on
+        (changed_at, uuid) so a page costs the same however deep it is.  The cursor is None on the last page.
+        page_size defaults to BLOOM_USER_AUDIT_LOG_PAGE_SIZE (500).
+        """
+        if page_size is None:
+            page_size = int(os.environ.get("BLOOM_USER_AUDIT_LOG_PAGE_SIZE", 500))
+        rows = self.query_user_audit_logs(username, limit=page_size + 1, **filters)
+        if len(rows) <= page_size:
+            return rows, None
+        rows = rows[:page_size]
+        return rows, _keyset_cursor(rows[-1].changed_at, rows[-1].uuid)
+
+    def stream_user_audit_logs(self, username, fmt="csv", page_size=None, **filters):
+        """Yields query_user_audit_logs(username, **filters) as CSV (with a header) or NDJSON text, fetched a
+        keyset page at a time so memory does not grow with the user's history.
+        """
+        if fmt not in ["csv", "ndjson"]:
+            raise ValueError(f"Unknown audit log export format: {fmt}")
+
+        def _value(v):
+            if isinstance(v, datetime):
+                return v.isoformat()
+            if isinstance(v, (dict, list)):
+                return json.dumps(v)
+            return v
+
+        filters.pop("after", None)
+        after = None
+        if fmt == "csv":
+            out = io.StringIO()
+            csv.writer(out).writerow(self._user_audit_log_result(username, limit=0).keys())
+            yield out.getvalue()
+        while True:
+            rows, after = self.query_user_audit_log_page(username, page_size, after=after, **filters)
+            out = io.StringIO()
+            if fmt == "csv":
+                csv.writer(out).writerows([_value(v) for v in row] for row in rows)
+            else:
+                for row in rows:
+                    record = {k: v.isoformat() if isinstance(v, datetime) else v for k, v in row._asdict().items()}
+                    out.write(json.dumps(record, default=str) + "\n")
+            yield out.getvalue()
+            if after is None:
+                break
+
     # Aggregate Report SQL
-    def query_generic_template_stats(self):
-        q = text(
-            """
-            SELECT
-                'Generic Template Summary' as Report,
-                COUNT(*) as Total_Templates,
-                COUNT(DISTINCT btype) as Distinct_Base_Types,
-                COUNT(DISTINCT b_sub_type) as Distinct_Sub_Types,
-                COUNT(DISTINCT super_type) as Distinct_Super_Types,
-                MAX(created_dt) as Latest_Creation_Date,
-                MIN(created_dt) as Earliest_Creation_Date,
-                AVG(AGE(NOW(), created_dt)) as Average_Age,
-                COUNT(CASE WHEN is_singleton THEN 1 END) as Singleton_Count
-            FROM
-                generic_template
-            WHERE
-                is_deleted = :is_deleted
+    _GENERIC_TEMPLATE_STATS_SQL = register_sql(
+        "generic_template_stats",
         """
-        )
+        SELECT
+            'Generic Template Summary' as Report,
+            COUNT(*) as Total_Templates,
+            COUNT(DISTINCT btype) as Distinct_Base_Types,
+            COUNT(DISTINCT b_sub_type) as Distinct_Sub_Types,
+            COUNT(DISTINCT super_type) as Distinct_Super_Types,
+            MAX(created_dt) as Latest_Creation_Date,
+            MIN(created_dt) as Earliest_Creation_Date,
+            AVG(AGE(NOW(), created_dt)) as Average_Age,
+            COUNT(CASE WHEN is_singleton THEN 1 END) as Singleton_Count
+        FROM
+            generic_template
+        WHERE
+            is_deleted = :is_deleted
+        """,
+        {"is_deleted": "boolean"},
+    )
 
-        result = self.session.execute(q, {"is_deleted": self.is_deleted}).fetchall()
+    def query_generic_template_stats(self):
+        result = self._GENERIC_TEMPLATE_STATS_SQL.execute(
+            self.session, is_deleted=self.is_deleted
+        ).fetchall()
 
         # Define the column names based on your SELECT statement
         columns = [
@@ -1280,9 +2385,9 @@ class BloomObj:
         # Convert each row to a dictionary
         return [dict(zip(columns, row)) for row in result]
 
-    def query_generic_instance_and_lin_stats(self):
-        q = text(
-            f"""
+    _GENERIC_INSTANCE_AND_LIN_STATS_SQL = register_sql(
+        "generic_instance_and_lin_stats",
+        """
         SELECT
             -- Summary from generic_instance table
             'Generic Instance Summary' as Report,
@@ -1297,8 +2402,8 @@ class BloomObj:
         FROM
             generic_instance
         WHERE
-            is_deleted = {self.is_deleted}
-            
+            is_deleted = :is_deleted
+
         UNION ALL
 
         SELECT
@@ -1315,11 +2420,15 @@ class BloomObj:
         FROM
             generic_instance_lineage
         WHERE
-            is_deleted = {self.is_deleted};
-        """
-        )
+            is_deleted = :is_deleted;
+        """,
+        {"is_deleted": "boolean"},
+    )
 
-        result = self.session.execute(q, {"is_deleted": self.is_deleted}).fetchall()
+    def query_generic_instance_and_lin_stats(self):
+        result = self._GENERIC_INSTANCE_AND_LIN_STATS_SQL.execute(
+            self.session, is_deleted=self.is_deleted
+        ).fetchall()
 
         # Define the column names based on your SELECT statement
         columns = [
@@ -1337,129 +2446,478 @@ class BloomObj:
         # Convert each row to a dictionary
         return [dict(zip(columns, row)) for row in result]
 
+    _COST_OF_ALL_CHILDREN_SQL = register_sql(
+        "cost_of_all_children",
+        """
+        WITH RECURSIVE descendants AS (
+            SELECT gi.uuid
+            FROM generic_instance gi
+            WHERE gi.euid = :euid
+
+            UNION
+
+            SELECT child_gi.uuid
+            FROM descendants d
+            JOIN generic_instance_lineage gil ON gil.parent_instance_uuid = d.uuid
+            JOIN generic_instance child_gi ON gil.child_instance_uuid = child_gi.uuid
+            WHERE NOT child_gi.is_deleted
+        )
+        SELECT gi.euid, gi.json_addl -> 'cogs' ->> 'cost' AS cost
+        FROM descendants d
+        JOIN generic_instance gi ON gi.uuid = d.uuid
+        WHERE gi.json_addl -> 'cogs' ->> 'cost' <> ''
+        ORDER BY gi.created_dt DESC
+        """,
+        {"euid": "text"},
+    )
+
     def query_cost_of_all_children(self, euid):
-        # limited to 10,000 children right now...
-        query = text(
-            f"""
-            WITH RECURSIVE descendants AS (
-            -- Initial query to get the root instance
-            SELECT gi.uuid, gi.euid, gi.json_addl, gi.created_dt
+        """[(euid, cost)] for the euid and all of its (not deleted) descendants which carry a cogs cost."""
+        return [
+            (row[0], row[1])
+            for row in self._COST_OF_ALL_CHILDREN_SQL.execute(self.session, euid=euid)
+        ]
+
+    # A cost is summed when it looks like a number, text which does not is skipped rather than failing the
+    # whole rollup.
+    _COGS_NUMBER_RE = r"^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$"
+
+    _COSTS_OF_CHILDREN_SQL = register_sql(
+        "costs_of_children",
+        """
+        WITH RECURSIVE descendants(root_euid, uuid) AS (
+            SELECT gi.euid, gi.uuid
             FROM generic_instance gi
-            WHERE gi.euid = '{euid}' -- Replace with your target euid
+            WHERE gi.euid = ANY(:euids)
 
-            UNION ALL
+            UNION
 
-            -- Recursive part to get all descendants
-            SELECT child_gi.uuid, child_gi.euid, child_gi.json_addl, child_gi.created_dt
-            FROM generic_instance_lineage gil
-            JOIN descendants d ON gil.parent_instance_uuid = d.uuid
+            SELECT d.root_euid, child_gi.uuid
+            FROM descendants d
+            JOIN generic_instance_lineage gil ON gil.parent_instance_uuid = d.uuid
             JOIN generic_instance child_gi ON gil.child_instance_uuid = child_gi.uuid
-            WHERE NOT child_gi.is_deleted -- Assuming you want to exclude deleted instances
+            WHERE NOT child_gi.is_deleted
         )
-        SELECT d.euid, 
-            d.json_addl -> 'cogs' ->> 'cost' AS cost
+        SELECT d.root_euid, SUM(CAST(gi.json_addl -> 'cogs' ->> 'cost' AS NUMERIC))
         FROM descendants d
-        WHERE d.json_addl ? 'cogs' AND 
-            d.json_addl -> 'cogs' ? 'cost' AND 
-            d.json_addl -> 'cogs' ->> 'cost' <> ''
-        ORDER BY d.created_dt DESC -- Order the final result set        
+        JOIN generic_instance gi ON gi.uuid = d.uuid
+        WHERE gi.json_addl -> 'cogs' ->> 'cost' ~ :number_re
+        GROUP BY d.root_euid
+        """,
+        {"euids": "text[]", "number_re": "text"},
+    )
+
+    def get_costs_of_children(self, euids):
+        """get_cost_of_euid_children() for many roots, with one recursive query.
+
+        Each descendant is counted once per root, however many paths lead to it.
+
+        Returns:
+            {euid: float() or "na"}: "na" where nothing under the root carries a cost
+        """
+        euids = list(dict.fromkeys(euids))
+        if len(euids) == 0:
+            return {}
+
+        costs = {
+            row[0]: float(row[1])
+            for row in self._COSTS_OF_CHILDREN_SQL.execute(
+                self.session, euids=euids, number_re=self._COGS_NUMBER_RE
+            )
+        }
+        return {euid: costs.get(euid, "na") for euid in euids}
+
+    _COGS_TO_PRODUCE_SQL = register_sql(
+        "cogs_to_produce",
         """
+        WITH RECURSIVE ancestors(root_euid, uuid) AS (
+            SELECT gi.euid, gi.uuid
+            FROM generic_instance gi
+            WHERE gi.euid = ANY(:euids)
+
+            UNION
+
+            SELECT a.root_euid, gil.parent_instance_uuid
+            FROM ancestors a
+            JOIN generic_instance_lineage gil ON gil.child_instance_uuid = a.uuid
+        ),
+        node_cost AS (
+            SELECT
+                gi.uuid,
+                gi.json_addl -> 'cogs' ? 'state' AND (
+                    gi.json_addl -> 'cogs' ->> 'state' <> 'active'
+                    OR gi.json_addl -> 'cogs' ->> 'cost' ~ :number_re
+                ) AS has_cogs,
+                gi.json_addl -> 'cogs' ->> 'state' = 'active' AS is_active,
+                gi.json_addl -> 'cogs' ->> 'cost' AS cost,
+                COALESCE(NULLIF(gi.json_addl -> 'cogs' ->> 'fractional_cost', ''), '1') AS fractional_cost,
+                (
+                    SELECT COUNT(*)
+                    FROM generic_instance_lineage l
+                    WHERE l.child_instance_uuid = gi.uuid
+                        AND l.json_addl -> 'cogs' ->> 'state' = 'active'
+                ) AS active_lineages
+            FROM generic_instance gi
+            WHERE gi.uuid IN (SELECT uuid FROM ancestors)
         )
+        SELECT
+            a.root_euid,
+            BOOL_AND(COALESCE(nc.has_cogs, FALSE)) AS complete,
+            SUM(
+                CASE WHEN nc.has_cogs AND nc.is_active
+                THEN CAST(nc.cost AS NUMERIC) * CAST(nc.fractional_cost AS NUMERIC)
+                    / GREATEST(nc.active_lineages, 1)
+                ELSE 0 END
+            ) AS cogs
+        FROM ancestors a
+        JOIN node_cost nc ON nc.uuid = a.uuid
+        GROUP BY a.root_euid
+        """,
+        {"euids": "text[]", "number_re": "text"},
+    )
 
-        # Execute the query
-        result = self.session.execute(query)
+    def get_cogs_to_produce(self, euids):
+        """get_cogs_to_produce_euid() for many roots, with one recursive query.
+
+        Each ancestor (and the root itself) contributes, once per root, cost * fractional_cost divided by
+        the number of its active parent lineages, if its cogs state is active.
 
-        # Extract euids and transit times from the result
-        euid_cost_tuples = [(row[0], row[1]) for row in result]
+        Returns:
+            {euid: float() or "na"}: "na" where some ancestor has no cogs cost/state, 0 for an unknown euid
+        """
+        euids = list(dict.fromkeys(euids))
+        if len(euids) == 0:
+            return {}
 
-        return euid_cost_tuples
+        costs = {}
+        for root_euid, complete, cogs in self._COGS_TO_PRODUCE_SQL.execute(
+            self.session, euids=euids, number_re=self._COGS_NUMBER_RE
+        ):
+            costs[root_euid] = float(cogs) if complete else "na"
+        return {euid: costs.get(euid, 0) for euid in euids}
 
     def query_all_fedex_transit_times_by_ay_euid(self, qx_euid):
+        return self.query_fedex_transit_times_by_queue([qx_euid]).get(qx_euid, [])
 
-        query = text(
-            f"""SELECT gi.euid,
-        gi.json_addl -> 'properties' -> 'fedex_tracking_data' -> 0 ->> 'Transit_Time_sec' AS transit_time
+    _FEDEX_TRANSIT_TIMES_SQL = register_sql(
+        "fedex_transit_times_by_queue",
+        """
+        SELECT gi_parent2.euid, gi.euid,
+            gi.json_addl -> 'properties' -> 'fedex_tracking_data' -> 0 ->> 'Transit_Time_sec' AS transit_time
         FROM generic_instance AS gi
         JOIN generic_instance_lineage AS gil1 ON gi.uuid = gil1.child_instance_uuid
         JOIN generic_instance AS gi_parent1 ON gil1.parent_instance_uuid = gi_parent1.uuid
         JOIN generic_instance_lineage AS gil2 ON gi_parent1.uuid = gil2.child_instance_uuid
         JOIN generic_instance AS gi_parent2 ON gil2.parent_instance_uuid = gi_parent2.uuid
         WHERE
-        gi_parent2.euid = '{qx_euid}' AND
+        gi_parent2.euid = ANY(:qx_euids) AND
         gi.btype = 'package' AND
         jsonb_typeof(gi.json_addl -> 'properties') = 'object' AND
         jsonb_typeof(gi.json_addl -> 'properties' -> 'fedex_tracking_data') = 'array' AND
         jsonb_typeof((gi.json_addl -> 'properties' -> 'fedex_tracking_data' -> 0)) = 'object' AND
         COALESCE(NULLIF(gi.json_addl -> 'properties' -> 'fedex_tracking_data' -> 0 ->> 'Transit_Time_sec', ''), '0') >= '0';
+        """,
+        {"qx_euids": "text[]"},
+    )
+
+    def query_fedex_transit_times_by_queue(self, qx_euids):
+        """{queue euid: [(package euid, transit time)]} for packages two lineage levels under the queues."""
+        ret = {}
+        for qx_euid, euid, transit_time in self._FEDEX_TRANSIT_TIMES_SQL.execute(
+            self.session, qx_euids=list(qx_euids)
+        ):
+            ret.setdefault(qx_euid, []).append((euid, transit_time))
+        return ret
+
+    # The /assays page used to walk every queue and workset and price each workset on every request.  The
+    # numbers are computed here with a fixed number of queries and kept in assay_dashboard_metrics, which the
+    # page reads; rows older than BLOOM_ASSAY_METRICS_MAX_AGE_SEC are recomputed on read, and main.py
+    # refreshes them all in the background.
+    _ASSAY_METRICS_WORKSET_LIMIT = 150
+    _ASSAY_QUEUE_WORKSETS_SQL = register_sql(
+        "assay_queue_worksets",
+        """
+        SELECT queue_euid, n, workset_euid FROM (
+            SELECT
+                p.euid AS queue_euid,
+                c.euid AS workset_euid,
+                COUNT(*) OVER (PARTITION BY p.uuid) AS n,
+                ROW_NUMBER() OVER (PARTITION BY p.uuid ORDER BY c.created_dt DESC) AS rn
+            FROM generic_instance_lineage gil
+            JOIN generic_instance p ON p.uuid = gil.parent_instance_uuid
+            JOIN generic_instance c ON c.uuid = gil.child_instance_uuid
+            WHERE p.euid = ANY(:queue_euids) AND NOT gil.is_deleted
+        ) w
+        WHERE rn <= :limit
+        """,
+        {"queue_euids": "text[]", "limit": "integer"},
+    )
+    _ASSAY_METRICS_SQL = register_sql(
+        "assay_dashboard_metrics",
         """
+        SELECT assay_euid, metrics,
+            EXTRACT(EPOCH FROM (CURRENT_TIMESTAMP - refreshed_at)) > :max_age AS stale
+        FROM assay_dashboard_metrics
+        WHERE assay_euid = ANY(:assay_euids)
+        """,
+        {"max_age": "double precision", "assay_euids": "text[]"},
+    )
+
+    def compute_assay_metrics(self, assays):
+        """{assay euid: metrics} for the assay workflow_instances, see refresh_assay_metrics()."""
+        if len(assays) == 0:
+            return {}
+
+        queue_lins = self.get_lineage_children(assays, include_deleted=True)
+        queues = [lin.child_instance for lin in queue_lins]
+        queue_euids = [q.euid for q in queues]
+
+        # workset counts per queue, and the most recent worksets of each, whose COGS are summed
+        worksets = {}
+        workset_counts = {}
+        if queue_euids:
+            rows = self._ASSAY_QUEUE_WORKSETS_SQL.execute(
+                self.session,
+                queue_euids=queue_euids,
+                limit=self._ASSAY_METRICS_WORKSET_LIMIT + 1,
+            )
+            for queue_euid, n, workset_euid in rows:
+                workset_counts[queue_euid] = n
+                worksets.setdefault(queue_euid, []).append(workset_euid)
+
+        workset_costs = self.get_costs_of_children(
+            [e for euids in worksets.values() for e in euids]
         )
+        transit_times = self.query_fedex_transit_times_by_queue(queue_euids)
+
+        metrics = {}
+        for assay in assays:
+            m = {
+                "Instantaneous COGS": 0,
+                "tot": 0,
+                "tit_s": 0,
+                "tot_fx": 0,
+                "avail": 0,
+                "inprog": 0,
+                "complete": 0,
+                "exception": 0,
+                "queues": [],
+            }
+            for lin in queue_lins:
+                if lin.parent_instance_uuid != assay.uuid:
+                    continue
+                queue = lin.child_instance
+                for euid, transit_time in transit_times.get(queue.euid, []):
+                    try:
+                        m["tit_s"] += float(transit_time)
+                        m["tot_fx"] += 1
+                    except Exception as e:
+                        self.logger.debug(e)
+
+                name = queue.json_addl.get("properties", {}).get("name", "na")
+                wset = ""
+                if name.startswith("In"):
+                    wset = "inprog"
+                elif name.startswith("Comple"):
+                    wset = "complete"
+                elif name.startswith("Exception"):
+                    wset = "exception"
+                elif name.startswith("Ready"):
+                    wset = "avail"
+                m[wset] = workset_counts.get(queue.euid, 0)
+
+                for workset_euid in worksets.get(queue.euid, []):
+                    cost = workset_costs[workset_euid]
+                    m["Instantaneous COGS"] += round(cost, 2) if cost != "na" else 0
+                    m["tot"] += 1
+
+                m["queues"].append(
+                    {
+                        "euid": queue.euid,
+                        "name": name,
+                        "btype": queue.btype,
+                        "b_sub_type": queue.b_sub_type,
+                        "n_worksets": workset_counts.get(queue.euid, 0),
+                    }
+                )
 
-        # Execute the query
-        result = self.session.execute(query)
-
-        # Extract euids and transit times from the result
-        euid_transit_time_tuples = [(row[0], row[1]) for row in result]
-
-        return euid_transit_time_tuples
-
-    def fetch_graph_data_by_node_depth(self, start_euid, depth):
-        # SQL query with placeholders for parameters
-        query = text(
-            f"""WITH RECURSIVE graph_data AS (
-                SELECT 
-                    gi.euid, 
-                    gi.uuid, 
-                    gi.name, 
-                    gi.btype, 
-                    gi.super_type, 
-                    gi.b_sub_type, 
-                    gi.version, 
-                    0 AS depth,
-                    NULL::text AS lineage_euid,
-                    NULL::text AS lineage_parent_euid,
-                    NULL::text AS lineage_child_euid,
-                    NULL::text AS relationship_type
-                FROM 
-                    generic_instance gi
-                WHERE 
-                    gi.euid = '{start_euid}' AND gi.is_deleted = FALSE
-
-                UNION
-
-                SELECT 
-                    gi.euid, 
-                    gi.uuid, 
-                    gi.name, 
-                    gi.btype, 
-                    gi.super_type, 
-                    gi.b_sub_type, 
-                    gi.version, 
-                    gd.depth + 1,
-                    gil.euid AS lineage_euid,
-                    parent_instance.euid AS lineage_parent_euid,
-                    child_instance.euid as lineage_child_euid,
-                    gil.relationship_type
-                FROM 
-                    generic_instance_lineage gil
-                JOIN 
-                    generic_instance gi ON gi.uuid = gil.child_instance_uuid OR gi.uuid = gil.parent_instance_uuid
-                JOIN 
-                    generic_instance parent_instance ON gil.parent_instance_uuid = parent_instance.uuid
-                JOIN 
-                    generic_instance child_instance ON gil.child_instance_uuid = child_instance.uuid
-                JOIN 
-                    graph_data gd ON (gil.parent_instance_uuid = gd.uuid AND gi.uuid = gil.child_instance_uuid) OR 
-                                    (gil.child_instance_uuid = gd.uuid AND gi.uuid = gil.parent_instance_uuid)
-                WHERE 
-                    gi.is_deleted = FALSE AND gd.depth < {depth}
-            )
-            SELECT DISTINCT * FROM graph_data;
+            m["avg_d_fx"] = (
+                round(float(m["tit_s"]) / 60.0 / 60.0 / 24.0 / float(m["tot_fx"]), 2)
+                if m["tot_fx"] > 0
+                else "na"
+            )
+            m["conv"] = (
+                round(float(m["complete"]) / float(m["complete"] + m["exception"]), 2)
+                if m["complete"] + m["exception"] > 0
+                else "na"
+            )
+            m["wsetp"] = (
+                round(float(m["Instantaneous COGS"]) / float(m["tot"]), 2)
+                if m["tot"] > 0
+                else "na"
+            )
+            metrics[assay.euid] = m
+
+        return metrics
+
+    def _query_assays(self, assay_euids=None):
+        wi = self.Base.classes.workflow_instance
+        query = self.session.query(wi).filter_by(is_deleted=False, is_singleton=True)
+        if assay_euids is not None:
+            query = query.filter(wi.euid.in_(list(assay_euids)))
+        return query.all()
+
+    def refresh_assay_metrics(self, assay_euids=None):
+        """Recompute assay_dashboard_metrics for the assays (all singleton workflow_instances by default)."""
+        assays = self._query_assays(assay_euids)
+        metrics = self.compute_assay_metrics(assays)
+        if metrics:
+            self.session.execute(
+                text(
+                    """
+                    INSERT INTO assay_dashboard_metrics (assay_euid, assay_uuid, metrics, refreshed_at)
+                    VALUES (:assay_euid, :assay_uuid, CAST(:metrics AS JSONB), CURRENT_TIMESTAMP)
+                    ON CONFLICT (assay_euid) DO UPDATE
+                    SET assay_uuid = EXCLUDED.assay_uuid,
+                        metrics = EXCLUDED.metrics,
+                        refreshed_at = EXCLUDED.refreshed_at
+                    """
+                ),
+                [
+                    {
+                        "assay_euid": assay.euid,
+                        "assay_uuid": str(assay.uuid),
+                        "metrics": json.dumps(metrics[assay.euid]),
+                    }
+                    for assay in assays
+                ],
+            )
+        self.session.commit()
+        return metrics
+
+    def get_assay_metrics(self, assay_euids, max_age_sec=None):
+        """{assay euid: metrics} from assay_dashboard_metrics, (re)computing missing or stale rows first."""
+        if max_age_sec is None:
+            max_age_sec = float(os.environ.get("BLOOM_ASSAY_METRICS_MAX_AGE_SEC", 900))
+        assay_euids = list(assay_euids)
+        if len(assay_euids) == 0:
+            return {}
+
+        rows = self._ASSAY_METRICS_SQL.execute(
+            self.session, max_age=max_age_sec, assay_euids=assay_euids
+        ).all()
+        metrics = {row.assay_euid: row.metrics for row in rows if not row.stale}
+
+        missing = [e for e in assay_euids if e not in metrics]
+        if missing:
+            metrics.update(self.refresh_assay_metrics(missing))
+        return metrics
+
+    # The DAG explorer neighbourhood used to be one recursive CTE joining generic_instance on "child OR parent",
+    # which no index can serve, and which re-walked every node once per path (and per direction) reaching it.
+    # It is now a breadth first walk, one query per level: the frontier's children and its parents are two
+    # separately indexed branches, nodes already visited are not expanded again, and the walk stops at
+    # max_nodes (BLOOM_DAG_MAX_NODES).
+    _GRAPH_NODE_SQL = register_sql(
+        "graph_node",
         """
-        )
+        SELECT uuid, euid, name, btype, super_type, b_sub_type, version
+        FROM generic_instance
+        WHERE euid = :euid AND is_deleted = FALSE
+        """,
+        {"euid": "text"},
+    )
+    _GRAPH_NEIGHBOURS_SQL = register_sql(
+        "graph_neighbours",
+        """
+        SELECT
+            gil.euid AS lineage_euid,
+            gil.parent_instance_uuid,
+            gil.child_instance_uuid,
+            gil.relationship_type,
+            n.uuid, n.euid, n.name, n.btype, n.super_type, n.b_sub_type, n.version
+        FROM generic_instance_lineage gil
+        JOIN generic_instance n ON n.uuid = gil.child_instance_uuid
+        WHERE gil.parent_instance_uuid = ANY(CAST(:frontier AS UUID[])) AND n.is_deleted = FALSE
 
-        # Execute the query
-        result = self.session.execute(query)
-        return result
+        UNION ALL
+
+        SELECT
+            gil.euid AS lineage_euid,
+            gil.parent_instance_uuid,
+            gil.child_instance_uuid,
+            gil.relationship_type,
+            n.uuid, n.euid, n.name, n.btype, n.super_type, n.b_sub_type, n.version
+        FROM generic_instance_lineage gil
+        JOIN generic_instance n ON n.uuid = gil.parent_instance_uuid
+        WHERE gil.child_instance_uuid = ANY(CAST(:frontier AS UUID[])) AND n.is_deleted = FALSE
+
+        ORDER BY lineage_euid
+        """,
+        {"frontier": "text[]"},
+    )
+
+    def fetch_graph_neighbourhood(self, start_euid, depth, max_nodes=None):
+        """The instances within depth lineage hops of start_euid, in either direction.
+
+        Args:
+            start_euid str(): a generic_instance euid
+            depth int(): how many hops to walk
+            max_nodes int(): stop once this many nodes are found, default BLOOM_DAG_MAX_NODES (1000)
+
+        Returns:
+            {"nodes": [{euid, name, btype, super_type, b_sub_type, version, depth}],
+             "edges": [{lineage_euid, parent_euid, child_euid, relationship_type}],
+             "truncated": bool()}: edges only join returned nodes; truncated is True if max_nodes was hit
+        """
+        if max_nodes is None:
+            max_nodes = int(os.environ.get("BLOOM_DAG_MAX_NODES", 1000))
+
+        node_cols = ["uuid", "euid", "name", "btype", "super_type", "b_sub_type", "version"]
+        nodes = {}
+        edges = {}
+        truncated = False
+
+        root = self._GRAPH_NODE_SQL.execute(self.session, euid=start_euid).first()
+        if root is None:
+            return {"nodes": [], "edges": [], "truncated": False}
+        nodes[root.uuid] = dict(zip(node_cols, root), depth=0)
+
+        frontier = [root.uuid]
+        for level in range(1, int(depth) + 1):
+            if not frontier or truncated:
+                break
+            next_frontier = []
+            rows = self._GRAPH_NEIGHBOURS_SQL.execute(
+                self.session, frontier=[str(u) for u in frontier]
+            )
+            for row in rows:
+                if row.uuid not in nodes:
+                    if len(nodes) >= max_nodes:
+                        truncated = True
+                        continue
+                    nodes[row.uuid] = dict(zip(node_cols, row[4:]), depth=level)
+                    next_frontier.append(row.uuid)
+                if row.lineage_euid not in edges:
+                    edges[row.lineage_euid] = row
+            frontier = next_frontier
+
+        return {
+            "nodes": [
+                {k: v for k, v in node.items() if k != "uuid"} for node in nodes.values()
+            ],
+            "edges": [
+                {
+                    "lineage_euid": lineage_euid,
+                    "parent_euid": nodes[row.parent_instance_uuid]["euid"],
+                    "child_euid": nodes[row.child_instance_uuid]["euid"],
+                    "relationship_type": row.relationship_type,
+                }
+                for lineage_euid, row in edges.items()
+                if row.parent_instance_uuid in nodes and row.child_instance_uuid in nodes
+            ],
+            "truncated": truncated,
+        }
 
     def create_instance_by_template_components(
         self, super_type, btype, b_sub_type, version
@@ -1581,16 +3039,13 @@ class BloomObj:
         euids = action_ds["captured_data"]["euids"]
 
         # euids is the text from a textareas, process each and assign lineage
+        edges = []
         for a_euid in euids.split("\n"):
             if a_euid != "":
                 if lineage_to_create == "parent":
-                    self.create_generic_instance_lineage_by_euids(
-                        a_euid, euid, relationship_type
-                    )
+                    edges.append((a_euid, euid_obj, relationship_type))
                 elif lineage_to_create == "child":
-                    self.create_generic_instance_lineage_by_euids(
-                        euid, a_euid, relationship_type
-                    )
+                    edges.append((euid_obj, a_euid, relationship_type))
                 else:
                     self.logger.exception(
                         f"Unknown lineage type {lineage_to_create}, requires 'parent' or 'child'"
@@ -1598,19 +3053,29 @@ class BloomObj:
                     raise Exception(
                         f"Unknown lineage type {lineage_to_create}, requires 'parent' or 'child'"
                     )
+        self.create_generic_instance_lineages(edges)
 
         return euid_obj
 
+    def _ret_wells_and_contents(self, plate):
+        # two queries, all the wells of the plate and then all the contents of those wells.  Soft deleted
+        # lineages and instances are included, as walking plate.parent_of_lineages always did.
+        well_lins = self.get_lineage_children(plate, btype="well", include_deleted=True)
+        contents = {}
+        for c in self.get_lineage_children(
+            [lin.child_instance for lin in well_lins], super_type="content", include_deleted=True
+        ):
+            contents.setdefault(c.parent_instance_uuid, []).append(c.child_instance)
+        return well_lins, contents
+
     def ret_plate_wells_dict(self, plate):
         plate_wells = {}
-        for lin in plate.parent_of_lineages:
+        well_lins, contents = self._ret_wells_and_contents(plate)
+        for lin in well_lins:
             if lin.child_instance.btype == "well":
 
                 well = lin.child_instance
-                content_arr = []
-                for c in well.parent_of_lineages:
-                    if c.child_instance.super_type == "content":
-                        content_arr.append(c.child_instance)
+                content_arr = contents.get(well.uuid, [])
                 content = None
                 if len(content_arr) == 0:
                     pass
@@ -1663,35 +3128,36 @@ class BloomObj:
             source_plates.append(spo)
             source_plates_well_digested.append(self.ret_plate_wells_dict(spo))
 
+        # all the new edges are created together at the end
+        edges = []
         wfs = ""
         for layout_str in action_ds["child_workflow_step_obj"]:
             wfs = self.create_instance_by_code(
                 layout_str, action_ds["child_workflow_step_obj"][layout_str]
             )
-            self.create_generic_instance_lineage_by_euids(euid_obj.euid, wfs.euid)
+            edges.append((euid_obj, wfs))
 
-        self.create_generic_instance_lineage_by_euids(wfs.euid, dest_plate.euid)
+        edges.append((wfs, dest_plate))
 
         for spo in source_plates:
-            self.create_generic_instance_lineage_by_euids(wfs.euid, spo.euid)
+            edges.append((wfs, spo))
 
         # For all plates being stamped into the destination, link all source plate wells to the destination plate wells, and the contensts of source wells to destination wells.
         # Further, if a dest well is empty, create a new content instance for it and link appropriately.
-        for dest_well in dest_plate.parent_of_lineages:
+        dest_wells, dest_contents = self._ret_wells_and_contents(dest_plate)
+        for dest_well in dest_wells:
             if dest_well.child_instance.btype == "well":
                 well_name = dest_well.child_instance.json_addl["cont_address"]["name"]
                 for spod in source_plates_well_digested:
                     if well_name in spod:
-                        self.create_generic_instance_lineage_by_euids(
-                            spod[well_name][0].euid, dest_well.child_instance.euid
-                        )
+                        edges.append((spod[well_name][0], dest_well.child_instance))
                         if spod[well_name][1] != None:
-                            for dwc in dest_well.child_instance.parent_of_lineages:
-                                if dwc.child_instance.super_type == "content":
-                                    self.create_generic_instance_lineage_by_euids(
-                                        spod[well_name][1].euid, dwc.child_instance.euid
-                                    )
+                            for dwc in dest_contents.get(
+                                dest_well.child_instance.uuid, []
+                            ):
+                                edges.append((spod[well_name][1], dwc))
                         del spod[well_name]
+        self.create_generic_instance_lineages(edges)
         ## TODO
         ### IF there are any source wells left, create new content instances for them and link to the dest wells
         remaining_wells = 0
@@ -2009,12 +3475,214 @@ class BloomObj:
 
         return bobj
 
-    def query_audit_log_by_euid(self, euid):
-        return (
-            self.session.query(self.Base.classes.audit_log)
-            .filter(self.Base.classes.audit_log.rel_table_euid_fk == euid)
+    def query_audit_log_by_euid(self, euid, since=None, until=None):
+        """audit_log rows for euid, changed_at in [since, until) when given.  Nothing is logged for an object before
+        it was created, so pass its created_dt as since to skip the older audit_log partitions.
+        """
+        audit_log = self.Base.classes.audit_log
+        query = self.session.query(audit_log).filter(audit_log.rel_table_euid_fk == euid)
+        if since is not None:
+            query = query.filter(audit_log.changed_at >= since)
+        if until is not None:
+            query = query.filter(audit_log.changed_at < until)
+        return query.all()
+
+    # json_addl changes are kept in audit_log as path level patches (audit_log.json_addl, see jsonb_diff_paths in
+    # postgres_schema_v3.sql), json_addl_as_of() undoes them from the current document back to the one asked for
+    _JSON_ADDL_AS_OF_SQL = register_sql(
+        "json_addl_as_of",
+        "SELECT json_addl_as_of(:table_name, CAST(:uuid AS UUID), :as_of)",
+        {"table_name": "text", "uuid": "text", "as_of": "timestamptz"},
+    )
+
+    def get_json_addl_as_of(self, euid, as_of):
+        """The json_addl of euid as it was at as_of (a datetime, ie: an audit_log changed_at)."""
+        obj = self.get_by_euid(euid)
+        return self._JSON_ADDL_AS_OF_SQL.execute(
+            self.session, table_name=obj.__table__.name, uuid=str(obj.uuid), as_of=as_of
+        ).scalar()
+
+    # audit_log is range partitioned by month on changed_at (see postgres_schema_v3.sql).  The partitions are made
+    # ahead of time by ensure_audit_log_partitions(), and archive_audit_log_partitions() writes the months older than
+    # BLOOM_AUDIT_LOG_KEEP_MONTHS out to compressed CSV or Parquet, on local disk or S3, records them in
+    # audit_log_archive and drops them.  bloom_lims/bin/archive_audit_log.py runs both, ie: from cron.
+    _AUDIT_LOG_PARTITION_RE = re.compile(r"^audit_log_p(\d{4})(\d{2})$")
+
+    def ensure_audit_log_partitions(self, months_ahead=None):
+        """Make any missing monthly audit_log partitions through months_ahead (BLOOM_AUDIT_LOG_MONTHS_AHEAD, 3)
+        months from now.  Returns the names of the ones made.
+        """
+        if months_ahead is None:
+            months_ahead = int(os.environ.get("BLOOM_AUDIT_LOG_MONTHS_AHEAD", 3))
+        created = (
+            self.session.execute(
+                text("SELECT create_audit_log_partitions(:months_ahead)"),
+                {"months_ahead": months_ahead},
+            )
+            .scalars()
+            .all()
+        )
+        self.session.commit()
+        return created
+
+    def list_audit_log_partitions(self):
+        """[(name, range start, range end)] of the monthly audit_log partitions, oldest first."""
+        names = (
+            self.session.execute(
+                text(
+                    "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                    "WHERE i.inhparent = 'audit_log'::regclass"
+                )
+            )
+            .scalars()
             .all()
         )
+        partitions = []
+        for name in names:
+            match = self._AUDIT_LOG_PARTITION_RE.match(name)
+            if match:
+                start = datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=pytz.utc)
+                partitions.append((name, start, _month_start(start, 1)))
+        return sorted(partitions, key=lambda p: p[1])
+
+    def audit_log_partitions_to_archive(self, keep_months=None, now=None):
+        """The list_audit_log_partitions() which end keep_months (BLOOM_AUDIT_LOG_KEEP_MONTHS, 12) or more months
+        before the start of this month.
+        """
+        if keep_months is None:
+            keep_months = int(os.environ.get("BLOOM_AUDIT_LOG_KEEP_MONTHS", 12))
+        cutoff = _month_start(now or datetime.now(pytz.utc), -keep_months)
+        return [p for p in self.list_audit_log_partitions() if p[2] <= cutoff]
+
+    def archive_audit_log_partitions(self, dest, keep_months=None, fmt="csv", drop=True, now=None):
+        """Archive the audit_log_partitions_to_archive(keep_months).
+
+        Args:
+            dest str(): a local directory or s3://bucket/prefix, files are named <partition>.csv.gz / .parquet
+            fmt str(): csv (gzipped) or parquet (zstd, needs pyarrow)
+            drop bool(): detach and drop each partition once its file is written and checked
+
+        Returns:
+            [] : the audit_log_archive rows written, as dicts
+        """
+        if fmt not in ["csv", "parquet"]:
+            raise ValueError(f"Unknown audit_log archive format: {fmt}")
+
+        archived = []
+        for name, start, end in self.audit_log_partitions_to_archive(keep_months, now):
+            try:
+                archived.append(self._archive_audit_log_partition(name, start, end, dest, fmt, drop))
+            except Exception:
+                self.session.rollback()
+                raise
+        return archived
+
+    def _archive_audit_log_partition(self, name, start, end, dest, fmt, drop):
+        filename = f"{name}.csv.gz" if fmt == "csv" else f"{name}.parquet"
+        # nothing should be written this far back, but make sure of it until the partition is gone
+        self.session.execute(text(f'LOCK TABLE "{name}" IN SHARE MODE'))
+        n_expected = self.session.execute(text(f'SELECT COUNT(*) FROM "{name}"')).scalar()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if dest.startswith("s3://"):
+                path = os.path.join(tmp_dir, filename)
+            else:
+                os.makedirs(dest, exist_ok=True)
+                path = os.path.join(dest, filename + ".part")
+
+            if fmt == "csv":
+                n_rows = self._write_audit_log_csv(name, path)
+            else:
+                n_rows = self._write_audit_log_parquet(name, path)
+            if n_rows != n_expected:
+                raise Exception(f"Wrote {n_rows} of the {n_expected} rows in {name}, it was not archived")
+
+            if dest.startswith("s3://"):
+                bucket, _, prefix = dest[len("s3://") :].partition("/")
+                key = f"{prefix.strip('/')}/{filename}".lstrip("/")
+                s3_client = boto3.client("s3")
+                _with_s3_backoff(
+                    s3_client.upload_file, path, bucket, key, Config=s3_transfer_config()
+                )
+                head = _with_s3_backoff(s3_client.head_object, Bucket=bucket, Key=key)
+                if head["ContentLength"] != os.path.getsize(path):
+                    raise Exception(f"s3://{bucket}/{key} is not the size written, {name} was not archived")
+                location = f"s3://{bucket}/{key}"
+            else:
+                location = os.path.join(dest, filename)
+                os.replace(path, location)
+
+        archive = {
+            "partition_name": name,
+            "range_start": start,
+            "range_end": end,
+            "n_rows": n_rows,
+            "location": location,
+        }
+        self.session.execute(
+            text(
+                "INSERT INTO audit_log_archive (partition_name, range_start, range_end, n_rows, location) "
+                "VALUES (:partition_name, :range_start, :range_end, :n_rows, :location) "
+                "ON CONFLICT (partition_name) DO UPDATE SET n_rows = EXCLUDED.n_rows, location = EXCLUDED.location, "
+                "archived_at = CURRENT_TIMESTAMP"
+            ),
+            archive,
+        )
+        if drop:
+            self.session.execute(text(f'ALTER TABLE audit_log DETACH PARTITION "{name}"'))
+            self.session.execute(text(f'DROP TABLE "{name}"'))
+        self.session.commit()
+        self.logger.info(f"Archived {n_rows} audit_log rows from {name} to {location}")
+        return archive
+
+    def _write_audit_log_csv(self, name, path):
+        cursor = self.session.connection().connection.cursor()
+        with gzip.open(path, "wb") as f:
+            cursor.copy_expert(
+                f'COPY (SELECT * FROM "{name}" ORDER BY seq) TO STDOUT WITH (FORMAT csv, HEADER)', f
+            )
+        return cursor.rowcount
+
+    def _write_audit_log_parquet(self, name, path):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise Exception("pyarrow is needed to archive audit_log as parquet, pip install pyarrow (or use csv)")
+
+        columns = self.session.execute(
+            text(
+                "SELECT column_name, data_type FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = 'audit_log' ORDER BY ordinal_position"
+            )
+        ).all()
+        arrow_types = {
+            "boolean": pa.bool_(),
+            "bigint": pa.int64(),
+            "integer": pa.int32(),
+            "timestamp with time zone": pa.timestamp("us", tz="UTC"),
+        }
+        schema = pa.schema([(c, arrow_types.get(t, pa.string())) for c, t in columns])
+        # uuid and jsonb (and text) columns go out as strings
+        select = ", ".join(
+            f'"{c}"' if t in arrow_types else f'CAST("{c}" AS TEXT) AS "{c}"' for c, t in columns
+        )
+
+        batch_size = int(os.environ.get("BLOOM_AUDIT_LOG_ARCHIVE_BATCH", 10000))
+        cursor = self.session.connection().connection.cursor(name=f"archive_{name}")
+        cursor.itersize = batch_size
+        cursor.execute(f'SELECT {select} FROM "{name}" ORDER BY seq')
+        n_rows = 0
+        with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                arrays = [pa.array(list(col), type=field.type) for col, field in zip(zip(*rows), schema)]
+                writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                n_rows += len(rows)
+        cursor.close()
+        return n_rows
 
     def check_lineages_for_btype(self, lineages, btype, parent_or_child=None):
         if parent_or_child == "parent":
@@ -2031,81 +3699,55 @@ class BloomObj:
         return False
 
     def get_cost_of_euid_children(self, euid):
-        tot_cost = 0
-        ctr = 0
-        for ec_tups in self.query_cost_of_all_children(euid):
-            tot_cost += float(ec_tups[1])
-            ctr += 1
-        return tot_cost if ctr > 0 else "na"
-
-        # Start with the provided EUID
-        initial_instance = (
-            self.session.query(self.Base.classes.generic_instance)
-            .filter_by(euid=euid)
-            .first()
-        )
-        if initial_instance:
-            return traverse_and_calculate_children_cogs(initial_instance)
-        else:
-            return 0
+        return self.get_costs_of_children([euid])[euid]
 
     def get_cogs_to_produce_euid(self, euid):
-
-        # Function to fetch and calculate the COGS for a given object
-        def calculate_cogs(orm_instance):
-            if (
-                "cogs" not in orm_instance.json_addl
-                or "state" not in orm_instance.json_addl["cogs"]
-            ):
-                raise ValueError(
-                    f"COGS or state information missing for EUID: {orm_instance.euid}"
+        cogs = self.get_cogs_to_produce([euid])[euid]
+        if cogs == "na":
+            raise ValueError(f"COGS or state information missing in the history of EUID: {euid}")
+        return cogs
+
+    # Dewey properties with their own expression index (postgres_schema_v3.sql), a search on one of these for a
+    # string is a ->> equality on the index rather than a @> on the json_addl GIN
+    _INDEXED_PROPERTIES = ("patient_id", "study_id", "upload_group_key")
+
+    def _addl_metadata_condition(self, model, search_criteria, search_greedy=True):
+        """The json_addl filter for search_criteria, any (greedy) or all of the terms, None if there are none."""
+        conditions = []
+        for key, value in search_criteria.items():
+            if key == "file_metadata":
+                key = "properties"
+                logging.warning(
+                    "The key 'file_metadata' is being treated as 'properties'."
                 )
 
-            if orm_instance.json_addl["cogs"]["state"] != "active":
-                return 0
-
-            cost = float(orm_instance.json_addl["cogs"]["cost"])
-            fractional_cost = float(
-                orm_instance.json_addl["cogs"].get("fractional_cost", 1)
-            )
-            allocation_type = orm_instance.json_addl["cogs"].get(
-                "allocation_type", "single"
-            )
-
-            active_children = len(
-                [
-                    child
-                    for child in orm_instance.child_of_lineages
-                    if "cogs" in child.json_addl
-                    and child.json_addl["cogs"].get("state") == "active"
-                ]
-            )
-            if active_children == 0:
-                active_children = 1.0
-            return cost * float(fractional_cost) / float(active_children)
-
-        # Recursive function to traverse the graph and accumulate COGS
-        def traverse_history_and_calculate_cogs(orm_instance):
-            total_cogs = calculate_cogs(orm_instance)
-
-            # Traverse child_of_lineages to find parent instances and accumulate their COGS
-            for lineage in orm_instance.child_of_lineages:
-                parent_instance = lineage.parent_instance
-                if parent_instance:
-                    total_cogs += traverse_history_and_calculate_cogs(parent_instance)
-
-            return total_cogs
+            # Create conditions for JSONB key-value pairs
+            if isinstance(value, dict):
+                for sub_key, sub_value in value.items():
+                    if (
+                        key == "properties"
+                        and sub_key in self._INDEXED_PROPERTIES
+                        and isinstance(sub_value, str)
+                    ):
+                        # spelt out as -> / ->> to match the index expression, not json_addl['properties']
+                        conditions.append(
+                            model.json_addl.op("->")("properties").op("->>")(sub_key)
+                            == sub_value
+                        )
+                    else:
+                        conditions.append(
+                            model.json_addl.op("@>")(cast({key: {sub_key: sub_value}}, JSONB))
+                        )
+            else:
+                conditions.append(model.json_addl.op("@>")(cast({key: value}, JSONB)))
 
-        # Start with the provided EUID
-        initial_instance = (
-            self.session.query(self.Base.classes.generic_instance)
-            .filter_by(euid=euid)
-            .first()
-        )
-        if initial_instance:
-            return traverse_history_and_calculate_cogs(initial_instance)
-        else:
-            return 0
+        if not conditions:
+            return None
+        if search_greedy:
+            # Greedy search: matching any of the provided search keys
+            return or_(*conditions)
+        # Non-greedy search: matching all specified search terms
+        return and_(*conditions)
 
     def search_objs_by_addl_metadata(
         self,
@@ -2115,84 +3757,115 @@ class BloomObj:
         b_sub_type=None,
         super_type=None,
     ):
-        query = self.session.query(self.Base.classes.generic_instance)
+        gi = self.Base.classes.generic_instance
+        query = self.session.query(gi)
 
-        if search_greedy:
-            # Greedy search: matching any of the provided search keys
-            or_conditions = []
-            for key, value in file_search_criteria.items():
-                if key == "file_metadata":
-                    key = "properties"
-                    logging.warning(
-                        "The key 'file_metadata' is being treated as 'properties'."
-                    )
-
-                # Create conditions for JSONB key-value pairs
-                if isinstance(value, dict):
-                    for sub_key, sub_value in value.items():
-                        jsonb_filter = {key: {sub_key: sub_value}}
-                        or_conditions.append(
-                            self.Base.classes.generic_instance.json_addl.op("@>")(
-                                jsonb_filter
-                            )
-                        )
-                else:
-                    jsonb_filter = {key: value}
-                    or_conditions.append(
-                        self.Base.classes.generic_instance.json_addl.op("@>")(
-                            jsonb_filter
-                        )
-                    )
-
-            if or_conditions:
-                query = query.filter(or_(*or_conditions))
-        else:
-            # Non-greedy search: matching all specified search terms
-            and_conditions = []
-            for key, value in file_search_criteria.items():
-                if key == "file_metadata":
-                    key = "properties"
-                    logging.warning(
-                        "The key 'file_metadata' is being treated as 'properties'."
-                    )
-
-                if isinstance(value, dict):
-                    for sub_key, sub_value in value.items():
-                        jsonb_filter = {key: {sub_key: sub_value}}
-                        and_conditions.append(
-                            self.Base.classes.generic_instance.json_addl.op("@>")(
-                                jsonb_filter
-                            )
-                        )
-                else:
-                    jsonb_filter = {key: value}
-                    and_conditions.append(
-                        self.Base.classes.generic_instance.json_addl.op("@>")(
-                            jsonb_filter
-                        )
-                    )
-
-            if and_conditions:
-                query = query.filter(and_(*and_conditions))
+        condition = self._addl_metadata_condition(gi, file_search_criteria, search_greedy)
+        if condition is not None:
+            query = query.filter(condition)
 
         if btype is not None:
-            query = query.filter(self.Base.classes.generic_instance.btype == btype)
+            query = query.filter(gi.btype == btype)
 
         if b_sub_type is not None:
-            query = query.filter(
-                self.Base.classes.generic_instance.b_sub_type == b_sub_type
-            )
+            query = query.filter(gi.b_sub_type == b_sub_type)
 
         if super_type is not None:
-            query = query.filter(
-                self.Base.classes.generic_instance.super_type == super_type
-            )
+            query = query.filter(gi.super_type == super_type)
 
         logging.info(f"Generated SQL: {str(query.statement)}")
 
         results = query.all()
         return [result.euid for result in results]
 
+    def search_addl_metadata(
+        self,
+        search_criteria=None,
+        search_greedy=True,
+        btype=None,
+        b_sub_type=None,
+        super_type=None,
+        euids=None,
+        limit=None,
+        offset=0,
+        after=None,
+    ):
+        """generic_instances matching search_criteria (as search_objs_by_addl_metadata) and/or in euids, newest
+        first, as just the columns the search pages show, one query for the page and the total.
+
+        Args:
+            limit int(): page size, None for everything
+            offset int(): rows to skip, or
+            after str(): the next_after of the previous page, keyset paginated on (created_dt, uuid)
+
+        Returns:
+            {} : {"rows": [{"euid", "uuid", "created_dt", "bstatus", "properties"}], "total": int(),
+                  "next_after": cursor for the next page, None on the last}
+        """
+        gi = self.Base.classes.generic_instance
+        conditions = [gi.is_deleted == self.is_deleted]
+        condition = self._addl_metadata_condition(gi, search_criteria or {}, search_greedy)
+        if condition is not None:
+            conditions.append(condition)
+        if euids is not None:
+            conditions.append(gi.euid.in_(list(euids)))
+        if btype is not None:
+            conditions.append(gi.btype == btype)
+        if b_sub_type is not None:
+            conditions.append(gi.b_sub_type == b_sub_type)
+        if super_type is not None:
+            conditions.append(gi.super_type == super_type)
+
+        total = (
+            self.session.query(func.count(gi.uuid)).filter(*conditions).scalar_subquery()
+        )
+        query = self.session.query(
+            gi.euid,
+            gi.uuid,
+            gi.created_dt,
+            gi.bstatus,
+            gi.json_addl["properties"].label("properties"),
+            total.label("total"),
+        ).filter(*conditions)
+        if after:
+            after_created_dt, after_uuid = _parse_keyset_cursor(after)
+            query = query.filter(
+                or_(
+                    gi.created_dt < after_created_dt,
+                    and_(gi.created_dt == after_created_dt, gi.uuid < after_uuid),
+                )
+            )
+        query = query.order_by(desc(gi.created_dt), desc(gi.uuid))
+        if offset:
+            query = query.offset(offset)
+        if limit is not None:
+            query = query.limit(limit + 1)
+
+        rows = query.all()
+        next_after = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_after = _keyset_cursor(rows[-1].created_dt, rows[-1].uuid)
+        if rows:
+            n_total = rows[0].total
+        else:
+            n_total = self.session.query(func.count(gi.uuid)).filter(*conditions).scalar()
+
+        return {
+            "rows": [
+                {
+                    "euid": r.euid,
+                    "uuid": r.uuid,
+                    "created_dt": r.created_dt,
+                    "bstatus": r.bstatus,
+                    "properties": r.properties or {},
+                }
+                for r in rows
+            ],
+            "total": n_total,
+            "next_after": next_after,
+        }
+
 
 class BloomContainer(BloomObj):
     def __init__(self, bdb):
@@ -2308,7 +3981,9 @@ class BloomWorkflow(BloomObj):
         # Assuming wfobj is your top-level object
         workflow_steps = []
 
-        for lineage in wfobj.parent_of_lineages:
+        for lineage in self.get_lineage_children(
+            wfobj, super_type="workflow_step", include_deleted=True
+        ):
             child_instance = lineage.child_instance
             if child_instance.super_type == "workflow_step":
                 workflow_steps.append(child_instance)
@@ -2318,8 +3993,8 @@ class BloomWorkflow(BloomObj):
         return wfobj
 
     # This can be made more widely useful now that i've detangled the wf-wfs special relationship
-    def get_sorted_euid(self, workflow_euid):
-        wfobj = self.get_by_euid(workflow_euid)
+    def get_sorted_euid(self, workflow_euid, use_cache=None):
+        wfobj = self.get_by_euid(workflow_euid, use_cache=use_cache)
 
         def sort_key(child_instance):
             # Fetch the step_number if it exists, otherwise return a high value to sort it at the end
@@ -2335,7 +4010,9 @@ class BloomWorkflow(BloomObj):
         # Assuming wfobj is your top-level object
         workflow_steps = []
 
-        for lineage in wfobj.parent_of_lineages:
+        for lineage in self.get_lineage_children(
+            wfobj, super_type="workflow_step", include_deleted=True
+        ):
             child_instance = lineage.child_instance
             if child_instance.super_type == "workflow_step":
                 workflow_steps.append(child_instance)
@@ -2679,7 +4356,7 @@ class BloomWorkflowStep(BloomObj):
             self.session.commit()
 
         # self.create_generic_instance_lineage_by_euids(wfs.euid, child_wfs.euid)
-        self.create_generic_instance_lineage_by_euids(new_wf.euid, child_wfs.euid)
+        edges = [(new_wf, child_wfs)]
 
         for cxeuid in cx_ds:
             parent_specimen = cx_ds[cxeuid]
@@ -2694,21 +4371,14 @@ class BloomWorkflowStep(BloomObj):
             # soft delete the edge w the queue
             for aa in parent_cx.child_of_lineages:
                 if aa.parent_instance.euid == wfs.euid:
-                    self.create_generic_instance_lineage_by_euids(
-                        new_wf.euid, aa.child_instance.euid
-                    )
+                    edges.append((new_wf, aa.child_instance))
                     self.delete_obj(aa)
 
-            self.create_generic_instance_lineage_by_euids(
-                parent_specimen.euid, child_gdna_obj.euid
-            )
-            self.create_generic_instance_lineage_by_euids(cxeuid, child_tube_obj.euid)
-            self.create_generic_instance_lineage_by_euids(
-                child_tube_obj.euid, child_gdna_obj.euid
-            )
-            self.create_generic_instance_lineage_by_euids(
-                child_wfs.euid, child_tube_obj.euid
-            )
+            edges.append((parent_specimen, child_gdna_obj))
+            edges.append((parent_cx, child_tube_obj))
+            edges.append((child_tube_obj, child_gdna_obj))
+            edges.append((child_wfs, child_tube_obj))
+        self.create_generic_instance_lineages(edges)
         self.session.commit()
         return child_wfs
 
@@ -3039,6 +4709,183 @@ class BloomHealthEvent(BloomObj):
         return new_event
 
 
+class _ChecksumReader:
+    """Read-only wrapper that counts bytes and hashes them as boto3 pulls them.
+
+    It deliberately has no seek(), so s3transfer treats it as a non-seekable
+    stream and reads it strictly once, in order, one part at a time.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        chunk = self.fileobj.read(size)
+        if chunk:
+            self.size += len(chunk)
+            self.sha256.update(chunk)
+        return chunk
+
+    def readable(self):
+        return True
+
+
+def s3_transfer_config():
+    mb = 1024 * 1024
+    return TransferConfig(
+        multipart_threshold=int(os.environ.get("BLOOM_S3_MULTIPART_THRESHOLD_MB", 64)) * mb,
+        multipart_chunksize=int(os.environ.get("BLOOM_S3_MULTIPART_CHUNKSIZE_MB", 16)) * mb,
+        max_concurrency=int(os.environ.get("BLOOM_S3_MAX_CONCURRENCY", 4)),
+    )
+
+
+_S3_THROTTLE_CODES = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "TooManyRequestsException",
+    "RequestTimeout",
+    "ServiceUnavailable",
+}
+
+
+def _is_s3_throttle(e):
+    code = e.response.get("Error", {}).get("Code")
+    status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return code in _S3_THROTTLE_CODES or status == 503
+
+
+def _with_s3_backoff(fn, *args, **kwargs):
+    """fn(*args, **kwargs), retried with jittered exponential backoff while S3 throttles.
+    BLOOM_S3_RETRY_ATTEMPTS (default 5) tries, starting from BLOOM_S3_RETRY_BASE_SEC (default 0.2).
+    """
+    attempts = int(os.environ.get("BLOOM_S3_RETRY_ATTEMPTS", 5))
+    base_sec = float(os.environ.get("BLOOM_S3_RETRY_BASE_SEC", 0.2))
+    for attempt in range(attempts):
+        try:
+            return fn(*args, **kwargs)
+        except ClientError as e:
+            if not _is_s3_throttle(e) or attempt == attempts - 1:
+                raise
+            time.sleep(min(base_sec * 2**attempt, 20) * random.uniform(0.5, 1.0))
+
+
+class _ArchiveBuffer:
+    """Write-only sink for zipfile/tarfile output which is handed on (drained) as it is produced."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+# Files are spread over buckets named <prefix><first euid number> and, inside a bucket, over folders named
+# <first euid number>/.  Routing a file used to list every bucket and every folder on each upload; the
+# sorted suffixes are now kept here and looked up with bisect.  A table is reloaded after
+# BLOOM_S3_ROUTING_TTL_SEC seconds, and straight away when a lookup falls below the lowest suffix.
+class S3RoutingTable:
+    def __init__(self, bucket_prefix, ttl_sec=None):
+        self.bucket_prefix = bucket_prefix
+        self.ttl_sec = float(
+            ttl_sec
+            if ttl_sec is not None
+            else os.environ.get("BLOOM_S3_ROUTING_TTL_SEC", 300)
+        )
+        # Only guards swapping the listings in, S3 is never called while holding it (a slow listing would
+        # otherwise hold up every upload in the process)
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._buckets = None  # (loaded_at, [suffix, ...])
+            self._folders = {}  # bucket_name -> (loaded_at, [folder, ...])
+
+    def _fresh(self, entry):
+        return entry is not None and time.monotonic() - entry[0] < self.ttl_sec
+
+    def _load_buckets(self, s3_client):
+        suffixes = set()
+        for bucket in s3_client.list_buckets()["Buckets"]:
+            if not bucket["Name"].startswith(self.bucket_prefix):
+                continue
+            digits = re.sub("[^0-9]", "", bucket["Name"].replace(self.bucket_prefix, ""))
+            if digits:
+                suffixes.add(int(digits))
+        buckets = (time.monotonic(), sorted(suffixes))
+        with self._lock:
+            self._buckets = buckets
+        return buckets[1]
+
+    def _load_folders(self, s3_client, bucket_name):
+        folders = set()
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket_name, Prefix="", Delimiter="/"):
+            for content in page.get("CommonPrefixes", []):
+                folder = content["Prefix"].rstrip("/")
+                if folder.isdigit():
+                    folders.add(int(folder))
+
+        if not folders:
+            # If no folders are found, create a '0' folder
+            s3_client.put_object(Bucket=bucket_name, Key="0/")
+            folders = {0}
+        entry = (time.monotonic(), sorted(folders))
+        with self._lock:
+            self._folders[bucket_name] = entry
+        return entry[1]
+
+    def bucket_for(self, s3_client, euid_int):
+        with self._lock:
+            buckets = self._buckets
+        suffixes = buckets[1] if self._fresh(buckets) else self._load_buckets(s3_client)
+        idx = bisect.bisect_right(suffixes, euid_int) - 1
+        if idx < 0:
+            suffixes = self._load_buckets(s3_client)
+            idx = bisect.bisect_right(suffixes, euid_int) - 1
+        if idx < 0:
+            raise Exception("No matching bucket found for the provided EUID.")
+        return f"{self.bucket_prefix}{suffixes[idx]}"
+
+    def folder_for(self, s3_client, bucket_name, euid_int):
+        with self._lock:
+            entry = self._folders.get(bucket_name)
+        folders = entry[1] if self._fresh(entry) else self._load_folders(s3_client, bucket_name)
+        idx = bisect.bisect_right(folders, euid_int) - 1
+        return folders[idx] if idx >= 0 else 0
+
+
+_S3_ROUTING_TABLES = {}
+_S3_ROUTING_LOCK = threading.Lock()
+
+
+def get_s3_routing_table(bucket_prefix):
+    with _S3_ROUTING_LOCK:
+        if bucket_prefix not in _S3_ROUTING_TABLES:
+            _S3_ROUTING_TABLES[bucket_prefix] = S3RoutingTable(bucket_prefix)
+        return _S3_ROUTING_TABLES[bucket_prefix]
+
+
+def reset_s3_routing():
+    """Forget the cached bucket and folder listings, they are reloaded on next use."""
+    with _S3_ROUTING_LOCK:
+        for table in _S3_ROUTING_TABLES.values():
+            table.clear()
+
+
 class BloomFile(BloomObj):
     def __init__(self, bdb, bucket_prefix=None):
         super().__init__(bdb)
@@ -3053,58 +4900,47 @@ class BloomFile(BloomObj):
 
     def _derive_bucket_name(self, euid):
         euid_int = int(re.sub("[^0-9]", "", euid))
-        response = self.s3_client.list_buckets()
-        buckets = response["Buckets"]
-        matching_buckets = [
-            bucket["Name"]
-            for bucket in buckets
-            if bucket["Name"].startswith(self.bucket_prefix)
-        ]
-        bucket_suffixes = sorted(
-            [
-                int(re.sub("[^0-9]", "", name.replace(self.bucket_prefix, "")))
-                for name in matching_buckets
-            ]
+        return get_s3_routing_table(self.bucket_prefix).bucket_for(
+            self.s3_client, euid_int
         )
 
-        for i in range(len(bucket_suffixes) - 1):
-            if bucket_suffixes[i] <= euid_int < bucket_suffixes[i + 1]:
-                return f"{self.bucket_prefix}{bucket_suffixes[i]}"
-
-        if euid_int >= bucket_suffixes[-1]:
-            return f"{self.bucket_prefix}{bucket_suffixes[-1]}"
-
-        raise Exception("No matching bucket found for the provided EUID.")
-
-    def _determine_s3_key(self, euid, data_file_name):
-        bucket_name = self._derive_bucket_name(euid)
+    def _determine_s3_key(self, euid, data_file_name, bucket_name=None):
+        if bucket_name is None:
+            bucket_name = self._derive_bucket_name(euid)
         euid_numeric_part = int(re.sub("[^0-9]", "", euid))
-        response = self.s3_client.list_objects_v2(
-            Bucket=bucket_name, Prefix="", Delimiter="/"
+        folder_prefix = get_s3_routing_table(self.bucket_prefix).folder_for(
+            self.s3_client, bucket_name, euid_numeric_part
         )
 
-        logging.debug(f"ListObjectsV2 Response: {response}")
-        folders = sorted(
-            [
-                int(content["Prefix"].rstrip("/"))
-                for content in response.get("CommonPrefixes", [])
-            ]
-        )
+        logging.debug(f"Determined folder_prefix: {folder_prefix}")
+        return f"{folder_prefix}/{euid}.{data_file_name.split('.')[-1]}"
 
-        if not folders:
-            # If no folders are found, create a '0' folder
-            self.s3_client.put_object(Bucket=bucket_name, Key="0/")
-            folders = [0]
+    def _stream_to_s3(self, fileobj, bucket_name, s3_key, tags):
+        """Stream fileobj to S3 (multipart above the threshold) and return (size, sha256).
 
-        for i in range(len(folders) - 1):
-            if folders[i] <= euid_numeric_part < folders[i + 1]:
-                folder_prefix = folders[i]
-                break
-        else:
-            folder_prefix = folders[-1] if euid_numeric_part >= folders[-1] else 0
+        tags is a dict; a None original_file_size_bytes is filled in once the
+        stream has been consumed.
+        """
+        reader = _ChecksumReader(fileobj)
+        size_known = tags.get("original_file_size_bytes") is not None
+        tagging = {k: self.sanitize_tag(str(v)) for k, v in tags.items() if v is not None}
+        self.s3_client.upload_fileobj(
+            reader,
+            bucket_name,
+            s3_key,
+            ExtraArgs={"Tagging": urlencode(tagging)},
+            Config=s3_transfer_config(),
+        )
 
-        logging.debug(f"Determined folder_prefix: {folder_prefix}")
-        return f"{folder_prefix}/{euid}.{data_file_name.split('.')[-1]}"
+        if not size_known:
+            tagging["original_file_size_bytes"] = str(reader.size)
+            self.s3_client.put_object_tagging(
+                Bucket=bucket_name,
+                Key=s3_key,
+                Tagging={"TagSet": [{"Key": k, "Value": v} for k, v in tagging.items()]},
+            )
+
+        return reader.size, reader.sha256.hexdigest()
 
     def DELME_check_s3_key_exists(self, bucket_name, s3_key):
         try:
@@ -3141,36 +4977,11 @@ class BloomFile(BloomObj):
         self.session.commit()
 
         # Special handling for patient_id
-        if (
-            "patient_id" in file_metadata
-            and len(file_metadata["patient_id"]) > 0
-        ):
-            patient_id = file_metadata["patient_id"]
-            search_criteria = {"properties": {"patient_id": patient_id}}
-            existing_euids = self.search_objs_by_addl_metadata(
-                search_criteria,
-                True,
-                super_type="actor",
-                btype="generic",
-                b_sub_type="patient",
-            )
-
-            if existing_euids:
-                # Create child relationships to existing objects
-                for euid in existing_euids:
-                    self.create_generic_instance_lineage_by_euids(euid, new_file.euid)
-            else:
-                # Create a new actor/generic/patient object
-                new_patient = self.create_instance(
-                    self.query_template_by_component_v2(
-                        "actor", "generic", "patient", "1.0"
-                    )[0].euid,
-                    {"properties": {"patient_id": patient_id}},
-                )
-                self.session.commit()
-                self.create_generic_instance_lineage_by_euids(
-                    new_patient.euid, new_file.euid
-                )
+        patient_euids = self._patient_euids(file_metadata)
+        if patient_euids:
+            self.create_generic_instance_lineages(
+                [(euid, new_file) for euid in patient_euids]
+            )
 
         new_file.json_addl["properties"]["current_s3_bucket_name"] = (
             self._derive_bucket_name(new_file.euid)
@@ -3190,6 +5001,307 @@ class BloomFile(BloomObj):
 
         return new_file
 
+    def _patient_euids(self, file_metadata):
+        """euids of the actor/generic/patient objects a file with file_metadata belongs to.  A patient is
+        created (not committed) if the patient_id is new.
+        """
+        if len(file_metadata.get("patient_id", "")) == 0:
+            return []
+
+        patient_id = file_metadata["patient_id"]
+        search_criteria = {"properties": {"patient_id": patient_id}}
+        existing_euids = self.search_objs_by_addl_metadata(
+            search_criteria,
+            True,
+            super_type="actor",
+            btype="generic",
+            b_sub_type="patient",
+        )
+        if existing_euids:
+            return existing_euids
+
+        # Create a new actor/generic/patient object
+        new_patient = self._build_instance(
+            self.query_template_by_component_v2("actor", "generic", "patient", "1.0")[0],
+            {"properties": {"patient_id": patient_id}},
+        )
+        self.session.add(new_patient)
+        self.session.flush()
+        return [new_patient.euid]
+
+    def create_files(
+        self,
+        sources,
+        file_metadata={},
+        file_set_euid=None,
+        create_locked=True,
+        max_workers=None,
+    ):
+        """Batch create_file.
+
+        All file_instance rows, and their patient and file set lineages, are created in one transaction
+        before any data moves.  The uploads/copies then run on up to max_workers threads
+        (BLOOM_FILE_UPLOAD_WORKERS, default 8).
+
+        Args:
+            sources [{}]: each is the create_file kwargs for one file, ie. {"file_data": f, "file_name": n},
+                {"url": u}, {"full_path_to_file": p} or {"s3_uri": u}
+            file_metadata {}: properties shared by all the files
+
+        Returns:
+            a generator yielding one result dict per source as its upload finishes (completion order).
+            Nothing is uploaded unless it is iterated.
+        """
+        euids = self._create_file_rows(len(sources), file_metadata, file_set_euid)
+        return self._upload_files(euids, sources, create_locked, max_workers)
+
+    def _create_file_rows(self, count, file_metadata, file_set_euid):
+        # count file_instance rows, with their bucket, patient and file set lineages, in one transaction
+        if count == 0:
+            return []  # and no patient actor is looked up (or created) for nothing
+        template = self.query_template_by_component_v2("file", "file", "generic", "1.0")[0]
+        action_groups = (
+            self._create_action_ds(template.json_addl["action_imports"])
+            if "action_imports" in template.json_addl
+            else {}
+        )
+        try:
+            new_files = self._bulk_insert_instances(
+                [
+                    self._build_instance(
+                        template,
+                        {"properties": copy.deepcopy(file_metadata)},
+                        action_groups=action_groups,
+                    )
+                    for i in range(count)
+                ]
+            )
+            for new_file in new_files:
+                new_file.json_addl["properties"]["current_s3_bucket_name"] = (
+                    self._derive_bucket_name(new_file.euid)
+                )
+                flag_modified(new_file, "json_addl")
+
+            edges = [(euid, f) for euid in self._patient_euids(file_metadata) for f in new_files]
+            if file_set_euid:
+                edges.extend((file_set_euid, f) for f in new_files)
+            self.create_generic_instance_lineages(edges)
+            euids = [f.euid for f in new_files]
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+        return euids
+
+    def _upload_files(self, euids, sources, create_locked, max_workers):
+        if max_workers is None:
+            max_workers = int(os.environ.get("BLOOM_FILE_UPLOAD_WORKERS", 8))
+        # one query to reload the rows the commit expired
+        file_instances = self.get_many_by_euid(euids)
+
+        def _upload(euid, s3_bucket_name, source):
+            start = time.monotonic()
+            file_properties = self._upload_file_data(euid, s3_bucket_name, **source)
+            if create_locked:
+                self._lock_s3_object(s3_bucket_name, file_properties["current_s3_key"])
+            return file_properties, time.monotonic() - start
+
+        def _record(future, file_instance, source):
+            # runs on this thread, the session is not shared with the workers
+            original = (
+                source.get("file_name")
+                or source.get("url")
+                or source.get("s3_uri")
+                or source.get("full_path_to_file")
+            )
+            try:
+                file_properties, seconds = future.result()
+            except Exception as e:
+                logging.exception(f"An error occurred while uploading the file: {e}")
+                file_instance.bstatus = "error"
+                file_instance.json_addl["properties"]["comments"] = (
+                    str(e) + f" FILENAM == {original}"
+                )
+                flag_modified(file_instance, "json_addl")
+                return {
+                    "identifier": file_instance.euid,
+                    "status": f"Failed: {str(e)}",
+                    "original": original,
+                }
+
+            _update_recursive(file_instance.json_addl["properties"], file_properties)
+            flag_modified(file_instance, "json_addl")
+            return {
+                "identifier": file_instance.euid,
+                "status": "Success",
+                "original": original,
+                "current_s3_uri": file_properties["current_s3_uri"],
+                "seconds": round(seconds, 3),
+            }
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                pool.submit(
+                    _upload,
+                    file_instance.euid,
+                    file_instance.json_addl["properties"]["current_s3_bucket_name"],
+                    source,
+                ): (file_instance, source)
+                for file_instance, source in zip(file_instances, sources)
+            }
+            recorded = set()
+            try:
+                for future in as_completed(futures):
+                    result = _record(future, *futures[future])
+                    recorded.add(future)
+                    yield result
+            finally:
+                # also reached when the consumer stops early, what the workers did is still recorded
+                for future in futures:
+                    if future not in recorded:
+                        _record(future, *futures[future])
+                self.session.commit()
+
+    def import_s3_uris(
+        self,
+        s3_uris,
+        file_metadata={},
+        file_set_euid=None,
+        create_locked=True,
+        max_workers=None,
+    ):
+        """Bulk create_file(s3_uri=...): the objects are moved into dewey with server side copies.
+
+        The sources are sized up front (one listing per folder holding several of them, otherwise a head
+        each, on the worker pool) and only the ones found get a file_instance.  The copies then run on up
+        to max_workers (BLOOM_S3_IMPORT_WORKERS, default 16) threads.  S3 calls back off while throttled.
+
+        Returns:
+            a generator like create_files(); each result carries head_seconds and seconds (copy, delete and
+            marker), which are also collected in self.last_s3_import_timings.
+        """
+        if max_workers is None:
+            max_workers = int(os.environ.get("BLOOM_S3_IMPORT_WORKERS", 16))
+
+        s3_uris = list(dict.fromkeys(s3_uris))
+        sizes = self._size_s3_uris(s3_uris, max_workers)
+        found = [u for u in s3_uris if sizes[u]["error"] is None]
+        euids = self._create_file_rows(len(found), file_metadata, file_set_euid)
+        self.last_s3_import_timings = []
+
+        def _results():
+            for s3_uri in s3_uris:
+                if sizes[s3_uri]["error"] is not None:
+                    self.last_s3_import_timings.append(
+                        {"s3_uri": s3_uri, "head_seconds": sizes[s3_uri]["seconds"], "status": "missing"}
+                    )
+                    yield {
+                        "identifier": s3_uri,
+                        "status": f"Failed: {sizes[s3_uri]['error']}",
+                        "original": s3_uri,
+                    }
+
+            sources = [{"s3_uri": u, "s3_source_size": sizes[u]["size"]} for u in found]
+            for result in self._upload_files(euids, sources, create_locked, max_workers):
+                result["head_seconds"] = sizes[result["original"]]["seconds"]
+                self.last_s3_import_timings.append(
+                    {
+                        "s3_uri": result["original"],
+                        "euid": result["identifier"],
+                        "head_seconds": result["head_seconds"],
+                        "seconds": result.get("seconds"),
+                        "status": result["status"],
+                    }
+                )
+                yield result
+
+            self.logger.info(
+                f"Imported {len(found)} of {len(s3_uris)} s3 uris with {max_workers} workers"
+            )
+
+        return _results()
+
+    def _size_s3_uris(self, s3_uris, max_workers):
+        """{s3_uri: {"size", "error", "seconds"}} for each source object."""
+        list_min = int(os.environ.get("BLOOM_S3_IMPORT_LIST_MIN", 3))
+        sizes = {}
+        folders = {}
+        for s3_uri in s3_uris:
+            s3_parsed_uri = re.match(r"s3://([^/]+)/(.+)", s3_uri)
+            if not s3_parsed_uri:
+                sizes[s3_uri] = {
+                    "size": None,
+                    "error": "Invalid s3_uri format. Expected format: s3://bucket_name/key",
+                    "seconds": 0.0,
+                }
+                continue
+            bucket, key = s3_parsed_uri.groups()
+            folder = key[: key.rfind("/") + 1]
+            folders.setdefault((bucket, folder), []).append((s3_uri, key))
+
+        def _missing(s3_uri):
+            return f"The s3_uri {s3_uri} does not exist or is not accessible with the provided credentials."
+
+        def _head(bucket, s3_uri, key):
+            start = time.monotonic()
+            try:
+                size = _with_s3_backoff(
+                    self.s3_client.head_object, Bucket=bucket, Key=key
+                )["ContentLength"]
+                error = None
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") in ["404", "NoSuchKey", "NotFound"]:
+                    error = _missing(s3_uri)
+                else:
+                    # ie: 403, or still throttled after the retries, say which
+                    error = f"The s3_uri {s3_uri} could not be checked: {e}"
+                size = None
+            return {s3_uri: {"size": size, "error": error, "seconds": time.monotonic() - start}}
+
+        def _list(bucket, folder, members):
+            # one listing of the folder (not its sub folders) sizes all of them
+            start = time.monotonic()
+            listed = {}
+            kwargs = {"Bucket": bucket, "Prefix": folder, "Delimiter": "/"}
+            while True:
+                try:
+                    page = _with_s3_backoff(self.s3_client.list_objects_v2, **kwargs)
+                except ClientError as e:
+                    if _is_s3_throttle(e):
+                        raise
+                    # ie: no s3:ListBucket, which sizing by head never needed
+                    self.logger.warning(f"Listing s3://{bucket}/{folder} failed ({e}), sizing its objects one by one")
+                    sizes = {}
+                    for member in members:
+                        sizes.update(_head(bucket, *member))
+                    return sizes
+                listed.update({c["Key"]: c["Size"] for c in page.get("Contents", [])})
+                if not page.get("IsTruncated"):
+                    break
+                kwargs["ContinuationToken"] = page["NextContinuationToken"]
+            seconds = (time.monotonic() - start) / len(members)
+            return {
+                s3_uri: {
+                    "size": listed.get(key),
+                    "error": None if key in listed else _missing(s3_uri),
+                    "seconds": seconds,
+                }
+                for s3_uri, key in members
+            }
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = []
+            for (bucket, folder), members in folders.items():
+                if len(members) >= list_min:
+                    futures.append(pool.submit(_list, bucket, folder, members))
+                else:
+                    futures.extend(pool.submit(_head, bucket, *m) for m in members)
+            for future in futures:
+                sizes.update(future.result())
+
+        return sizes
+
     def create_filex(
         self,
         file_metadata={},
@@ -3249,6 +5361,44 @@ class BloomFile(BloomObj):
     ):
         file_instance = self.get_by_euid(euid)
         s3_bucket_name = file_instance.json_addl["properties"]["current_s3_bucket_name"]
+
+        try:
+            file_properties = self._upload_file_data(
+                euid, s3_bucket_name, file_data, file_name, url, full_path_to_file, s3_uri
+            )
+        except Exception as e:
+            logging.exception(f"An error occurred while uploading the file: {e}")
+            file_instance.bstatus = "error"
+            file_instance.json_addl["properties"]["comments"] = (
+                str(e) + f" FILENAM == {file_name}"
+            )
+            flag_modified(file_instance, "json_addl")
+            flag_modified(file_instance, "bstatus")
+            self.session.flush()
+            self.session.commit()
+            raise (e)
+
+        _update_recursive(file_instance.json_addl["properties"], file_properties)
+        flag_modified(file_instance, "json_addl")
+        self.session.commit()
+
+        return file_instance
+
+    def _upload_file_data(
+        self,
+        euid,
+        s3_bucket_name,
+        file_data=None,
+        file_name=None,
+        url=None,
+        full_path_to_file=None,
+        s3_uri=None,
+        s3_source_size=None,
+    ):
+        """Moves the data for file euid into s3_bucket_name and returns the file properties to record.
+        Only S3 is touched (no session), so this may run on a worker thread.  s3_source_size, when the
+        caller already knows it, saves the head of the s3_uri.
+        """
         file_properties = {}
 
         if file_name is None:
@@ -3264,7 +5414,7 @@ class BloomFile(BloomObj):
                 )
 
         file_suffix = file_name.split(".")[-1]
-        s3_key = self._determine_s3_key(euid, file_name)
+        s3_key = self._determine_s3_key(euid, file_name, s3_bucket_name)
 
         # Check if a file with the same EUID already exists in the bucket
         s3_key_path = "/".join(s3_key.split("/")[:-1])
@@ -3280,150 +5430,179 @@ class BloomFile(BloomObj):
                 f"A file with EUID {euid} already exists in bucket {s3_bucket_name} {s3_key_path}."
             )
 
-        try:
-            if file_data:
-                file_data.seek(0)  # Ensure the file pointer is at the beginning
-                file_size = len(file_data.read())
-                file_data.seek(0)  # Reset the file pointer after reading
-                self.s3_client.put_object(
-                    Bucket=s3_bucket_name,
-                    Key=s3_key,
-                    Body=file_data,
-                    Tagging=f"creating_service=dewey&original_file_name={self.sanitize_tag(file_name)}&original_file_path=N/A&original_file_size_bytes={self.sanitize_tag(str(file_size))}&original_file_suffix={self.sanitize_tag(file_suffix)}&euid={euid}",
-                )
-                odirectory, ofilename = os.path.split(file_name)
-
-                file_properties = {
-                    "current_s3_key": s3_key,
-                    "original_file_name": ofilename,
-                    "name": file_name,
-                    "original_file_path": odirectory,
+        if file_data:
+            file_data.seek(0, os.SEEK_END)  # size without reading the data
+            file_size = file_data.tell()
+            file_data.seek(0)
+            file_size, file_sha256 = self._stream_to_s3(
+                file_data,
+                s3_bucket_name,
+                s3_key,
+                {
+                    "creating_service": "dewey",
+                    "original_file_name": file_name,
+                    "original_file_path": "N/A",
                     "original_file_size_bytes": file_size,
                     "original_file_suffix": file_suffix,
-                    "original_file_data_type": "raw data",
-                    "file_type": file_suffix,
-                    "current_s3_uri": f"s3://{s3_bucket_name}/{s3_key}",
-                }
-
-            elif url:
-                response = requests.get(url)
-                file_size = len(response.content)
-                url_info = url.split("/")[-1]
-                file_suffix = url_info.split(".")[-1]
-                self.s3_client.put_object(
-                    Bucket=s3_bucket_name,
-                    Key=s3_key,
-                    Body=response.content,
-                    Tagging=f"creating_service=dewey&original_file_name={self.sanitize_tag(url_info)}&original_url={self.sanitize_tag(url)}&original_file_size_bytes={self.sanitize_tag(str(file_size))}&original_file_suffix={self.sanitize_tag(file_suffix)}&euid={euid}",
+                    "euid": euid,
+                },
+            )
+            odirectory, ofilename = os.path.split(file_name)
+
+            file_properties = {
+                "current_s3_key": s3_key,
+                "original_file_name": ofilename,
+                "name": file_name,
+                "original_file_path": odirectory,
+                "original_file_size_bytes": file_size,
+                "original_file_sha256": file_sha256,
+                "original_file_suffix": file_suffix,
+                "original_file_data_type": "raw data",
+                "file_type": file_suffix,
+                "current_s3_uri": f"s3://{s3_bucket_name}/{s3_key}",
+            }
+
+        elif url:
+            url_info = url.split("/")[-1]
+            file_suffix = url_info.split(".")[-1]
+            with requests.get(url, stream=True) as response:
+                response.raw.decode_content = True
+                content_length = response.headers.get("Content-Length")
+                if response.headers.get("Content-Encoding"):
+                    content_length = None  # the header counts the encoded bytes
+                file_size, file_sha256 = self._stream_to_s3(
+                    response.raw,
+                    s3_bucket_name,
+                    s3_key,
+                    {
+                        "creating_service": "dewey",
+                        "original_file_name": url_info,
+                        "original_url": url,
+                        "original_file_size_bytes": content_length,
+                        "original_file_suffix": file_suffix,
+                        "euid": euid,
+                    },
                 )
-                file_properties = {
-                    "current_s3_key": s3_key,
-                    "original_file_name": url_info,
-                    "name": url_info,
-                    "original_url": url,
-                    "original_file_size_bytes": file_size,
-                    "original_file_suffix": file_suffix,
-                    "original_file_data_type": "url",
-                    "file_type": file_suffix,
-                    "current_s3_uri": f"s3://{s3_bucket_name}/{s3_key}",
-                }
-
-            elif full_path_to_file:
-                with open(full_path_to_file, "rb") as file:
-                    file_data = file.read()
-                file_size = os.path.getsize(full_path_to_file)
-                local_path_info = Path(full_path_to_file)
-                local_ip = None
-                try:
-                    local_ip = socket.gethostbyname(socket.gethostname())
-                except socket.gaierror:
-                    local_ip = "127.0.0.1"  # Fallback to localhost
-
-                self.s3_client.put_object(
-                    Bucket=s3_bucket_name,
-                    Key=s3_key,
-                    Body=file_data,
-                    Tagging=f"creating_service=dewey&original_file_name={self.sanitize_tag(local_path_info.name)}&original_file_path={self.sanitize_tag(full_path_to_file)}&original_file_size_bytes={self.sanitize_tag(str(file_size))}&original_file_suffix={self.sanitize_tag(file_suffix)}&euid={euid}",
+            file_properties = {
+                "current_s3_key": s3_key,
+                "original_file_name": url_info,
+                "name": url_info,
+                "original_url": url,
+                "original_file_size_bytes": file_size,
+                "original_file_sha256": file_sha256,
+                "original_file_suffix": file_suffix,
+                "original_file_data_type": "url",
+                "file_type": file_suffix,
+                "current_s3_uri": f"s3://{s3_bucket_name}/{s3_key}",
+            }
+
+        elif full_path_to_file:
+            local_path_info = Path(full_path_to_file)
+            local_ip = None
+            try:
+                local_ip = socket.gethostbyname(socket.gethostname())
+            except socket.gaierror:
+                local_ip = "127.0.0.1"  # Fallback to localhost
+
+            with open(full_path_to_file, "rb") as file:
+                file_size, file_sha256 = self._stream_to_s3(
+                    file,
+                    s3_bucket_name,
+                    s3_key,
+                    {
+                        "creating_service": "dewey",
+                        "original_file_name": local_path_info.name,
+                        "original_file_path": full_path_to_file,
+                        "original_file_size_bytes": os.path.getsize(full_path_to_file),
+                        "original_file_suffix": file_suffix,
+                        "euid": euid,
+                    },
+                )
+            file_properties = {
+                "current_s3_key": s3_key,
+                "original_file_name": local_path_info.name,
+                "name": local_path_info.name,
+                "original_file_path": full_path_to_file,
+                "original_local_server_name": socket.gethostname(),
+                "original_server_ip": local_ip,
+                "original_file_size_bytes": file_size,
+                "original_file_sha256": file_sha256,
+                "original_file_suffix": file_suffix,
+                "original_file_data_type": "local file",
+                "file_type": file_suffix,
+                "current_s3_uri": f"s3://{s3_bucket_name}/{s3_key}",
+            }
+
+        elif s3_uri:
+            # Validate and move the file from the provided s3_uri
+            s3_parsed_uri = re.match(r"s3://([^/]+)/(.+)", s3_uri)
+            if not s3_parsed_uri:
+                raise ValueError(
+                    "Invalid s3_uri format. Expected format: s3://bucket_name/key"
                 )
-                file_properties = {
-                    "current_s3_key": s3_key,
-                    "original_file_name": local_path_info.name,
-                    "name": local_path_info.name,
-                    "original_file_path": full_path_to_file,
-                    "original_local_server_name": socket.gethostname(),
-                    "original_server_ip": local_ip,
-                    "original_file_size_bytes": file_size,
-                    "original_file_suffix": file_suffix,
-                    "original_file_data_type": "local file",
-                    "file_type": file_suffix,
-                    "current_s3_uri": f"s3://{s3_bucket_name}/{s3_key}",
-                }
-
-            elif s3_uri:
-                # Validate and move the file from the provided s3_uri
-                s3_parsed_uri = re.match(r"s3://([^/]+)/(.+)", s3_uri)
-                if not s3_parsed_uri:
-                    raise ValueError(
-                        "Invalid s3_uri format. Expected format: s3://bucket_name/key"
-                    )
 
-                source_bucket, source_key = s3_parsed_uri.groups()
+            source_bucket, source_key = s3_parsed_uri.groups()
+            file_size = s3_source_size
+            if file_size is None:
                 try:
-                    self.s3_client.head_object(Bucket=source_bucket, Key=source_key)
-                except self.s3_client.exceptions.NoSuchKey:
+                    file_size = _with_s3_backoff(
+                        self.s3_client.head_object, Bucket=source_bucket, Key=source_key
+                    )["ContentLength"]
+                except ClientError:
                     raise ValueError(
                         f"The s3_uri {s3_uri} does not exist or is not accessible with the provided credentials."
                     )
 
-                copy_source = {"Bucket": source_bucket, "Key": source_key}
-                self.s3_client.copy(copy_source, s3_bucket_name, s3_key)
-                file_size = self.s3_client.head_object(
-                    Bucket=s3_bucket_name, Key=s3_key
-                )["ContentLength"]
-
-                file_properties = {
-                    "current_s3_key": s3_key,
-                    "original_file_name": file_name,
-                    "name": file_name,
-                    "original_s3_uri": s3_uri,
-                    "original_file_size_bytes": file_size,
-                    "original_file_suffix": file_suffix,
-                    "original_file_data_type": "s3_uri",
-                    "file_type": file_suffix,
-                    "current_s3_uri": f"s3://{s3_bucket_name}/{s3_key}",
-                }
-
-                # Delete the old file and create a marker file
-                self.s3_client.delete_object(Bucket=source_bucket, Key=source_key)
-                marker_key = f"{source_key}.dewey.moved"
-                self.s3_client.put_object(
-                    Bucket=source_bucket,
-                    Key=marker_key,
-                    Body=b"",
-                    Tagging=f"euid={euid}&original_s3_uri={s3_uri}",
+            # server side copies; the managed copy (UploadPartCopy) only above the multipart threshold, as
+            # it heads the source again
+            copy_source = {"Bucket": source_bucket, "Key": source_key}
+            transfer_config = s3_transfer_config()
+            if file_size < transfer_config.multipart_threshold:
+                _with_s3_backoff(
+                    self.s3_client.copy_object,
+                    CopySource=copy_source,
+                    Bucket=s3_bucket_name,
+                    Key=s3_key,
                 )
-
             else:
-                self.logger.exception("No file data provided.")
-                raise ValueError("No file data provided.")
+                _with_s3_backoff(
+                    self.s3_client.copy,
+                    copy_source,
+                    s3_bucket_name,
+                    s3_key,
+                    Config=transfer_config,
+                )
 
-        except Exception as e:
-            logging.exception(f"An error occurred while uploading the file: {e}")
-            file_instance.bstatus = "error"
-            file_instance.json_addl["properties"]["comments"] = (
-                str(e) + f" FILENAM == {file_name}"
+            file_properties = {
+                "current_s3_key": s3_key,
+                "original_file_name": file_name,
+                "name": file_name,
+                "original_s3_uri": s3_uri,
+                "original_file_size_bytes": file_size,
+                "original_file_suffix": file_suffix,
+                "original_file_data_type": "s3_uri",
+                "file_type": file_suffix,
+                "current_s3_uri": f"s3://{s3_bucket_name}/{s3_key}",
+            }
+
+            # Delete the old file and create a marker file
+            _with_s3_backoff(
+                self.s3_client.delete_object, Bucket=source_bucket, Key=source_key
+            )
+            marker_key = f"{source_key}.dewey.moved"
+            _with_s3_backoff(
+                self.s3_client.put_object,
+                Bucket=source_bucket,
+                Key=marker_key,
+                Body=b"",
+                Tagging=f"euid={euid}&original_s3_uri={s3_uri}",
             )
-            flag_modified(file_instance, "json_addl")
-            flag_modified(file_instance, "bstatus")
-            self.session.flush()
-            self.session.commit()
-            raise (e)
 
-        _update_recursive(file_instance.json_addl["properties"], file_properties)
-        flag_modified(file_instance, "json_addl")
-        self.session.commit()
+        else:
+            self.logger.exception("No file data provided.")
+            raise ValueError("No file data provided.")
 
-        return file_instance
+        return file_properties
 
     def update_file_metadata(self, euid, file_metadata={}):
         file_instance = self.get_by_euid(euid)
@@ -3461,20 +5640,9 @@ class BloomFile(BloomObj):
         file_instance = self.get_by_euid(euid)
         s3_bucket_name = file_instance.json_addl["properties"]["current_s3_bucket_name"]
         s3_key = file_instance.json_addl["properties"]["current_s3_key"]
-        original_file_name = file_instance.json_addl["properties"]["original_file_name"]
-        file_suffix = file_instance.json_addl["properties"]["original_file_suffix"]
-
-        if save_pattern == "dewey":
-            local_file_name = f"{euid}.{file_suffix}"
-        elif save_pattern == "orig":
-            local_file_name = original_file_name
+        local_file_name = self.download_file_name(file_instance, save_pattern)
+        if save_pattern == "orig":
             print("WARNING: Using 'orig' pattern may overwrite existing files!")
-        elif save_pattern == "hybrid":
-            local_file_name = f"{euid}.{original_file_name}"
-        else:
-            raise ValueError(
-                "Invalid save_pattern. Options are: 'dewey', 'orig', 'hybrid'."
-            )
 
         local_file_path = os.path.join(save_path, local_file_name)
 
@@ -3514,6 +5682,45 @@ class BloomFile(BloomObj):
 
         return local_file_path
 
+    def download_file_name(self, file_instance, save_pattern="dewey"):
+        """The name a download of file_instance is saved as, see download_file()."""
+        euid = file_instance.euid
+        original_file_name = file_instance.json_addl["properties"]["original_file_name"]
+        file_suffix = file_instance.json_addl["properties"]["original_file_suffix"]
+
+        if save_pattern == "dewey":
+            return f"{euid}.{file_suffix}"
+        elif save_pattern == "orig":
+            return original_file_name
+        elif save_pattern == "hybrid":
+            return f"{euid}.{original_file_name}"
+        raise ValueError(
+            "Invalid save_pattern. Options are: 'dewey', 'orig', 'hybrid'."
+        )
+
+    def get_presigned_download_url(self, euid, save_pattern="dewey", expires_in=None):
+        """A presigned S3 GET url for the file, which the browser saves as download_file_name().
+        Nothing passes through (or is written on) this server.
+        """
+        if expires_in is None:
+            expires_in = int(os.environ.get("BLOOM_DEWEY_PRESIGN_EXPIRES_SEC", 3600))
+
+        file_instance = self.get_by_euid(euid)
+        file_name = self.download_file_name(file_instance, save_pattern)
+        return self.s3_client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": file_instance.json_addl["properties"]["current_s3_bucket_name"],
+                "Key": file_instance.json_addl["properties"]["current_s3_key"],
+                "ResponseContentDisposition": f'attachment; filename="{file_name}"',
+            },
+            ExpiresIn=expires_in,
+        )
+
+    def get_metadata_yaml(self, euid):
+        """The .dewey.yaml sidecar download_file(include_metadata=True) writes, as a string."""
+        return yaml.dump(self.get_by_euid(euid).json_addl["properties"])
+
     def get_s3_uris(self, euids, include_metadata=False):
         """
         Returns a dictionary of EUIDs to arrays containing their corresponding S3 URIs and optionally their metadata.
@@ -3523,10 +5730,18 @@ class BloomFile(BloomObj):
         :return: Dictionary with EUID as key and array [S3 URI, metadata] as value.
         """
         euid_to_s3_data = {}
+        # one query for all of them
+        by_euid = (
+            {f.euid: f for f in self._query_table_by_euids("file_instance", list(euids))}
+            if euids
+            else {}
+        )
 
         for euid in euids:
             try:
-                file_instance = self.get_by_euid(euid)
+                file_instance = by_euid.get(euid)
+                if file_instance is None:
+                    raise Exception(f"No file found with euid {euid}")
                 s3_bucket_name = file_instance.json_addl["properties"][
                     "current_s3_bucket_name"
                 ]
@@ -3542,6 +5757,108 @@ class BloomFile(BloomObj):
 
         return euid_to_s3_data
 
+    def stream_archive(
+        self,
+        file_instances,
+        archive_format="zip",
+        save_pattern="dewey",
+        include_metadata=True,
+        prefetch=None,
+        chunk_size=1024 * 1024,
+    ):
+        """An iterator over a zip or tar of the files (and their .dewey.yaml sidecars) as it is built.
+
+        The next `prefetch` (BLOOM_DEWEY_ARCHIVE_PREFETCH, default 4) S3 objects are opened ahead on worker
+        threads, and bodies are copied through chunk_size at a time, so memory does not grow with the files.
+        A file which can not be read is replaced by a <name>.dewey.error member.
+
+        Not a generator itself, so a bad archive_format raises here rather than once the response has started.
+        """
+        if archive_format not in ["zip", "tar"]:
+            raise ValueError("Invalid archive_format. Options are: 'zip', 'tar'.")
+        if prefetch is None:
+            prefetch = int(os.environ.get("BLOOM_DEWEY_ARCHIVE_PREFETCH", 4))
+
+        # everything needed from the session is collected here, the workers only talk to S3
+        entries = []
+        names = set()
+        for file_instance in file_instances:
+            props = file_instance.json_addl["properties"]
+            name = self.download_file_name(file_instance, save_pattern)
+            if name in names:
+                name = f"{file_instance.euid}.{name}"
+            names.add(name)
+            entries.append(
+                (
+                    name,
+                    props.get("current_s3_bucket_name"),
+                    props.get("current_s3_key"),
+                    yaml.dump(props).encode() if include_metadata else None,
+                )
+            )
+
+        return self._stream_archive(entries, archive_format, prefetch, chunk_size)
+
+    def _stream_archive(self, entries, archive_format, prefetch, chunk_size):
+        def _open(bucket, key):
+            return self.s3_client.get_object(Bucket=bucket, Key=key)
+
+        out = _ArchiveBuffer()
+        if archive_format == "zip":
+            archive = zipfile.ZipFile(out, mode="w", compression=zipfile.ZIP_STORED)
+
+        def _add(name, size, chunks):
+            if archive_format == "zip":
+                zinfo = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+                zinfo.file_size = size
+                with archive.open(zinfo, "w") as dest:
+                    for chunk in chunks:
+                        dest.write(chunk)
+                        yield out.drain()
+            else:
+                tinfo = tarfile.TarInfo(name)
+                tinfo.size = size
+                tinfo.mtime = int(time.time())
+                out.write(tinfo.tobuf(format=tarfile.PAX_FORMAT))
+                for chunk in chunks:
+                    out.write(chunk)
+                    yield out.drain()
+                out.write(b"\0" * (-size % tarfile.BLOCKSIZE))
+            yield out.drain()
+
+        with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as pool:
+            pending = deque()
+            remaining = iter(entries)
+            for entry in itertools.islice(remaining, prefetch):
+                pending.append((entry, pool.submit(_open, entry[1], entry[2])))
+
+            while pending:
+                (name, bucket, key, sidecar), future = pending.popleft()
+                entry = next(remaining, None)
+                if entry is not None:
+                    pending.append((entry, pool.submit(_open, entry[1], entry[2])))
+
+                try:
+                    s3_object = future.result()
+                except Exception as e:
+                    logging.error(f"Error reading s3://{bucket}/{key} for archive: {e}")
+                    error = str(e).encode()
+                    yield from _add(f"{name}.dewey.error", len(error), [error])
+                else:
+                    yield from _add(
+                        name,
+                        s3_object["ContentLength"],
+                        s3_object["Body"].iter_chunks(chunk_size=chunk_size),
+                    )
+                if sidecar is not None:
+                    yield from _add(f"{name}.dewey.yaml", len(sidecar), [sidecar])
+
+        if archive_format == "zip":
+            archive.close()
+        else:
+            out.write(b"\0" * (2 * tarfile.BLOCKSIZE))
+        yield out.drain()
+
     def delete_file(self, euid):
         # SOFT delete (S3 record is not deleted)
 
@@ -3560,18 +5877,32 @@ class BloomFile(BloomObj):
             return False
 
     def get_s3_object_stream(self, euid):
+        response = self.get_s3_object(euid)
+        return response["Body"], response["ContentType"]
+
+    def get_s3_object(self, euid, byte_range=None):
+        """The S3 get_object response for the file (Body is a stream, not yet read).
+
+        byte_range is an HTTP Range header value, ie. "bytes=0-1023"; the response then also carries
+        ContentRange.
+        """
         file_instance = self.get_file_by_euid(euid)
         s3_bucket_name = file_instance.json_addl["properties"]["current_s3_bucket_name"]
         s3_key = file_instance.json_addl["properties"]["current_s3_key"]
 
+        kwargs = {"Bucket": s3_bucket_name, "Key": s3_key}
+        if byte_range:
+            kwargs["Range"] = byte_range
         try:
-            response = self.s3_client.get_object(Bucket=s3_bucket_name, Key=s3_key)
-            content_type = response["ContentType"]
-            return response["Body"], content_type
+            return self.s3_client.get_object(**kwargs)
         except self.s3_client.exceptions.NoSuchKey:
             raise Exception("File not found")
         except NoCredentialsError:
             raise Exception("Credentials not available")
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "InvalidRange":
+                raise ValueError(f"Range not satisfiable: {byte_range}")
+            raise Exception(e)
         except Exception as e:
             raise Exception(e)
 
@@ -3586,6 +5917,9 @@ class BloomFile(BloomObj):
         s3_bucket_name = file_instance.json_addl["properties"]["current_s3_bucket_name"]
         s3_key = file_instance.json_addl["properties"]["current_s3_key"]
 
+        return self._lock_s3_object(s3_bucket_name, s3_key, lock)
+
+    def _lock_s3_object(self, s3_bucket_name, s3_key, lock=True):
         try:
             if lock:                
                 self.s3_client.put_object_retention(
@@ -3620,14 +5954,23 @@ class BloomFileSet(BloomObj):
 
     def add_files_to_file_set(self, file_set_euid, file_euids=[]):
         file_set = self.get_by_euid(file_set_euid)
-        for file_euid in file_euids:
-            self.create_generic_instance_lineage_by_euids(file_set_euid, file_euid)
+        self.create_generic_instance_lineages(
+            [(file_set, file_euid) for file_euid in file_euids]
+        )
         self.session.commit()
         return file_set
 
     def get_file_set_by_euid(self, euid):
         return self.get_by_euid(euid)
 
+    def get_file_set_files(self, file_set_euid):
+        """The files in the file set, with one query."""
+        file_set = self.get_by_euid(file_set_euid)
+        return [
+            lin.child_instance
+            for lin in self.get_lineage_children(file_set, btype="file", super_type="file")
+        ]
+
     def remove_files_from_file_set(self, file_set_euid, file_euids=[]):
         file_set = self.get_by_euid(file_set_euid)
 
@@ -0,0 +1,49 @@
+"""Archive and drop the old monthly audit_log partitions, and make sure the coming months' partitions exist.
+
+Every partition which ended --keep-months (default BLOOM_AUDIT_LOG_KEEP_MONTHS, 12) months before the start of this
+month is written to --dest, checked, recorded in audit_log_archive and dropped.  Meant to be run from cron.
+--format parquet needs pyarrow, which is not installed with the rest (pip install pyarrow, or bloom_lims[parquet]).
+
+    python bloom_lims/bin/archive_audit_log.py --dest s3://my-bloom-archive/audit_log --format parquet
+    python bloom_lims/bin/archive_audit_log.py --dest /data/audit_log_archive --keep-months 24 --dry-run
+"""
+
+import argparse
+
+from bloom_lims.bdb import BLOOMdb3, BloomObj
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dest", required=True, help="local directory or s3://bucket/prefix")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv", help="gzipped csv, or parquet (pyarrow)")
+    parser.add_argument("--keep-months", type=int, default=None)
+    parser.add_argument("--months-ahead", type=int, default=None, help="partitions to make ahead of this month")
+    parser.add_argument("--keep-partitions", action="store_true", help="write the archives but do not drop anything")
+    parser.add_argument("--dry-run", action="store_true", help="list what would be archived, write nothing")
+    args = parser.parse_args()
+
+    bdb = BLOOMdb3(app_username="bloom_audit_log_archive")
+    bob = BloomObj(bdb)
+    try:
+        for name in bob.ensure_audit_log_partitions(args.months_ahead):
+            print(f"created {name}")
+
+        if args.dry_run:
+            for name, start, end in bob.audit_log_partitions_to_archive(args.keep_months):
+                print(f"would archive {name} ({start:%Y-%m-%d} to {end:%Y-%m-%d})")
+            return
+
+        for archive in bob.archive_audit_log_partitions(
+            args.dest,
+            keep_months=args.keep_months,
+            fmt=args.format,
+            drop=not args.keep_partitions,
+        ):
+            print(f"archived {archive['partition_name']}: {archive['n_rows']} rows to {archive['location']}")
+    finally:
+        bdb.close()
+
+
+if __name__ == "__main__":
+    main()
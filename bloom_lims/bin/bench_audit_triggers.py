@@ -0,0 +1,182 @@
+"""Write throughput of the audit_log triggers, the old row level ones vs the statement level ones.
+
+Creates 96 well plates (the bulk instantiation path), edits json_addl on every well through the ORM, and then with
+a single UPDATE, once per trigger mode.  The row level triggers are installed as bench_legacy_* functions for the
+run and the schema's triggers are put back after, but everything created stays: point this at a scratch database.
+
+    python bloom_lims/bin/bench_audit_triggers.py --plates 10
+"""
+
+import argparse
+import time
+
+from sqlalchemy import inspect, text
+from sqlalchemy.orm.attributes import flag_modified
+
+from bloom_lims.bdb import BLOOMdb3, BloomObj
+
+AUDITED_TABLES = ["generic_template", "generic_instance", "generic_instance_lineage"]
+
+# The row level trigger functions as they were, one dynamic EXECUTE per column per updated row
+LEGACY_FUNCTIONS_SQL = """
+CREATE OR REPLACE FUNCTION bench_legacy_record_update()
+RETURNS TRIGGER AS $$
+DECLARE
+    r RECORD;
+    column_name TEXT;
+    old_value TEXT;
+    new_value TEXT;
+    app_username TEXT;
+BEGIN
+    BEGIN
+        app_username := current_setting('session.current_username', true);
+    EXCEPTION WHEN OTHERS THEN
+        app_username := current_user;
+    END;
+
+    FOR r IN SELECT * FROM json_each_text(row_to_json(NEW)) LOOP
+        column_name := r.key;
+        new_value := r.value;
+        EXECUTE format('SELECT ($1).%I', column_name) USING OLD INTO old_value;
+
+        IF old_value IS DISTINCT FROM new_value THEN
+            INSERT INTO audit_log (rel_table_name, column_name, old_value, new_value, changed_by, rel_table_uuid_fk, rel_table_euid_fk, operation_type)
+            VALUES (TG_TABLE_NAME, column_name, old_value, new_value, app_username, NEW.uuid, NEW.euid, TG_OP);
+        END IF;
+    END LOOP;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION bench_legacy_record_insert()
+RETURNS TRIGGER AS $$
+DECLARE
+    app_username TEXT;
+BEGIN
+    BEGIN
+        app_username := current_setting('session.current_username', true);
+    EXCEPTION WHEN OTHERS THEN
+        app_username := current_user;
+    END;
+
+    INSERT INTO audit_log (rel_table_name, rel_table_uuid_fk, rel_table_euid_fk, changed_by, operation_type)
+    VALUES (TG_TABLE_NAME, NEW.uuid, NEW.euid, app_username, 'INSERT');
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def drop_audit_triggers(session):
+    for table in AUDITED_TABLES:
+        for op in ["update", "insert"]:
+            session.execute(text(f"DROP TRIGGER IF EXISTS {table}_audit_trigger_after_{op} ON {table}"))
+
+
+def install_legacy_triggers(session):
+    session.execute(text(LEGACY_FUNCTIONS_SQL))
+    drop_audit_triggers(session)
+    for table in AUDITED_TABLES:
+        session.execute(
+            text(
+                f"CREATE TRIGGER {table}_audit_trigger_after_update AFTER UPDATE ON {table} "
+                "FOR EACH ROW EXECUTE FUNCTION bench_legacy_record_update()"
+            )
+        )
+        session.execute(
+            text(
+                f"CREATE TRIGGER {table}_audit_trigger_after_insert AFTER INSERT ON {table} "
+                "FOR EACH ROW EXECUTE FUNCTION bench_legacy_record_insert()"
+            )
+        )
+    session.commit()
+
+
+def restore_schema_triggers(session):
+    # the delete triggers were never touched, create_audit_triggers_for_tables() makes update and delete
+    drop_audit_triggers(session)
+    for table in AUDITED_TABLES:
+        session.execute(text(f"DROP TRIGGER IF EXISTS {table}_audit_trigger_after_delete ON {table}"))
+    session.execute(text("SELECT create_audit_triggers_for_tables(:tables)"), {"tables": AUDITED_TABLES})
+    session.execute(text("SELECT create_insert_audit_triggers_for_tables(:tables)"), {"tables": AUDITED_TABLES})
+    session.execute(text("DROP FUNCTION IF EXISTS bench_legacy_record_update()"))
+    session.execute(text("DROP FUNCTION IF EXISTS bench_legacy_record_insert()"))
+    session.commit()
+
+
+def audit_rows(session):
+    return session.execute(text("SELECT COUNT(*) FROM audit_log")).scalar()
+
+
+def run(bob, n_plates, repeat):
+    session = bob.session
+    template = bob.query_template_by_component_v2("container", "plate", "fixed-plate-96", "1.0")[0]
+    ret = {}
+
+    audit_start = audit_rows(session)
+    start = time.monotonic()
+    wells = []
+    for i in range(n_plates):
+        wells.extend(bob.create_instances(template.euid)[1])
+    ret["create"] = (time.monotonic() - start, n_plates * 97, audit_rows(session) - audit_start)
+
+    # the wells were expired by the commit, load them back in one query so only the writes are timed
+    gi = bob.Base.classes.generic_instance
+    uuids = [inspect(w).identity[0] for w in wells]
+    wells = session.query(gi).filter(gi.uuid.in_(uuids)).all()
+
+    audit_start = audit_rows(session)
+    start = time.monotonic()
+    for well in wells:
+        well.json_addl["properties"]["comments"] = "bench orm"
+        flag_modified(well, "json_addl")
+    session.commit()
+    ret["orm update"] = (time.monotonic() - start, len(wells), audit_rows(session) - audit_start)
+
+    # best of a few, a single statement is short enough for noise to matter
+    timings = []
+    for i in range(repeat):
+        audit_start = audit_rows(session)
+        start = time.monotonic()
+        session.execute(
+            text(
+                "UPDATE generic_instance SET json_addl = jsonb_set(json_addl, '{properties,comments}', to_jsonb(CAST(:comment AS TEXT))) "
+                "WHERE uuid = ANY(CAST(:uuids AS UUID[]))"
+            ),
+            {"uuids": [str(u) for u in uuids], "comment": f"bench sql {i}"},
+        )
+        session.commit()
+        timings.append((time.monotonic() - start, len(wells), audit_rows(session) - audit_start))
+    ret["sql update"] = min(timings)
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--plates", type=int, default=5, help="96 well plates to create per mode")
+    parser.add_argument("--mode", choices=["both", "row", "statement"], default="both")
+    parser.add_argument("--repeat", type=int, default=3, help="times to run the single UPDATE, the best is reported")
+    args = parser.parse_args()
+
+    bob = BloomObj(BLOOMdb3(app_username="bench_audit_triggers"))
+    results = {}
+    try:
+        if args.mode in ["both", "row"]:
+            install_legacy_triggers(bob.session)
+            results["row"] = run(bob, args.plates, args.repeat)
+    finally:
+        bob.session.rollback()
+        restore_schema_triggers(bob.session)
+    if args.mode in ["both", "statement"]:
+        results["statement"] = run(bob, args.plates, args.repeat)
+
+    print(f"{'mode':<10} {'step':<11} {'rows':>6} {'seconds':>8} {'rows/s':>9} {'audit rows':>11}")
+    for mode, steps in results.items():
+        for step, (seconds, rows, n_audit) in steps.items():
+            print(f"{mode:<10} {step:<11} {rows:>6} {seconds:>8.3f} {rows / seconds:>9.0f} {n_audit:>11}")
+
+
+if __name__ == "__main__":
+    main()
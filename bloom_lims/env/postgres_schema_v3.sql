@@ -148,7 +148,13 @@ CREATE INDEX idx_generic_instance_super_type ON generic_instance(super_type);
 CREATE INDEX idx_generic_instance_b_sub_type ON generic_instance(b_sub_type);
 CREATE INDEX idx_generic_instance_version ON generic_instance(version);
 CREATE INDEX idx_generic_instance_mod_df ON generic_instance(modified_dt);
-CREATE INDEX idx_generic_instance_json_addl_gin ON generic_instance USING GIN (json_addl);
+-- jsonb_path_ops: only @> is indexed (nothing here uses the ? operators), but the index is smaller and faster for it
+CREATE INDEX idx_generic_instance_json_addl_gin ON generic_instance USING GIN (json_addl jsonb_path_ops);
+-- the Dewey properties searched on most (BloomObj._INDEXED_PROPERTIES)
+CREATE INDEX idx_generic_instance_patient_id ON generic_instance ((json_addl -> 'properties' ->> 'patient_id'));
+CREATE INDEX idx_generic_instance_study_id ON generic_instance ((json_addl -> 'properties' ->> 'study_id'));
+CREATE INDEX idx_generic_instance_upload_group_key ON generic_instance ((json_addl -> 'properties' ->> 'upload_group_key'));
+CREATE INDEX idx_generic_instance_created_dt ON generic_instance (created_dt DESC, uuid DESC);
 CREATE INDEX idx_generic_instance_singleton ON generic_instance(is_singleton);
 
 CREATE OR REPLACE TRIGGER trigger_generic_instance_soft_delete
@@ -240,10 +246,14 @@ FOR EACH ROW EXECUTE FUNCTION soft_delete_row();
 
 /*
 Audit Log Mechanism (could be changed to log changes for each table to a distincy audit log table)
+Range partitioned by changed_at, one partition a month named audit_log_pYYYYMM (bounds are UTC month starts), made
+ahead of time by create_audit_log_partitions().  Queries with a changed_at range only read the months they need,
+and old months are archived and dropped a partition at a time (BloomObj.archive_audit_log_partitions,
+bloom_lims/bin/archive_audit_log.py).  audit_log_default catches anything no monthly partition covers.
 */
 CREATE SEQUENCE audit_log_seq;
 CREATE TABLE audit_log (
-    uuid UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    uuid UUID NOT NULL DEFAULT gen_random_uuid(),
     rel_table_name TEXT NOT NULL,
     column_name TEXT,
     rel_table_uuid_fk UUID NOT NULL,
@@ -257,28 +267,179 @@ CREATE TABLE audit_log (
     super_type TEXT,
     deleted_record_json JSONB,
     is_deleted BOOLEAN NOT NULL DEFAULT FALSE,
-    is_singleton BOOLEAN NOT NULL DEFAULT FALSE
-);
+    is_singleton BOOLEAN NOT NULL DEFAULT FALSE,
+    seq BIGINT NOT NULL DEFAULT nextval('audit_log_seq'), -- write order, changed_at is the same for everything in a transaction
+    PRIMARY KEY (uuid, changed_at)
+) PARTITION BY RANGE (changed_at);
+CREATE TABLE audit_log_default PARTITION OF audit_log DEFAULT;
 CREATE INDEX idx_audit_log_rel_table_name ON audit_log(rel_table_name);
 CREATE INDEX idx_audit_log_rel_table_uuid_fk ON audit_log(rel_table_uuid_fk);
 CREATE INDEX idx_audit_log_rel_table_euid_fk ON audit_log(rel_table_euid_fk);
 CREATE INDEX idx_audit_log_is_deleted ON audit_log(is_deleted);
 CREATE INDEX idx_audit_log_operation_type ON audit_log(operation_type);
 CREATE INDEX idx_audit_log_changed_at ON audit_log(changed_at);
-CREATE INDEX idx_audit_log_changed_by ON audit_log(changed_by);
+CREATE INDEX idx_audit_log_changed_by ON audit_log(changed_by, changed_at, uuid);
 CREATE INDEX idx_audit_log_json_addl_gin ON audit_log USING GIN (json_addl);
+CREATE INDEX idx_audit_log_rel_table_uuid_fk_seq ON audit_log(rel_table_uuid_fk, seq);
+
+
+-- Monthly partitions from from_month (default this month) through months_ahead months from now, returns the ones
+-- it made.  Rows already sitting in audit_log_default for a new month are moved into it.
+CREATE OR REPLACE FUNCTION create_audit_log_partitions(months_ahead INT DEFAULT 3, from_month DATE DEFAULT NULL)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    m DATE := date_trunc('month', COALESCE(from_month, CURRENT_DATE))::DATE;
+    last_month DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => months_ahead))::DATE;
+    range_start TIMESTAMP WITH TIME ZONE;
+    range_end TIMESTAMP WITH TIME ZONE;
+    part TEXT;
+BEGIN
+    WHILE m <= last_month LOOP
+        part := 'audit_log_p' || to_char(m, 'YYYYMM');
+        range_start := m::TIMESTAMP AT TIME ZONE 'UTC';
+        range_end := (m + INTERVAL '1 month')::TIMESTAMP AT TIME ZONE 'UTC';
+        IF to_regclass(part) IS NULL THEN
+            CREATE TEMP TABLE audit_log_moving (LIKE audit_log) ON COMMIT DROP;
+            WITH moved AS (
+                DELETE FROM audit_log_default WHERE changed_at >= range_start AND changed_at < range_end RETURNING *
+            )
+            INSERT INTO audit_log_moving SELECT * FROM moved;
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF audit_log FOR VALUES FROM (%L) TO (%L)', part, range_start, range_end
+            );
+            INSERT INTO audit_log SELECT * FROM audit_log_moving;
+            DROP TABLE audit_log_moving;
+            RETURN NEXT part;
+        END IF;
+        m := (m + INTERVAL '1 month')::DATE;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT create_audit_log_partitions(3);
+
+
+-- One row per audit_log partition archived (and dropped) by BloomObj.archive_audit_log_partitions
+CREATE TABLE audit_log_archive (
+    partition_name TEXT PRIMARY KEY,
+    range_start TIMESTAMP WITH TIME ZONE NOT NULL,
+    range_end TIMESTAMP WITH TIME ZONE NOT NULL,
+    n_rows BIGINT NOT NULL,
+    location TEXT NOT NULL,
+    archived_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+
+/*
+json_addl patches
+Changes to a json_addl column are not stored as the full old and new documents (old_value / new_value are left NULL),
+audit_log.json_addl holds a patch instead: an array of {"path": [...], "old": x, "new": y}, one per changed leaf.
+"old" is left out for an added key / array element and "new" for a removed one.  Objects and arrays are walked
+into when both sides are the same kind, so appending to an action's executed_datetime array is one small entry.
+*/
+CREATE OR REPLACE FUNCTION jsonb_diff_paths(old_doc JSONB, new_doc JSONB, base_path TEXT[] DEFAULT '{}')
+RETURNS JSONB AS $$
+DECLARE
+    patch JSONB := '[]';
+    k TEXT;
+    i INT;
+BEGIN
+    IF old_doc IS NOT DISTINCT FROM new_doc THEN
+        RETURN patch;
+    END IF;
+
+    IF jsonb_typeof(old_doc) = 'object' AND jsonb_typeof(new_doc) = 'object' THEN
+        FOR k IN SELECT jsonb_object_keys(old_doc) UNION SELECT jsonb_object_keys(new_doc) ORDER BY 1 LOOP
+            patch := patch || jsonb_diff_paths(old_doc -> k, new_doc -> k, base_path || k);
+        END LOOP;
+        RETURN patch;
+    END IF;
+
+    IF jsonb_typeof(old_doc) = 'array' AND jsonb_typeof(new_doc) = 'array' THEN
+        FOR i IN 0 .. greatest(jsonb_array_length(old_doc), jsonb_array_length(new_doc)) - 1 LOOP
+            patch := patch || jsonb_diff_paths(old_doc -> i, new_doc -> i, base_path || i::TEXT);
+        END LOOP;
+        RETURN patch;
+    END IF;
+
+    -- a SQL NULL here is a missing key, a JSON null is kept
+    RETURN jsonb_build_array(
+        jsonb_build_object('path', to_jsonb(base_path))
+        || CASE WHEN old_doc IS NULL THEN '{}' ELSE jsonb_build_object('old', old_doc) END
+        || CASE WHEN new_doc IS NULL THEN '{}' ELSE jsonb_build_object('new', new_doc) END
+    );
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+-- Apply a patch from jsonb_diff_paths() to doc, or undo it (old <- new) with reverse.
+CREATE OR REPLACE FUNCTION jsonb_apply_patch(doc JSONB, patch JSONB, reverse BOOLEAN DEFAULT FALSE)
+RETURNS JSONB AS $$
+DECLARE
+    to_key TEXT := CASE WHEN reverse THEN 'old' ELSE 'new' END;
+    e JSONB;
+    path TEXT[];
+BEGIN
+    -- removals first and last one first, so the array indexes of the rest stay put, then the sets in order (so
+    -- appended array elements go on in order)
+    FOR e IN
+        SELECT p.value
+        FROM jsonb_array_elements(patch) WITH ORDINALITY AS p(value, n)
+        ORDER BY p.value ? to_key, CASE WHEN p.value ? to_key THEN p.n ELSE -p.n END
+    LOOP
+        path := ARRAY(SELECT jsonb_array_elements_text(e -> 'path'));
+        IF cardinality(path) = 0 THEN
+            doc := e -> to_key;
+        ELSIF e ? to_key THEN
+            doc := jsonb_set(doc, path, e -> to_key);
+        ELSE
+            doc := doc #- path;
+        END IF;
+    END LOOP;
+    RETURN doc;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+
+-- json_addl of a row as it was at as_of: the current one with every later patch undone, newest first.  Rows
+-- written before the patches were stored have the full old document in old_value, which is used as is.
+CREATE OR REPLACE FUNCTION json_addl_as_of(table_name TEXT, row_uuid UUID, as_of TIMESTAMP WITH TIME ZONE)
+RETURNS JSONB AS $$
+DECLARE
+    doc JSONB;
+    r RECORD;
+BEGIN
+    EXECUTE format('SELECT json_addl FROM %I WHERE uuid = $1', table_name) INTO doc USING row_uuid;
+
+    FOR r IN
+        SELECT al.json_addl AS patch, al.old_value
+        FROM audit_log al
+        WHERE al.rel_table_uuid_fk = row_uuid
+          AND al.column_name = 'json_addl'
+          AND al.operation_type = 'UPDATE'
+          AND al.changed_at > as_of
+        ORDER BY al.seq DESC
+    LOOP
+        IF r.patch IS NOT NULL THEN
+            doc := jsonb_apply_patch(doc, r.patch, TRUE);
+        ELSE
+            doc := r.old_value::JSONB;
+        END IF;
+    END LOOP;
+    RETURN doc;
+END;
+$$ LANGUAGE plpgsql STABLE;
 
 
 /*
 Audit Trigger Mechanisms
+These are statement level triggers: each INSERT / UPDATE / DELETE statement writes all of its audit_log rows with
+one INSERT ... SELECT over the statement's transition tables (old_rows / new_rows).  The old row level update
+trigger ran a dynamic EXECUTE per column per row, and an insert per changed column.
 */
 CREATE OR REPLACE FUNCTION record_update()
 RETURNS TRIGGER AS $$
 DECLARE
-    r RECORD;
-    column_name TEXT;
-    old_value TEXT;
-    new_value TEXT;
     app_username TEXT;
 BEGIN
     BEGIN
@@ -287,18 +448,30 @@ BEGIN
         app_username := current_user;
     END;
 
-    FOR r IN SELECT * FROM json_each_text(row_to_json(NEW)) LOOP
-        column_name := r.key;
-        new_value := r.value;
-        EXECUTE format('SELECT ($1).%I', column_name) USING OLD INTO old_value;
+    -- One audit row per changed column of each updated row, the values compared (and stored) as jsonb text, but
+    -- json_addl as a patch (see jsonb_diff_paths).  MATERIALIZED so each row is converted to jsonb once, not once
+    -- per column.  Run with EXECUTE so the join is planned for this statement's transition tables, a plan cached
+    -- from a one row (ie: ORM) update is very slow for a bulk one.
+    EXECUTE $sql$
+        INSERT INTO audit_log (rel_table_name, column_name, old_value, new_value, json_addl, changed_by, rel_table_uuid_fk, rel_table_euid_fk, operation_type)
+        WITH changed AS MATERIALIZED (
+            SELECT n.uuid, n.euid, to_jsonb(o) AS old_doc, to_jsonb(n) AS new_doc
+            FROM new_rows n
+            JOIN old_rows o ON o.uuid = n.uuid
+        )
+        SELECT
+            $1,
+            col.key,
+            CASE WHEN col.key <> 'json_addl' THEN c.old_doc -> col.key #>> '{}' END,
+            CASE WHEN col.key <> 'json_addl' THEN col.value #>> '{}' END,
+            CASE WHEN col.key = 'json_addl' THEN jsonb_diff_paths(c.old_doc -> col.key, col.value) END,
+            $2, c.uuid, c.euid, $3
+        FROM changed c
+        CROSS JOIN LATERAL jsonb_each(c.new_doc) AS col
+        WHERE c.old_doc -> col.key IS DISTINCT FROM col.value
+    $sql$ USING TG_TABLE_NAME, app_username, TG_OP;
 
-        IF old_value IS DISTINCT FROM new_value THEN
-            INSERT INTO audit_log (rel_table_name, column_name, old_value, new_value, changed_by, rel_table_uuid_fk, rel_table_euid_fk, operation_type)
-            VALUES (TG_TABLE_NAME, column_name, old_value, new_value, app_username, NEW.uuid, NEW.euid, TG_OP);
-        END IF;
-    END LOOP;
-    
-    RETURN NEW;
+    RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -315,7 +488,7 @@ BEGIN
     END;
     
     INSERT INTO audit_log (rel_table_name, rel_table_uuid_fk, rel_table_euid_fk, changed_by, operation_type)
-    VALUES (TG_TABLE_NAME, OLD.uuid, OLD.euid, app_username, 'DELETE');
+    SELECT TG_TABLE_NAME, uuid, euid, app_username, 'DELETE' FROM old_rows;
     RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
@@ -330,13 +503,13 @@ BEGIN
     FOREACH table_name IN ARRAY tables LOOP
         -- Construct the CREATE TRIGGER statement for UPDATE
         EXECUTE format(
-            'CREATE TRIGGER %I_audit_trigger_after_update AFTER UPDATE ON %I FOR EACH ROW EXECUTE FUNCTION record_update();',
+            'CREATE TRIGGER %I_audit_trigger_after_update AFTER UPDATE ON %I REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION record_update();',
             table_name, table_name
         );
 
         -- Construct the CREATE TRIGGER statement for DELETE
         EXECUTE format(
-            'CREATE TRIGGER %I_audit_trigger_after_delete AFTER DELETE ON %I FOR EACH ROW EXECUTE FUNCTION record_delete();',
+            'CREATE TRIGGER %I_audit_trigger_after_delete AFTER DELETE ON %I REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION record_delete();',
             table_name, table_name
         );
     END LOOP;
@@ -360,11 +533,11 @@ BEGIN
         app_username := current_user;
     END;
 
-    -- Insert record into audit_log
+    -- Insert records into audit_log
     INSERT INTO audit_log (rel_table_name, rel_table_uuid_fk, rel_table_euid_fk, changed_by, operation_type)
-    VALUES (TG_TABLE_NAME, NEW.uuid, NEW.euid, app_username, 'INSERT');
+    SELECT TG_TABLE_NAME, uuid, euid, app_username, 'INSERT' FROM new_rows;
 
-    RETURN NEW;
+    RETURN NULL;
 END;
 $$ LANGUAGE plpgsql;
 
@@ -377,7 +550,7 @@ BEGIN
     FOREACH table_name IN ARRAY tables LOOP
         -- Construct the CREATE TRIGGER statement for INSERT
         EXECUTE format(
-            'CREATE TRIGGER %I_audit_trigger_after_insert AFTER INSERT ON %I FOR EACH ROW EXECUTE FUNCTION record_insert();',
+            'CREATE TRIGGER %I_audit_trigger_after_insert AFTER INSERT ON %I REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION record_insert();',
             table_name, table_name
         );
     END LOOP;
@@ -388,6 +561,17 @@ $$ LANGUAGE plpgsql;
 SELECT create_insert_audit_triggers_for_tables(ARRAY['generic_template', 'generic_instance', 'generic_instance_lineage']);
 
 
+/*
+Assay dashboard metrics, precomputed for the /assays page (see BloomObj.refresh_assay_metrics)
+*/
+CREATE TABLE assay_dashboard_metrics (
+    assay_euid TEXT PRIMARY KEY,
+    assay_uuid UUID NOT NULL,
+    metrics JSONB NOT NULL,
+    refreshed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+
 /*
 Add modification date tracking
 */
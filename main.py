@@ -3,11 +3,17 @@ import jwt
 import httpx
 import os
 import json
+import re
 import subprocess
 import shutil
+import tempfile
 from typing import List
 from pathlib import Path
+from urllib.parse import urlencode
 import random
+import itertools
+import anyio
+import asyncio
  
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -81,8 +87,9 @@ from fastapi import (
 )
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import APIKeyCookie
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
 
 from starlette.responses import JSONResponse
 from starlette.middleware.sessions import SessionMiddleware
@@ -101,6 +108,10 @@ from bloom_lims.bdb import (
     BloomWorkflowStep,
     BloomFile,
     BloomFileSet,
+    close_bloomdb_sessions,
+    get_dag_cache,
+    get_sql_stats,
+    reset_sql_stats,
 )
 
 from bloom_lims.bvars import BloomVars
@@ -139,6 +150,93 @@ app.add_middleware(
 
 app.add_middleware(SessionMiddleware, secret_key="your-secret-key")
 
+
+class CloseBloomdbSessionsMiddleware:
+    # Routes open BLOOMdb3()s as they need them and mostly never close them.  Each one holds a connection from the
+    # shared pool until it is closed, so they are all closed once the request is done (streamed bodies and
+    # background tasks included, both run inside this call).
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with close_bloomdb_sessions():
+            await self.app(scope, receive, send)
+
+
+app.add_middleware(CloseBloomdbSessionsMiddleware)
+
+
+# Routes doing ORM / boto3 work are plain `def`, so FastAPI runs them in anyio's worker threads and one slow
+# upload no longer stalls the event loop for everyone.  async routes which must await the request body first do
+# the rest in an _in_thread() closure handed to run_in_threadpool.
+# Every worker thread may hold db connections from the shared pool (BLOOM_DB_POOL_SIZE + BLOOM_DB_MAX_OVERFLOW),
+# and some routes (ie: /create_file, /workflow_step_action) hold two BLOOMdb3 sessions at once, so by default there
+# are half as many worker threads as pooled connections.  Keep BLOOM_THREADPOOL_SIZE at or under that if set.
+@app.on_event("startup")
+async def size_threadpool():
+    pool_max = int(os.environ.get("BLOOM_DB_POOL_SIZE", 10)) + int(os.environ.get("BLOOM_DB_MAX_OVERFLOW", 20))
+    anyio.to_thread.current_default_thread_limiter().total_tokens = int(
+        os.environ.get("BLOOM_THREADPOOL_SIZE", max(pool_max // 2, 1))
+    )
+
+
+def _refresh_assay_metrics():
+    bdb = BLOOMdb3(app_username="bloom_assay_metrics")
+    try:
+        BloomObj(bdb).refresh_assay_metrics()
+    finally:
+        bdb.close()
+
+
+@app.on_event("startup")
+async def schedule_assay_metrics_refresh():
+    # keeps assay_dashboard_metrics (read by /assays) fresh, every BLOOM_ASSAY_METRICS_REFRESH_SEC seconds
+    refresh_sec = float(os.environ.get("BLOOM_ASSAY_METRICS_REFRESH_SEC", 300))
+    if refresh_sec <= 0:
+        return
+
+    async def _loop():
+        while True:
+            try:
+                await run_in_threadpool(_refresh_assay_metrics)
+            except Exception as e:
+                logging.error(f"Error refreshing assay metrics: {e}")
+            await asyncio.sleep(refresh_sec)
+
+    app.state.assay_metrics_task = asyncio.get_running_loop().create_task(_loop())
+
+
+def _ensure_audit_log_partitions():
+    bdb = BLOOMdb3(app_username="bloom_audit_log_partitions")
+    try:
+        created = BloomObj(bdb).ensure_audit_log_partitions()
+        if created:
+            logging.info(f"Created audit_log partitions: {created}")
+    finally:
+        bdb.close()
+
+
+@app.on_event("startup")
+async def schedule_audit_log_partitions():
+    # audit_log is partitioned by month, make sure the next months' partitions exist, every
+    # BLOOM_AUDIT_LOG_PARTITION_CHECK_SEC seconds.  Archiving old months is bloom_lims/bin/archive_audit_log.py
+    check_sec = float(os.environ.get("BLOOM_AUDIT_LOG_PARTITION_CHECK_SEC", 86400))
+    if check_sec <= 0:
+        return
+
+    async def _loop():
+        while True:
+            try:
+                await run_in_threadpool(_ensure_audit_log_partitions)
+            except Exception as e:
+                logging.error(f"Error creating audit_log partitions: {e}")
+            await asyncio.sleep(check_sec)
+
+    app.state.audit_log_partitions_task = asyncio.get_running_loop().create_task(_loop())
+
 # Serve static files
 cookie_scheme = APIKeyCookie(name="session")
 SKIP_AUTH = False if len(sys.argv) < 3 else True
@@ -213,7 +311,20 @@ def highlight_json_changes(old_json_str, new_json_str):
     return '\n'.join(old_json_highlighted), '\n'.join(new_json_highlighted)
 
 
-async def get_relationship_data(obj):
+def format_json_patch(patch):
+    # audit_log.json_addl patch (see jsonb_diff_paths) -> the old and new side as one "path: value" line per change
+    old_lines = []
+    new_lines = []
+    for change in patch or []:
+        path = "/".join(change["path"])
+        if "old" in change:
+            old_lines.append(f'<span class="deleted">{path}: {json.dumps(change["old"])}</span>')
+        if "new" in change:
+            new_lines.append(f'<span class="added">{path}: {json.dumps(change["new"])}</span>')
+    return '\n'.join(old_lines), '\n'.join(new_lines)
+
+
+def get_relationship_data(obj):
     relationship_data = {}
     for relationship in obj.__mapper__.relationships:
         if relationship.uselist:  # If it's a list of items
@@ -511,7 +622,7 @@ async def lims(request: Request, _=Depends(require_auth)):
 
 
 @app.get("/assays", response_class=HTMLResponse)
-async def assays(request: Request, show_type: str = "all", _auth=Depends(require_auth)):
+def assays(request: Request, show_type: str = "all", _auth=Depends(require_auth)):
     # Check if user is logged in
     if (
         "user_data" not in request.session
@@ -526,18 +637,11 @@ async def assays(request: Request, show_type: str = "all", _auth=Depends(require
     # Initialize your database object with the user's email
     bobdb = BloomObj(BLOOMdb3(app_username=user_email))
     ay_ds = {}
-    print("\n\n\nAAAAAAAA\n\n\n")
-    for i in (
-        bobdb.session.query(bobdb.Base.classes.workflow_instance)
-        .filter_by(is_deleted=False, is_singleton=True)
-        .all()
-    ):
+    for i in bobdb._query_assays():
         if show_type == "all" or i.json_addl.get("assay_type", "all") == show_type:
             ay_ds[i.euid] = i
 
-    print("\n\n\n\n\nBBBBBB\n\n\n\n")
     assays = []
-    ay_dss = {}
     atype = {}
 
     if show_type == "assay":
@@ -549,73 +653,10 @@ async def assays(request: Request, show_type: str = "all", _auth=Depends(require
 
     for i in sorted(ay_ds.keys()):
         assays.append(ay_ds[i])
-        ay_dss[i] = {
-            "Instantaneous COGS": 0
-        }  # round(bobdb.get_cost_of_euid_children(i),2)}
-        ay_dss[i]["tot"] = 0
-        ay_dss[i]["tit_s"] = 0
-        ay_dss[i]["tot_fx"] = 0
-
-        for q in ay_ds[i].parent_of_lineages:
-            if show_type == "accessioning":
-                for fex_tup in bobdb.query_all_fedex_transit_times_by_ay_euid(
-                    q.child_instance.euid
-                ):
-                    try:
-                        ay_dss[i]["tit_s"] += float(fex_tup[1])
-                        ay_dss[i]["tot_fx"] += 1
-                    except Exception as e:
-                        print(e)
-            wset = ""
-            n = q.child_instance.json_addl["properties"]["name"]
-            if n.startswith("In"):
-                wset = "inprog"
-            elif n.startswith("Comple"):
-                wset = "complete"
-            elif n.startswith("Exception"):
-                wset = "exception"
-            elif n.startswith("Ready"):
-                wset = "avail"
-            lins = q.child_instance.parent_of_lineages.all()
-            ay_dss[i][wset] = len(lins)
-            lctr = 0
-            lctr_max = 150
-            for llin in lins:
-                if lctr > lctr_max:
-                    break
-                else:
-                    ay_dss[i]["Instantaneous COGS"] += round(
-                        bobdb.get_cost_of_euid_children(llin.child_instance.euid), 2
-                    )
-                    ay_dss[i]["tot"] += 1
-                lctr += 1
 
-        try:
-            ay_dss[i]["avg_d_fx"] = round(
-                float(ay_dss[i]["tit_s"])
-                / 60.0
-                / 60.0
-                / 24.0
-                / float(ay_dss[i]["tot_fx"]),
-                2,
-            )
-        except Exception as e:
-            ay_dss[i]["avg_d_fx"] = "na"
+    # queue counts, conversion, transit days and COGS come precomputed from assay_dashboard_metrics
+    ay_dss = bobdb.get_assay_metrics(sorted(ay_ds.keys()))
 
-        ay_dss[i]["conv"] = (
-            round(
-                float(ay_dss[i]["complete"])
-                / float(ay_dss[i]["complete"] + ay_dss[i]["exception"]),
-                2,
-            )
-            if ay_dss[i]["complete"] + ay_dss[i]["exception"] > 0
-            else "na"
-        )
-        ay_dss[i]["wsetp"] = (
-            round(float(ay_dss[i]["Instantaneous COGS"]) / float(ay_dss[i]["tot"]), 2)
-            if ay_dss[i]["tot"] > 0
-            else "na"
-        )
     style = {"skin_css": user_data.get("style_css", "static/skins/bloom.css")}
 
     # Rendering the template with the dynamic content
@@ -633,7 +674,7 @@ async def assays(request: Request, show_type: str = "all", _auth=Depends(require
 
 
 @app.get("/calculate_cogs_children")
-async def Acalculate_cogs_children(euid, request: Request, _auth=Depends(require_auth)):
+def Acalculate_cogs_children(euid, request: Request, _auth=Depends(require_auth)):
     try:
         bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
         cogs_value = round(bobdb.get_cost_of_euid_children(euid), 2)
@@ -641,30 +682,41 @@ async def Acalculate_cogs_children(euid, request: Request, _auth=Depends(require
     except Exception as e:
         return json.dumps({"success": False, "message": str(e)})
 
+def _search_table_data(rows):
+    # search_addl_metadata() rows -> the columns and rows of the search results tables, the property columns are
+    # the first row's
+    columns = ["EUID", "Date Created", "Status"]
+    if rows and rows[0]["properties"]:
+        columns += list(rows[0]["properties"].keys())
+
+    table_data = []
+    for result in rows:
+        row = {
+            "EUID": result["euid"],
+            "Date Created": result["created_dt"].strftime("%Y-%m-%d %H:%M:%S"),
+            "Status": result["bstatus"],
+        }
+        for key in columns[3:]:
+            row[key] = result["properties"].get(key, "N/A")
+        table_data.append(row)
+    return columns, table_data
+
+
+def _search_page_size(page_size):
+    return page_size or int(os.environ.get("BLOOM_DEWEY_SEARCH_PAGE_SIZE", 500))
+
+
 @app.post("/query_by_euids", response_class=HTMLResponse)
-async def query_by_euids(request: Request, file_euids: str = Form(...)):
+def query_by_euids(request: Request, file_euids: str = Form(...)):
     try:
         bfi = BloomFile(BLOOMdb3(app_username=request.session["user_data"]["email"]))
         euid_list = [euid.strip() for euid in file_euids.split("\n") if euid.strip()]
 
-        detailed_results = [bfi.get_by_euid(euid) for euid in euid_list if euid]
-
-        # Create a list of columns for the table
-        columns = ["EUID", "Date Created", "Status"]
-        if detailed_results and detailed_results[0].json_addl.get("properties"):
-            columns += list(detailed_results[0].json_addl["properties"].keys())
-
-        # Prepare the data for the template
-        table_data = []
-        for result in detailed_results:
-            row = {
-                "EUID": result.euid,
-                "Date Created": result.created_dt.strftime("%Y-%m-%d %H:%M:%S"),
-                "Status": result.bstatus,
-            }
-            for key in columns[3:]:
-                row[key] = result.json_addl["properties"].get(key, "N/A")
-            table_data.append(row)
+        # one query for all of them, shown in the order asked for
+        found = bfi.search_addl_metadata(euids=euid_list)
+        order = {euid: i for i, euid in enumerate(euid_list)}
+        found["rows"].sort(key=lambda r: order[r["euid"]])
+        columns, table_data = _search_table_data(found["rows"])
 
         user_data = request.session.get("user_data", {})
         style = {"skin_css": user_data.get("style_css", "static/skins/bloom.css")}
@@ -675,6 +727,8 @@ async def query_by_euids(request: Request, file_euids: str = Form(...)):
             table_data=table_data,
             style=style,
             udat=user_data,
+            total=found["total"],
+            offset=0,
         )
         return HTMLResponse(content=content)
 
@@ -691,7 +745,7 @@ async def query_by_euids(request: Request, file_euids: str = Form(...)):
         return HTMLResponse(content=content)
 
 
-async def calculate_cogs_parents(euid, request: Request, _auth=Depends(require_auth)):
+def calculate_cogs_parents(euid, request: Request, _auth=Depends(require_auth)):
     try:
         bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]))
         cogs_value = round(bobdb.get_cogs_to_produce_euid(euid), 2)
@@ -709,7 +763,7 @@ async def set_filter(request: Request, _auth=Depends(require_auth), curr_val="of
 
 
 @app.get("/admin", response_class=HTMLResponse)
-async def admin(request: Request, _auth=Depends(require_auth), dest="na"):
+def admin(request: Request, _auth=Depends(require_auth), dest="na"):
 
     os.makedirs(os.path.dirname(UDAT_FILE), exist_ok=True)
     if not os.path.exists(UDAT_FILE):
@@ -757,6 +811,15 @@ async def admin(request: Request, _auth=Depends(require_auth), dest="na"):
     return HTMLResponse(content=content)
 
 
+# Per statement call counts and timings for the registered raw SQL, for profiling.
+@app.get("/sql_stats")
+def sql_stats(request: Request, _auth=Depends(require_auth), reset: bool = False):
+    stats = get_sql_stats()
+    if reset:
+        reset_sql_stats()
+    return JSONResponse(content=stats)
+
+
 # Take a look at this later
 @app.post("/update_preference")
 async def update_preference(request: Request, auth: dict = Depends(require_auth)):
@@ -790,7 +853,7 @@ async def update_preference(request: Request, auth: dict = Depends(require_auth)
 
 
 @app.get("/queue_details", response_class=HTMLResponse)
-async def queue_details(
+def queue_details(
     request: Request, queue_euid, page=1, _auth=Depends(require_auth)
 ):
     page = int(page)
@@ -799,7 +862,7 @@ async def queue_details(
     per_page = 500  # Items per page
     user_logged_in = True if "user_data" in request.session else False
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-    queue = bobdb.get_by_euid(queue_euid)
+    queue = bobdb.get_by_euid(queue_euid, use_cache=True)
     qm = []
     for i in queue.parent_of_lineages:
         qm.append(i.child_instance)
@@ -821,7 +884,7 @@ async def queue_details(
 
 
 @app.post("/generic_templates")
-async def generic_templates(request: Request, _auth=Depends(require_auth)):
+def generic_templates(request: Request, _auth=Depends(require_auth)):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
 
     the_templates = (
@@ -840,7 +903,7 @@ async def generic_templates(request: Request, _auth=Depends(require_auth)):
 
 
 @app.get("/workflow_summary", response_class=HTMLResponse)
-async def workflow_summary(request: Request, _auth=Depends(require_auth)):
+def workflow_summary(request: Request, _auth=Depends(require_auth)):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
     workflows = (
         bobdb.session.query(bobdb.Base.classes.workflow_instance)
@@ -883,7 +946,7 @@ async def workflow_summary(request: Request, _auth=Depends(require_auth)):
 
 
 @app.get("/update_object_name", response_class=HTMLResponse)
-async def update_object_name(request: Request, euid, name, _auth=Depends(require_auth)):
+def update_object_name(request: Request, euid, name, _auth=Depends(require_auth)):
     referer = request.headers.get("Referer", "/")
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
     obj = bobdb.get_by_euid(euid)
@@ -896,7 +959,7 @@ async def update_object_name(request: Request, euid, name, _auth=Depends(require
 
 
 @app.get("/equipment_overview", response_class=HTMLResponse)
-async def equipment_overview(request: Request, _auth=Depends(require_auth)):
+def equipment_overview(request: Request, _auth=Depends(require_auth)):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
 
     # Fetch equipment instances and templates
@@ -934,7 +997,7 @@ async def get_print_labs(_request: Request, _auth=Depends(require_auth)):
 
 
 @app.get("/reagent_overview", response_class=HTMLResponse)
-async def reagent_overview(request: Request, _auth=Depends(require_auth)):
+def reagent_overview(request: Request, _auth=Depends(require_auth)):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
 
     # Fetch equipment instances and templates
@@ -961,7 +1024,7 @@ async def reagent_overview(request: Request, _auth=Depends(require_auth)):
 
 
 @app.get("/control_overview", response_class=HTMLResponse)
-async def control_overview(request: Request, _auth=Depends(require_auth)):
+def control_overview(request: Request, _auth=Depends(require_auth)):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
 
     # Fetch equipment instances and templates
@@ -989,7 +1052,7 @@ async def control_overview(request: Request, _auth=Depends(require_auth)):
 
 @app.post("/create_from_template", response_class=HTMLResponse)
 @app.get("/create_from_template", response_class=HTMLResponse)
-async def create_from_template(
+def create_from_template(
     request: Request, euid: str = None, _auth=Depends(require_auth)
 ):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
@@ -1004,14 +1067,14 @@ async def create_from_template(
 
 
 @app.get("/uuid_details", response_class=HTMLResponse)
-async def uuid_details(request: Request, uuid: str, _auth=Depends(require_auth)):
+def uuid_details(request: Request, uuid: str, _auth=Depends(require_auth)):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
     obj = bobdb.get(uuid)
     return RedirectResponse(url=f"/euid_details?euid={obj.euid}")
 
 
 @app.get("/vertical_exp", response_class=HTMLResponse)
-async def vertical_exp(request: Request, euid=None, _auth=Depends(require_auth)):
+def vertical_exp(request: Request, euid=None, _auth=Depends(require_auth)):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
     instance = bobdb.get_by_euid(euid)
     user_data = request.session.get("user_data", {})
@@ -1024,7 +1087,7 @@ async def vertical_exp(request: Request, euid=None, _auth=Depends(require_auth))
 
 
 @app.get("/plate_carosel2", response_class=HTMLResponse)
-async def plate_carosel(
+def plate_carosel(
     request: Request, plate_euid: str = Query(...), _auth=Depends(require_auth)
 ):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
@@ -1036,7 +1099,7 @@ async def plate_carosel(
         return "Main plate not found."
 
     # Example logic to fetch related plates (modify based on your data model)
-    related_plates = await get_related_plates(main_plate)
+    related_plates = get_related_plates(request, main_plate)
     related_plates.append(main_plate)
     # Render the template with the main plate and related plates data
     user_data = request.session.get("user_data", {})
@@ -1052,35 +1115,36 @@ async def plate_carosel(
 
 
 @app.get("/get_related_plates", response_class=HTMLResponse)
-async def get_related_plates(request: Request, main_plate, _auth=Depends(require_auth)):
+def get_related_plates(request: Request, main_plate, _auth=Depends(require_auth)):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
     related_plates = []
 
     # Fetching ancestor plates through parent_of_lineages
-    for parent_lineage in main_plate.parent_of_lineages:
-        if parent_lineage.child_instance.btype == "plate":
-            related_plates.append(parent_lineage.child_instance)
+    for parent_lineage in bobdb.get_lineage_children(main_plate, btype="plate", include_deleted=True):
+        related_plates.append(parent_lineage.child_instance)
 
     # Fetching descendant plates through child_of_lineages
-    for child_lineage in main_plate.child_of_lineages:
-        if child_lineage.parent_instance.btype == "plate":
-            related_plates.append(child_lineage.parent_instance)
+    for child_lineage in bobdb.get_lineage_parents(main_plate, btype="plate", include_deleted=True):
+        related_plates.append(child_lineage.parent_instance)
 
     # Remove duplicates from the related_plates list
     related_plates = list({plate.euid: plate for plate in related_plates}.values())
 
+    # The wells of all related plates, in one query
+    plate_wells = {}
+    for lineage in bobdb.get_lineage_children(related_plates, btype="well", include_deleted=True):
+        plate_wells.setdefault(lineage.parent_instance_uuid, []).append(
+            lineage.child_instance
+        )
+
     # Additional logic to calculate rows and columns for each related plate
     for plate in related_plates:
         num_rows = 0
         num_cols = 0
-        for lineage in plate.parent_of_lineages:
-            if (
-                lineage.parent_instance.euid == plate.euid
-                and lineage.child_instance.btype == "well"
-            ):
-                cd = lineage.child_instance.json_addl.get("cont_address", {})
-                num_rows = max(num_rows, int(cd.get("row_idx", 0)))
-                num_cols = max(num_cols, int(cd.get("col_idx", 0)))
+        for well in plate_wells.get(plate.uuid, []):
+            cd = well.json_addl.get("cont_address", {})
+            num_rows = max(num_rows, int(cd.get("row_idx", 0)))
+            num_cols = max(num_cols, int(cd.get("col_idx", 0)))
         plate.json_addl["properties"]["num_rows"] = num_rows + 1
         plate.json_addl["properties"]["num_cols"] = num_cols + 1
         flag_modified(plate, "json_addl")
@@ -1089,7 +1153,7 @@ async def get_related_plates(request: Request, main_plate, _auth=Depends(require
 
 
 @app.get("/plate_visualization", response_class=HTMLResponse)
-async def plate_visualization(
+def plate_visualization(
     request: Request, plate_euid, _auth=Depends(require_auth)
 ):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
@@ -1099,7 +1163,7 @@ async def plate_visualization(
     num_rows = 0
     num_cols = 0
 
-    for i in plate.parent_of_lineages:
+    for i in bobdb.get_lineage_children(plate, btype="well", include_deleted=True):
         if i.parent_instance.euid == plate.euid and i.child_instance.btype == "well":
             cd = i.child_instance.json_addl["cont_address"]
             if int(cd["row_idx"]) > num_rows:
@@ -1128,14 +1192,13 @@ async def plate_visualization(
 
 
 @app.get("/database_statistics", response_class=HTMLResponse)
-async def database_statistics(request: Request, _auth=Depends(require_auth)):
+def database_statistics(request: Request, _auth=Depends(require_auth)):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
 
-    async def get_stats(days):
+    def get_stats(days):
         cutoff_date = datetime.now() - timedelta(days=days)
-        # Assume bobdb.session.query can be awaited; if not, adjust accordingly
         return (
-            await bobdb.session.query(
+            bobdb.session.query(
                 bobdb.Base.classes.generic_instance.b_sub_type,
                 func.count(bobdb.Base.classes.generic_instance.uuid),
             )
@@ -1147,9 +1210,9 @@ async def database_statistics(request: Request, _auth=Depends(require_auth)):
             .all()
         )
 
-    stats_1d = await get_stats(1)
-    stats_7d = await get_stats(7)
-    stats_30d = await get_stats(30)
+    stats_1d = get_stats(1)
+    stats_7d = get_stats(7)
+    stats_30d = get_stats(30)
 
     user_data = request.session.get("user_data", {})
     style = {"skin_css": user_data.get("style_css", "static/skins/bloom.css")}
@@ -1166,7 +1229,7 @@ async def database_statistics(request: Request, _auth=Depends(require_auth)):
 
 
 @app.get("/object_templates_summary", response_class=HTMLResponse)
-async def object_templates_summary(request: Request, _auth=Depends(require_auth)):
+def object_templates_summary(request: Request, _auth=Depends(require_auth)):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
 
     # Fetch all generic templates
@@ -1194,7 +1257,7 @@ async def object_templates_summary(request: Request, _auth=Depends(require_auth)
 
 # Quick hack to allow the details page to display deleted items.  Need to rework how the rest of the system juggles this.
 @app.get("/euid_details")
-async def euid_details(
+def euid_details(
     request: Request,
     euid: str = Query(..., description="The EUID to fetch details for"),
     _uuid: str = Query(None, description="Optional UUID parameter"),
@@ -1208,8 +1271,8 @@ async def euid_details(
 
     try:
         # Fetch the object using euid
-        obj = bobdb.get_by_euid(euid)
-        relationship_data = await get_relationship_data(obj) if obj else {}
+        obj = bobdb.get_by_euid(euid, use_cache=True)
+        relationship_data = get_relationship_data(obj) if obj else {}
 
         if not obj:
             raise HTTPException(status_code=404, detail="Object not found")
@@ -1223,7 +1286,8 @@ async def euid_details(
         obj_dict["parent_template_euid"] = (
             obj.parent_template.euid if hasattr(obj, "parent_template") else ""
         )
-        audit_logs = bobdb.query_audit_log_by_euid(euid)
+        # nothing is logged before the object was created, so the older audit_log partitions are skipped
+        audit_logs = bobdb.query_audit_log_by_euid(euid, since=obj.created_dt)
         user_data = request.session.get("user_data", {})
         style = {"skin_css": user_data.get("style_css", "static/skins/bloom.css")}
 
@@ -1233,6 +1297,7 @@ async def euid_details(
             style=style,
             relationships=relationship_data,
             audit_logs=audit_logs,
+            format_json_patch=format_json_patch,
             oobj=obj,
             udat=request.session["user_data"],
         )
@@ -1241,7 +1306,7 @@ async def euid_details(
     except Exception as e:
         if not is_deleted:
             # Retry with is_deleted set to True
-            return await euid_details(
+            return euid_details(
                 request=request,
                 euid=euid,
                 _uuid=_uuid,
@@ -1254,7 +1319,7 @@ async def euid_details(
 
 
 @app.get("/un_delete_by_uuid")
-async def un_delete_by_uuid(
+def un_delete_by_uuid(
     request: Request,
     uuid: str = Query(..., description="The UUID to un-delete"),
     euid: str = Query(..., description="The EUID associated with the UUID"),
@@ -1291,7 +1356,7 @@ async def un_delete_by_uuid(
                 logging.info(
                     f"Retrying with is_deleted=True for UUID: {uuid} and EUID: {euid}"
                 )
-                return await un_delete_by_uuid(
+                return un_delete_by_uuid(
                     request, uuid, euid, _auth, is_deleted=False
                 )
             except Exception as inner_e:
@@ -1307,7 +1372,7 @@ async def un_delete_by_uuid(
 
 
 @app.get("/bloom_schema_report", response_class=HTMLResponse)
-async def bloom_schema_report(request: Request, _auth=Depends(require_auth)):
+def bloom_schema_report(request: Request, _auth=Depends(require_auth)):
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
     a_stat = bobdb.query_generic_instance_and_lin_stats()
     b_stats = bobdb.query_generic_template_stats()
@@ -1346,23 +1411,27 @@ def delete_by_euid(request: Request, euid, _auth=Depends(require_auth)):
 @app.post("/delete_object")
 async def delete_object(request: Request, _auth=Depends(require_auth)):
     data = await request.json()
-    euid = data.get("euid")
-    bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-    bobdb.delete(bobdb.get_by_euid(euid))
-    bobdb.session.flush()
-    bobdb.session.commit()
-    return {
-        "status": "success",
-        "message": f"Delete object performed for EUID {euid}",
-    }
+
+    def _in_thread():
+        euid = data.get("euid")
+        bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
+        bobdb.delete(bobdb.get_by_euid(euid))
+        bobdb.session.flush()
+        bobdb.session.commit()
+        return {
+            "status": "success",
+            "message": f"Delete object performed for EUID {euid}",
+        }
+
+    return await run_in_threadpool(_in_thread)
 
 
 @app.get("/workflow_details", response_class=HTMLResponse)
-async def workflow_details(
+def workflow_details(
     request: Request, workflow_euid, _auth=Depends(require_auth)
 ):
     bwfdb = BloomWorkflow(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-    workflow = bwfdb.get_sorted_euid(workflow_euid)
+    workflow = bwfdb.get_sorted_euid(workflow_euid, use_cache=True)
     accordion_states = dict(request.session)
     user_data = request.session.get("user_data", {})
     style = {"skin_css": user_data.get("style_css", "static/skins/bloom.css")}
@@ -1391,42 +1460,46 @@ async def update_accordion_state(request: Request, _auth=Depends(require_auth)):
 @app.post("/workflow_step_action")
 async def workflow_step_action(request: Request, _auth=Depends(require_auth)):
     data = await request.json()
-    euid = data.get("euid")
-    action = data.get("action")
-    action_group = data.get("action_group")
-    ds = data.get("ds")
-    bobdb = BloomWorkflow(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-    bo = bobdb.get_by_euid(euid)
-
-    ds["curr_user"] = request.session.get("user_data", "bloomui-user")
-    udat = request.session.get("user_data", {})
-    ds["lab"] = udat.get("print_lab", "BLOOM")
-    ds["printer_name"] = udat.get("printer_name", "")
-    ds["label_zpl_style"] = udat.get("label_style", "")
-    ds["alt_a"] = udat.get("alt_a", "")
-    ds["alt_b"] = udat.get("alt_b", "")
-    ds["alt_c"] = udat.get(
-        "alt_c",
-    )
-    ds["alt_d"] = udat.get("alt_d", "")
-    ds["alt_e"] = udat.get("alt_e", "")
 
-    if bo.__class__.__name__ == "workflow_instance":
-        bwfdb = BloomWorkflow(
-            BLOOMdb3(app_username=request.session["user_data"]["email"])
-        )
-        act = bwfdb.do_action(
-            euid, action_ds=ds, action=action, action_group=action_group
-        )
-    else:
-        bwfsdb = BloomWorkflowStep(
-            BLOOMdb3(app_username=request.session["user_data"]["email"])
-        )
-        act = bwfsdb.do_action(
-            euid, action_ds=ds, action=action, action_group=action_group
+    def _in_thread():
+        euid = data.get("euid")
+        action = data.get("action")
+        action_group = data.get("action_group")
+        ds = data.get("ds")
+        bobdb = BloomWorkflow(BLOOMdb3(app_username=request.session["user_data"]["email"]))
+        bo = bobdb.get_by_euid(euid)
+
+        ds["curr_user"] = request.session.get("user_data", "bloomui-user")
+        udat = request.session.get("user_data", {})
+        ds["lab"] = udat.get("print_lab", "BLOOM")
+        ds["printer_name"] = udat.get("printer_name", "")
+        ds["label_zpl_style"] = udat.get("label_style", "")
+        ds["alt_a"] = udat.get("alt_a", "")
+        ds["alt_b"] = udat.get("alt_b", "")
+        ds["alt_c"] = udat.get(
+            "alt_c",
         )
+        ds["alt_d"] = udat.get("alt_d", "")
+        ds["alt_e"] = udat.get("alt_e", "")
 
-    return {"status": "success", "message": f" {action} performed for EUID {euid}"}
+        if bo.__class__.__name__ == "workflow_instance":
+            bwfdb = BloomWorkflow(
+                BLOOMdb3(app_username=request.session["user_data"]["email"])
+            )
+            act = bwfdb.do_action(
+                euid, action_ds=ds, action=action, action_group=action_group
+            )
+        else:
+            bwfsdb = BloomWorkflowStep(
+                BLOOMdb3(app_username=request.session["user_data"]["email"])
+            )
+            act = bwfsdb.do_action(
+                euid, action_ds=ds, action=action, action_group=action_group
+            )
+
+        return {"status": "success", "message": f" {action} performed for EUID {euid}"}
+
+    return await run_in_threadpool(_in_thread)
 
 
 @app.post("/update_obj_json_addl_properties", response_class=HTMLResponse)
@@ -1452,45 +1525,49 @@ async def update_obj_json_addl_properties(
 
     # Parse form data manually
     form = await request.form()
-    properties = {key: value for key, value in form.items() if key != "obj_euid"}
 
-    bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-    step = bobdb.get_by_euid(obj_euid)
+    def _in_thread():
+        properties = {key: value for key, value in form.items() if key != "obj_euid"}
 
-    if step is None:
-        print("Step not found")
-        return False
+        bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
+        step = bobdb.get_by_euid(obj_euid)
 
-    try:
-        for key, values in properties.items():
-            if key in step.json_addl["properties"]:
-                if isinstance(step.json_addl["properties"][key], list):
-                    step.json_addl["properties"][key] = (
-                        values if isinstance(values, list) else [values]
-                    )
-                else:
-                    step.json_addl["properties"][key] = values
-            if key.endswith("[]"):
-                key = key[:-2]
+        if step is None:
+            print("Step not found")
+            return False
+
+        try:
+            for key, values in properties.items():
                 if key in step.json_addl["properties"]:
-                    step.json_addl["properties"][key] = (
-                        values if isinstance(values, list) else [values]
-                    )
-                else:
-                    step.json_addl["properties"][key] = values
+                    if isinstance(step.json_addl["properties"][key], list):
+                        step.json_addl["properties"][key] = (
+                            values if isinstance(values, list) else [values]
+                        )
+                    else:
+                        step.json_addl["properties"][key] = values
+                if key.endswith("[]"):
+                    key = key[:-2]
+                    if key in step.json_addl["properties"]:
+                        step.json_addl["properties"][key] = (
+                            values if isinstance(values, list) else [values]
+                        )
+                    else:
+                        step.json_addl["properties"][key] = values
 
-        # Explicitly mark the object as modified if necessary
-        flag_modified(step, "json_addl")
+            # Explicitly mark the object as modified if necessary
+            flag_modified(step, "json_addl")
 
-        bobdb.session.flush()
-        bobdb.session.commit()
-        # Optionally, reload the object to confirm changes
-        bobdb.session.refresh(step)
+            bobdb.session.flush()
+            bobdb.session.commit()
+            # Optionally, reload the object to confirm changes
+            bobdb.session.refresh(step)
 
-    except Exception as e:
-        raise Exception("Error updating step properties:", e)
+        except Exception as e:
+            raise Exception("Error updating step properties:", e)
 
-    return RedirectResponse(url=referer, status_code=303)
+        return RedirectResponse(url=referer, status_code=303)
+
+    return await run_in_threadpool(_in_thread)
 
 
 @app.get("/dagg", response_class=HTMLResponse)
@@ -1500,7 +1577,7 @@ async def dagg(request: Request):
 
 
 @app.get("/dindex2", response_class=HTMLResponse)
-async def dindex2(
+def dindex2(
     request: Request,
     globalFilterLevel=6,
     globalZoom=0,
@@ -1535,7 +1612,7 @@ def add_new_node(request: Request, _auth=Depends(require_auth)):
 
 
 @app.get("/get_node_info")
-async def get_node_info(request: Request, euid, _auth=Depends(require_auth)):
+def get_node_info(request: Request, euid, _auth=Depends(require_auth)):
     bobj = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
     node_dat = bobj.get_by_euid(euid)
 
@@ -1553,22 +1630,57 @@ async def get_node_info(request: Request, euid, _auth=Depends(require_auth)):
         return {"error": "Node not found"}
 
 @app.get("/user_audit_logs", response_class=HTMLResponse)
-async def user_audit_logs(request: Request, username: str, _auth=Depends(require_auth)):
+def user_audit_logs(
+    request: Request,
+    username: str,
+    since: str = None,
+    until: str = None,
+    tables: List[str] = Query(None),
+    after: str = None,
+    page_size: int = None,
+    format: str = "html",
+    _auth=Depends(require_auth),
+):
+    # a keyset page at a time (after= is the cursor of the page before), format=csv / ndjson streams the lot
+    try:
+        filters = {
+            "since": datetime.fromisoformat(since).astimezone() if since else None,
+            "until": datetime.fromisoformat(until).astimezone() if until else None,
+            "tables": tables,
+        }
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid since / until: {e}")
     bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-    results = bobdb.query_user_audit_logs(username)
-    
+
+    if format in ["csv", "ndjson"]:
+        return StreamingResponse(
+            bobdb.stream_user_audit_logs(username, fmt=format, page_size=page_size, **filters),
+            media_type="text/csv" if format == "csv" else "application/x-ndjson",
+            headers={"Content-Disposition": f'attachment; filename="audit_log_{username}.{format}"'},
+        )
+
+    try:
+        results, next_after = bobdb.query_user_audit_log_page(username, page_size, after=after, **filters)
+    except ValueError as e:  # a bad or mangled after= cursor
+        raise HTTPException(status_code=400, detail=str(e))
+    query = {"username": username, "since": since or "", "until": until or "", "tables": tables or []}
+    next_url = f"/user_audit_logs?{urlencode({**query, 'after': next_after}, doseq=True)}" if next_after else None
+    export_url = f"/user_audit_logs?{urlencode(query, doseq=True)}"
+
     user_data = request.session.get("user_data", {})
     style = {"skin_css": user_data.get("style_css", "static/skins/bloom.css")}
-    
-    content = templates.get_template("audit_log_by_user.html").render(
-        results=results, username=username, style=style, udat=user_data, request=request, highlight_json_changes=highlight_json_changes
 
+    content = templates.get_template("audit_log_by_user.html").render(
+        results=results, username=username, style=style, udat=user_data, request=request, highlight_json_changes=highlight_json_changes,
+        format_json_patch=format_json_patch, since=since or "", until=until or "", tables=tables or [],
+        audit_tables=["generic_template", "generic_instance", "generic_instance_lineage"],
+        next_url=next_url, export_url=export_url, first_page=after is None
     )
-    
+
     return HTMLResponse(content=content)
 
 @app.get("/user_home", response_class=HTMLResponse)
-async def user_home(request: Request):
+def user_home(request: Request):
 
     user_data = request.session.get("user_data", {})
     session_data = request.session.get("session_data", {})  # Extract session_data from session
@@ -1627,40 +1739,26 @@ async def user_home(request: Request):
 def generate_dag_json_from_all_objects_v2(
     request: Request, euid="AY1", depth=6, _auth=Depends(require_auth)
 ):
+    """Compact cytoscape JSON text for the graph around euid, shared by all users from the DAG cache."""
     # Default values and setup
     if euid in [None, "", "None"]:
         euid = "AY1"
+    depth = int(depth)
 
     bobj = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-    last_schema_edit_dt = bobj.get_most_recent_schema_audit_log_entry()
-
-    # Simplify file naming and ensure directory exists
-    user_email_sanitized = (
-        request.session["user_data"]["email"].replace("@", "_").replace(".", "_")
+    # Any write to the database is in audit_log, and makes a new cache key
+    last_audit = bobj.get_most_recent_schema_audit_log_entry()
+    cache_key = (
+        euid,
+        depth,
+        None if last_audit is None else last_audit.changed_at.isoformat(),
     )
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    output_dir = "./dags"
-    os.makedirs(output_dir, exist_ok=True)  # Ensure the directory exists
-    output_file = os.path.join(
-        output_dir, f"dag_{user_email_sanitized}_{depth}_{timestamp}_dagv2.json"
+    return get_dag_cache(bobj.session.get_bind()).get(
+        cache_key, lambda: _build_dag_json(bobj, euid, depth)
     )
 
-    # Check if DAG needs to be regenerated
-    schema_mod_dt = request.session.get("schema_mod_dt")
-    if (
-        schema_mod_dt != last_schema_edit_dt.changed_at.isoformat()
-        or not os.path.exists(output_file)
-    ):
-        print(
-            f"Dag WILL BE Regenerated, Schema Has Changed. {output_file} being generated."
-        )
-    else:
-        print(f"Dag Not Regenerated, Schema Has Not Changed. {output_file} unchanged.")
-        return
-
-    request.session["schema_mod_dt"] = last_schema_edit_dt.changed_at.isoformat()
-    request.session["user_data"]["dag_fnv2"] = output_file
 
+def _build_dag_json(bobj, euid, depth):
     colors = {
         "container": "#8B00FF",  # Electric Purple
         "content": "#00BFFF",  # Deep Sky Blue
@@ -1684,35 +1782,11 @@ def generate_dag_json_from_all_objects_v2(
 
     edge_relationship_type_colors = {"generic": "#ADD8E6", "index": "#4CAF50"}
 
-    # instance_result = []
-    instance_result = {}
-    lineage_result = {}
-
-    for r in bobj.fetch_graph_data_by_node_depth(euid, depth):
-        if r[0] in [None, "", "None"]:
-            pass
-        else:
-
-            instance = {
-                "euid": r[0],
-                "name": r[2],
-                "btype": r[3],
-                "super_type": r[4],
-                "b_sub_type": r[5],
-                "version": r[6],
-            }
-            instance_result[r[0]] = instance
-
-            if r[8] in [None, "", "None"]:
-                pass
-            else:
-                lin_edge = {
-                    "parent_euid": r[9],
-                    "child_euid": r[10],
-                    "lineage_euid": r[8],
-                    "relationship_type": r[11],
-                }
-                lineage_result[r[8]] = lin_edge
+    graph = bobj.fetch_graph_neighbourhood(euid, int(depth))
+    if graph["truncated"]:
+        logging.warning(f"DAG for {euid} at depth {depth} truncated at {len(graph['nodes'])} nodes.")
+    instance_result = {n["euid"]: n for n in graph["nodes"]}
+    lineage_result = {e["lineage_euid"]: e for e in graph["edges"]}
 
     # Construct nodes and edges
     nodes = []
@@ -1759,15 +1833,8 @@ def generate_dag_json_from_all_objects_v2(
         }
         edges.append(edge)
 
-    # Construct JSON structure
-
-    dag_json = {"elements": {"nodes": nodes, "edges": edges}}
-
-    # Write to file
-    with open(output_file, "w") as f:
-        json.dump(dag_json, f, indent=4)
-
-    print(f"All DAG JSON saved to {output_file}")
+    # Construct JSON structure, truncated tells the page it is not seeing the whole neighbourhood
+    return {"elements": {"nodes": nodes, "edges": edges}, "truncated": graph["truncated"]}
 
 
 def get_dag(request: Request, _auth=Depends(require_auth)):
@@ -1780,16 +1847,11 @@ def get_dag(request: Request, _auth=Depends(require_auth)):
 
 
 @app.get("/get_dagv2")
-async def get_dagv2(
-    request: Request, _euid="AY1", _depth=6, _auth=Depends(require_auth)
-):
-    dag_fn = request.session["user_data"]["dag_fnv2"]
-    # dag_fn = "./dags/j.json"
-    dag_data = {"elements": {"nodes": [], "edges": []}}
-    if os.path.exists(dag_fn):
-        with open(dag_fn, "r") as f:
-            dag_data = json.load(f)
-    return dag_data
+def get_dagv2(request: Request, euid="AY1", depth=6, _auth=Depends(require_auth)):
+    dag_json = generate_dag_json_from_all_objects_v2(
+        request=request, euid=euid, depth=depth
+    )
+    return Response(content=dag_json, media_type="application/json")
 
 
 @app.post("/update_dag")
@@ -1804,42 +1866,54 @@ async def update_dag(request: Request, _auth=Depends(require_auth)):
 @app.post("/add_new_edge")
 async def add_new_edge(request: Request, _auth=Depends(require_auth)):
     input_data = await request.json()  # Corrected call to request.json()
-    parent_euid = input_data["parent_uuid"]
-    child_euid = input_data["child_uuid"]
-    bobj = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-    # Assuming the method returns the new edge object, you might need to adjust this part
-    new_edge = bobj.create_generic_instance_lineage_by_euids(parent_euid, child_euid)
-    bobj.session.flush()
-    bobj.session.commit()
-    return {"euid": str(new_edge.euid)}
+
+    def _in_thread():
+        parent_euid = input_data["parent_uuid"]
+        child_euid = input_data["child_uuid"]
+        bobj = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
+        # Assuming the method returns the new edge object, you might need to adjust this part
+        new_edge = bobj.create_generic_instance_lineage_by_euids(parent_euid, child_euid)
+        bobj.session.flush()
+        bobj.session.commit()
+        return {"euid": str(new_edge.euid)}
+
+    return await run_in_threadpool(_in_thread)
 
 
 @app.post("/delete_node")
 async def delete_node(request: Request, _auth=Depends(require_auth)):
     input_data = await request.json()
-    node_euid = input_data["euid"]
-    bobj = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-    bobj.delete(euid=node_euid)
-    bobj.session.flush()
-    bobj.session.commit()
 
-    return {
-        "status": "success",
-        "message": "Node and associated lineage records deleted successfully.",
-    }
+    def _in_thread():
+        node_euid = input_data["euid"]
+        bobj = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
+        bobj.delete(euid=node_euid)
+        bobj.session.flush()
+        bobj.session.commit()
+
+        return {
+            "status": "success",
+            "message": "Node and associated lineage records deleted successfully.",
+        }
+
+    return await run_in_threadpool(_in_thread)
 
 
 @app.post("/delete_edge")
 async def delete_edge(request: Request, _auth=Depends(require_auth)):
     input_data = await request.json()
-    edge_euid = input_data["euid"]
 
-    bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-    bobdb.delete(bobdb.get_by_euid(edge_euid))
-    bobdb.session.flush()
-    bobdb.session.commit()
+    def _in_thread():
+        edge_euid = input_data["euid"]
+
+        bobdb = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
+        bobdb.delete(bobdb.get_by_euid(edge_euid))
+        bobdb.session.flush()
+        bobdb.session.commit()
 
-    return {"status": "success", "message": "Edge deleted successfully."}
+        return {"status": "success", "message": "Edge deleted successfully."}
+
+    return await run_in_threadpool(_in_thread)
 
 
 ## File Manager // Dewey (pull into separate file   )
@@ -1854,7 +1928,7 @@ def generate_unique_upload_key():
 
 
 @app.get("/dewey", response_class=HTMLResponse)
-async def dewey(request: Request, _auth=Depends(require_auth)):
+def dewey(request: Request, _auth=Depends(require_auth)):
     request.session.pop("form_data", None)
 
     accordion_states = dict(request.session)
@@ -1908,8 +1982,29 @@ async def dewey0(request: Request, _auth=Depends(require_auth)):
     return HTMLResponse(content=content)
 
 
+def _spool_upload(upload):
+    # FastAPI closes the form's files as soon as the route returns, which is before the streamed report runs
+    # the uploads, so the report gets its own copy of each one
+    spool = tempfile.SpooledTemporaryFile(
+        max_size=int(os.environ.get("BLOOM_UPLOAD_SPOOL_MAX_BYTES", 1024 * 1024))
+    )
+    upload.file.seek(0)
+    shutil.copyfileobj(upload.file, spool, 1024 * 1024)
+    spool.seek(0)
+    return spool
+
+
+def _closing_when_done(results, files):
+    # the spooled uploads are closed once the report has been sent (or the client went away)
+    try:
+        yield from results
+    finally:
+        for f in files:
+            f.close()
+
+
 @app.post("/create_file")
-async def create_file(
+def create_file(
     request: Request,
     name: str = Form(...),
     comments: str = Form(""),
@@ -1972,38 +2067,11 @@ async def create_file(
             "sub_variable": sub_variable,
         }
 
-        results = []
-
+        sources = []
         if file_data:
             for file in file_data:
                 if file.filename:  # Ensure that there is a valid filename
-                    try:
-                        new_file = bfi.create_file(
-                            file_metadata=file_metadata,
-                            file_data=file.file,
-                            file_name=file.filename,
-                        )
-                        results.append(
-                            {
-                                "identifier": new_file.euid,
-                                "status": "Success",
-                                "original": file.filename if file else url,
-                                "current_s3_uri": new_file.json_addl["properties"][
-                                    "current_s3_uri"
-                                ],
-                            }
-                        )
-                        bfs.add_files_to_file_set(
-                            file_set_euid=new_file_set.euid, file_euids=[new_file.euid]
-                        )   
-                    except Exception as e:
-                        results.append(
-                            {
-                                "identifier": file.filename,
-                                "status": f"Failed: {str(e)}",
-                                "original": file.filename if file else url,
-                            }
-                        )
+                    sources.append({"file_data": _spool_upload(file), "file_name": file.filename})
                 else:
                     logging.warning(f"Skipping file with no filename: {file}")
 
@@ -2011,103 +2079,43 @@ async def create_file(
             directory_files = [
                 file for file in directory if not file.filename.startswith(".")
             ]
-
             for file in directory_files:
-
                 if (
                     len(file.filename) > 0
                     and len(file.filename.lstrip(".").lstrip("/").split("/")) < 3
                 ):
-                    try:
-                        new_file = bfi.create_file(
-                            file_metadata=file_metadata,
-                            file_data=file.file,
-                            file_name=file.filename,
-                        )
-                        results.append(
-                            {
-                                "identifier": new_file.euid,
-                                "status": "Success",
-                                "original": file.filename if file else url,
-                                "current_s3_uri": new_file.json_addl["properties"][
-                                    "current_s3_uri"
-                                ],
-                            }
-                        )
-                        bfs.add_files_to_file_set(
-                            file_set_euid=new_file_set.euid, file_euids=[new_file.euid]
-                        )  
-                    except Exception as e:
-                        results.append(
-                            {
-                                "identifier": file.filename,
-                                "status": f"Failed: {str(e)}",
-                                "original": file.filename if file else url,
-                            }
-                        )
+                    sources.append({"file_data": _spool_upload(file), "file_name": file.filename})
 
         if urls:
-            url_list = urls.split("\n")
-            for url in url_list:
-                if url.strip():
-                    try:
-                        new_file = bfi.create_file(
-                            file_metadata=file_metadata, url=url.strip()
-                        )
-                        results.append(
-                            {
-                                "identifier": new_file.euid,
-                                "status": "Success",
-                                "original": url,
-                                "current_s3_uri": new_file.json_addl["properties"][
-                                    "current_s3_uri"
-                                ],
-                            }
-                        )
-                        bfs.add_files_to_file_set(
-                            file_set_euid=new_file_set.euid, file_euids=[new_file.euid]
-                        )  
-                    except Exception as e:
-                        results.append(
-                            {"identifier": url.strip(), "status": f"Failed: {str(e)}"}
-                        )
+            sources.extend(
+                {"url": url.strip()} for url in urls.split("\n") if url.strip()
+            )
+        # All the file rows are created (and linked to the file set) up front, the uploads run in parallel
+        # and the report is streamed, one row per file as it finishes.
+        results = []
+        if sources:
+            results = bfi.create_files(
+                sources, file_metadata=file_metadata, file_set_euid=new_file_set.euid
+            )
         if s3_uris:
-            s3_uri_list = s3_uris.split("\n")
-            for s3_uri in s3_uri_list:
-                if s3_uri.strip():
-                    try:
-                        new_file = bfi.create_file(
-                            file_metadata=file_metadata, s3_uri=s3_uri.strip()
-                        )
-                        results.append(
-                            {
-                                "identifier": new_file.euid,
-                                "status": "Success",
-                                "original": s3_uri,
-                                "current_s3_uri": new_file.json_addl["properties"][
-                                    "current_s3_uri"
-                                ],
-                            }
-                        )
-                        bfs.add_files_to_file_set(
-                            file_set_euid=new_file_set.euid, file_euids=[new_file.euid]
-                        )  
-                    except Exception as e:
-                        results.append(
-                            {
-                                "identifier": s3_uri.strip(),
-                                "status": f"Failed: {str(e)}",
-                            }
-                        )
+            # s3 -> s3 moves are a separate job, they are server side copies and can run much wider
+            s3_results = bfi.import_s3_uris(
+                [s3_uri.strip() for s3_uri in s3_uris.split("\n") if s3_uri.strip()],
+                file_metadata=file_metadata,
+                file_set_euid=new_file_set.euid,
+            )
+            results = itertools.chain(results, s3_results)
+        results = _closing_when_done(
+            results, [source["file_data"] for source in sources if "file_data" in source]
+        )
 
-        # Render the report
         user_data = request.session.get("user_data", {})
         style = {"skin_css": user_data.get("style_css", "static/skins/bloom.css")}
-        content = templates.get_template("create_file_report.html").render(
+        content = templates.get_template("create_file_report.html").generate(
             request=request, results=results, style=style, udat=user_data
         )
 
-        return HTMLResponse(content=content)
+        return StreamingResponse(content, media_type="text/html")
 
     except ValueError as ve:
         logging.error(f"Input error: {ve}")
@@ -2133,15 +2141,52 @@ async def create_file(
 
 
 @app.post("/download_file", response_class=HTMLResponse)
-async def download_file(
+def download_file(
     request: Request,
     euid: str = Form(...),
     download_type: str = Form(...),
     create_metadata_file: str = Form(...),
     ret_json: str = Form(None),
+    delivery: str = Form(None),
 ):
+    # delivery: disk (copied to ./tmp/ first, the original behaviour and the default), stream (piped through
+    # /stream_file) or presigned (the browser fetches straight from S3, which bypasses this app's auth and logging
+    # for as long as the url is valid, so it is opt-in).  BLOOM_DEWEY_DOWNLOAD_MODE changes the default.  The
+    # metadata sidecar is generated on request in the last two.
+    delivery = delivery or os.environ.get("BLOOM_DEWEY_DOWNLOAD_MODE", "disk")
     try:
         bfi = BloomFile(BLOOMdb3(app_username=request.session["user_data"]["email"]))
+        if delivery in ["presigned", "stream"]:
+            query = urlencode({"euid": euid, "download_type": download_type})
+            if delivery == "presigned":
+                file_download_path = bfi.get_presigned_download_url(
+                    euid, save_pattern=download_type
+                )
+            else:
+                file_download_path = f"/stream_file?{query}"
+            metadata_yaml_path = (
+                f"/file_metadata_yaml?{query}" if create_metadata_file == "yes" else None
+            )
+
+            if ret_json:
+                return JSONResponse(
+                    content={
+                        "file_download_path": file_download_path,
+                        "metadata_download_path": metadata_yaml_path,
+                    }
+                )
+
+            user_data = request.session.get("user_data", {})
+            style = {"skin_css": user_data.get("style_css", "static/skins/bloom.css")}
+            content = templates.get_template("trigger_downloads.html").render(
+                request=request,
+                file_download_path=file_download_path,
+                metadata_download_path=metadata_yaml_path,
+                style=style,
+                udat=user_data,
+            )
+            return HTMLResponse(content=content)
+
         downloaded_file_path = bfi.download_file(
             euid=euid,
             save_pattern=download_type,
@@ -2202,6 +2247,82 @@ async def download_file(
         return HTMLResponse(content=content)
 
 
+def _parse_range_header(range_header):
+    # a single "bytes=start-end" / "bytes=start-" / "bytes=-suffix" range, which is what S3 accepts
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header or "")
+    if not match or match.groups() == ("", ""):
+        return None
+    return f"bytes={match.group(1)}-{match.group(2)}"
+
+
+@app.get("/stream_file")
+def stream_file(
+    request: Request, euid: str, download_type: str = "dewey", _auth=Depends(require_auth)
+):
+    bfi = BloomFile(BLOOMdb3(app_username=request.session["user_data"]["email"]))
+    file_name = bfi.download_file_name(bfi.get_by_euid(euid), download_type)
+    byte_range = _parse_range_header(request.headers.get("range"))
+    try:
+        s3_object = bfi.get_s3_object(euid, byte_range=byte_range)
+    except ValueError as e:
+        return Response(status_code=416, content=str(e))
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(s3_object["ContentLength"]),
+        "Content-Disposition": f'attachment; filename="{file_name}"',
+    }
+    if "ContentRange" in s3_object:
+        headers["Content-Range"] = s3_object["ContentRange"]
+    return StreamingResponse(
+        s3_object["Body"].iter_chunks(chunk_size=1024 * 1024),
+        status_code=206 if "ContentRange" in s3_object else 200,
+        media_type=s3_object.get("ContentType", "application/octet-stream"),
+        headers=headers,
+    )
+
+
+@app.get("/file_metadata_yaml")
+def file_metadata_yaml(
+    request: Request, euid: str, download_type: str = "dewey", _auth=Depends(require_auth)
+):
+    bfi = BloomFile(BLOOMdb3(app_username=request.session["user_data"]["email"]))
+    file_name = bfi.download_file_name(bfi.get_by_euid(euid), download_type)
+    return Response(
+        content=bfi.get_metadata_yaml(euid),
+        media_type="application/x-yaml",
+        headers={"Content-Disposition": f'attachment; filename="{file_name}.dewey.yaml"'},
+    )
+
+
+@app.get("/download_file_set")
+def download_file_set(
+    request: Request,
+    euid: str,
+    archive_format: str = "zip",
+    download_type: str = "dewey",
+    create_metadata_file: str = "yes",
+    _auth=Depends(require_auth),
+):
+    bdb = BLOOMdb3(app_username=request.session["user_data"]["email"])
+    files = BloomFileSet(bdb).get_file_set_files(euid)
+    try:
+        archive = BloomFile(bdb).stream_archive(
+            files,
+            archive_format=archive_format,
+            save_pattern=download_type,
+            include_metadata=create_metadata_file == "yes",
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    media_type = "application/zip" if archive_format == "zip" else "application/x-tar"
+    return StreamingResponse(
+        archive,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{euid}.{archive_format}"'},
+    )
+
+
 def delete_file(file_path: Path):
     try:
         if file_path.exists():
@@ -2225,7 +2346,7 @@ async def delete_temp_file(
 
 
 @app.post("/search_files", response_class=HTMLResponse)
-async def search_files(
+def search_files(
     request: Request,
     euid: str = Form(None),
     is_greedy: str = Form(...),
@@ -2235,6 +2356,8 @@ async def search_files(
     value_2: str = Form(None),
     key_3: str = Form(None),
     value_3: str = Form(None),
+    offset: int = Form(0),
+    page_size: int = Form(None),
 ):
     search_criteria = {}
 
@@ -2255,29 +2378,11 @@ async def search_files(
 
     try:
         bfi = BloomFile(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-        euid_results = bfi.search_objs_by_addl_metadata(
-            search_criteria, greedy, "file", super_type="file"
+        page_size = _search_page_size(page_size)
+        found = bfi.search_addl_metadata(
+            search_criteria, greedy, "file", super_type="file", limit=page_size, offset=offset
         )
-
-        # Fetch details for each EUID
-        detailed_results = [bfi.get_by_euid(euid) for euid in euid_results]
-
-        # Create a list of columns for the table
-        columns = ["EUID", "Date Created", "Status"]
-        if detailed_results and detailed_results[0].json_addl.get("properties"):
-            columns += list(detailed_results[0].json_addl["properties"].keys())
-
-        # Prepare the data for the template
-        table_data = []
-        for result in detailed_results:
-            row = {
-                "EUID": result.euid,
-                "Date Created": result.created_dt.strftime("%Y-%m-%d %H:%M:%S"),
-                "Status": result.bstatus,
-            }
-            for key in columns[3:]:
-                row[key] = result.json_addl["properties"].get(key, "N/A")
-            table_data.append(row)
+        columns, table_data = _search_table_data(found["rows"])
 
         user_data = request.session.get("user_data", {})
         style = {"skin_css": user_data.get("style_css", "static/skins/bloom.css")}
@@ -2288,6 +2393,21 @@ async def search_files(
             table_data=table_data,
             style=style,
             udat=user_data,
+            total=found["total"],
+            offset=offset,
+            next_offset=offset + page_size if found["next_after"] else None,
+            search_action="/search_files",
+            search_form={
+                "euid": euid or "",
+                "is_greedy": is_greedy,
+                "key_1": key_1 or "",
+                "value_1": value_1 or "",
+                "key_2": key_2 or "",
+                "value_2": value_2 or "",
+                "key_3": key_3 or "",
+                "value_3": value_3 or "",
+                "page_size": page_size,
+            },
         )
         return HTMLResponse(content=content)
 
@@ -2305,7 +2425,7 @@ async def search_files(
 
 
 @app.get("/get_node_property")
-async def get_node_property(request: Request, euid: str, key: str):
+def get_node_property(request: Request, euid: str, key: str):
     bo = BloomObj(BLOOMdb3(app_username=""))
 
     try:
@@ -2325,7 +2445,7 @@ async def get_node_property(request: Request, euid: str, key: str):
 
 
 @app.post("/create_file_set")
-async def create_file_set(
+def create_file_set(
     request: Request,
     file_set_name: str = Form(...),
     file_set_description: str = Form(...),
@@ -2361,7 +2481,7 @@ async def create_file_set(
 
 # The following is very redundant to the file_search and <s>probably</s> should be refactored
 @app.post("/search_file_sets", response_class=HTMLResponse)
-async def search_file_sets(
+def search_file_sets(
     request: Request,
     file_set_name: str = Form(None),
     file_set_description: str = Form(None),
@@ -2369,6 +2489,8 @@ async def search_file_sets(
     comments: str = Form(None),
     file_euids: str = Form(None),
     is_greedy: str = Form("yes"),
+    offset: int = Form(0),
+    page_size: int = Form(None),
 ):
     search_criteria = {}
 
@@ -2387,36 +2509,21 @@ async def search_file_sets(
 
     try:
         bfs = BloomFileSet(BLOOMdb3(app_username=request.session["user_data"]["email"]))
-        file_sets = bfs.search_objs_by_addl_metadata(
-            q_ds, greedy, "file_set", super_type="file"
+        page_size = _search_page_size(page_size)
+        found = bfs.search_addl_metadata(
+            q_ds, greedy, "file_set", super_type="file", limit=page_size, offset=offset
         )
-
-        # Fetch details for each EUID
-        detailed_results = [bfs.get_by_euid(euid) for euid in file_sets]
-
-        # Create a list of columns for the table
-        columns = ["EUID", "Date Created", "Status"]
-        if detailed_results and detailed_results[0].json_addl.get("properties"):
-            columns += list(detailed_results[0].json_addl["properties"].keys())
+        columns, table_data = _search_table_data(found["rows"])
         columns.append("File EUIDs")
-        # Prepare the data for the template
-        table_data = []
-        for result in detailed_results:
-            row = {
-                "EUID": result.euid,
-                "Date Created": result.created_dt.strftime("%Y-%m-%d %H:%M:%S"),
-                "Status": result.bstatus,
-            }
-            for key in columns[3:]:
-                row[key] = result.json_addl["properties"].get(key, "N/A")
-            file_euids = [
-                elem.child_instance.euid for elem in result.parent_of_lineages.all()
-            ]
-            euid_links = [
-                f'<a href="euid_details?euid={euid}">{euid}</a>' for euid in file_euids
+
+        # the files of every set on the page, in one query
+        file_euids = defaultdict(list)
+        for lin in bfs.get_lineage_children([r["uuid"] for r in found["rows"]], include_deleted=True):
+            file_euids[lin.parent_instance_uuid].append(lin.child_instance.euid)
+        for result, row in zip(found["rows"], table_data):
+            row["File EUIDs"] = [
+                f'<a href="euid_details?euid={euid}">{euid}</a>' for euid in file_euids[result["uuid"]]
             ]
-            row["File EUIDs"] = euid_links
-            table_data.append(row)
 
         user_data = request.session.get("user_data", {})
         style = {"skin_css": user_data.get("style_css", "static/skins/bloom.css")}
@@ -2427,6 +2534,18 @@ async def search_file_sets(
             columns=columns,
             style=style,
             udat=user_data,
+            total=found["total"],
+            offset=offset,
+            next_offset=offset + page_size if found["next_after"] else None,
+            search_action="/search_file_sets",
+            search_form={
+                "file_set_name": file_set_name or "",
+                "file_set_description": file_set_description or "",
+                "file_set_tag": file_set_tag or "",
+                "comments": comments or "",
+                "is_greedy": is_greedy,
+                "page_size": page_size,
+            },
         )
         return HTMLResponse(content=content)
 
@@ -2444,7 +2563,7 @@ async def search_file_sets(
 
 
 @app.get("/visual_report", response_class=HTMLResponse)
-async def visual_report(request: Request):
+def visual_report(request: Request):
     import io
     import base64
 
@@ -2576,7 +2695,7 @@ def generate_ui_form_fields(ui_form_properties: List[Dict], controlled_propertie
     return form_fields
 
 @app.get("/create_instance/{template_euid}", response_class=HTMLResponse)
-async def create_instance_form(request: Request, template_euid: str):
+def create_instance_form(request: Request, template_euid: str):
     bobj = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
     
     tempi = bobj.get_by_euid(template_euid)
@@ -2614,13 +2733,17 @@ async def create_instance_form(request: Request, template_euid: str):
 async def create_instance(request: Request):
     bobj = BloomObj(BLOOMdb3(app_username=request.session["user_data"]["email"]))
     form_data = await request.form()
-    #form_data_dict = form_data._dict
-    template_euid = form_data['template_euid']
-    #del form_data_dict['template_euid']
 
-    jaddl = {'properties': dict(form_data)}
-    ni = bobj.create_instance(template_euid, jaddl)
+    def _in_thread():
+        #form_data_dict = form_data._dict
+        template_euid = form_data['template_euid']
+        #del form_data_dict['template_euid']
+
+        jaddl = {'properties': dict(form_data)}
+        ni = bobj.create_instance(template_euid, jaddl)
+
+        return RedirectResponse(
+            url=f"/euid_details?euid={ni.euid}", status_code=303
+        )
 
-    return RedirectResponse(
-        url=f"/euid_details?euid={ni.euid}", status_code=303
-    )
\ No newline at end of file
+    return await run_in_threadpool(_in_thread)
\ No newline at end of file
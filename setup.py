@@ -8,6 +8,10 @@ setup(
         # Add dependencies here,
         # 'pytest',
     ],
+    extras_require={
+        # only archive_audit_log_partitions(fmt="parquet") needs it
+        "parquet": ["pyarrow"],
+    },
     entry_points={
         "console_scripts": [
             "install-bloom=bloom_lims.thing:main",
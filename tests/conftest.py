@@ -0,0 +1,30 @@
+import base64
+import json
+import os
+
+import pytest
+
+TEST_USER_DATA = {"email": "test_user@example.com"}
+
+
+@pytest.fixture
+def bloom_app(monkeypatch):
+    # require_auth() only wants the SUPABASE_* settings to be present, nothing here talks to supabase
+    monkeypatch.setenv("SUPABASE_URL", os.environ.get("SUPABASE_URL", "http://supabase.invalid"))
+    monkeypatch.setenv("SUPABASE_KEY", os.environ.get("SUPABASE_KEY", "test"))
+    import main
+
+    return main.app
+
+
+@pytest.fixture
+def session_cookies(bloom_app):
+    """Cookies for a logged in session (as TEST_USER_DATA), signed the way main.py's SessionMiddleware does."""
+    import itsdangerous
+    from starlette.middleware.sessions import SessionMiddleware
+
+    middleware = next(m for m in bloom_app.user_middleware if m.cls is SessionMiddleware)
+    options = getattr(middleware, "kwargs", None) or middleware.options
+    signer = itsdangerous.TimestampSigner(str(options["secret_key"]))
+    data = base64.b64encode(json.dumps({"user_data": TEST_USER_DATA}).encode("utf-8"))
+    return {"session": signer.sign(data).decode("utf-8")}
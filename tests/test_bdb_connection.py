@@ -0,0 +1,492 @@
+import copy
+import contextvars
+import gc
+import threading
+import time
+import weakref
+from datetime import timedelta
+from sqlalchemy import text
+from sqlalchemy.orm.attributes import flag_modified
+
+from bloom_lims.bdb import BLOOMdb3
+from bloom_lims.bdb import BloomObj
+from bloom_lims.bdb import close_bloomdb_sessions
+
+
+def test_engine_and_base_are_shared():
+    bdb_a = BLOOMdb3(app_username="test_user_a")
+    bdb_b = BLOOMdb3(app_username="test_user_b")
+
+    assert bdb_a.engine is bdb_b.engine
+    assert bdb_a.Base is bdb_b.Base
+    assert bdb_a.session is not bdb_b.session
+
+    bdb_a.close()
+    bdb_b.close()
+
+
+def test_username_is_set_per_checkout():
+    for username in ["test_user_a", "test_user_b", "test_user_a"]:
+        bdb = BLOOMdb3(app_username=username)
+        curr = bdb.session.execute(
+            text("SELECT current_setting('session.current_username', true)")
+        ).scalar()
+        assert curr == username
+
+        # and again after the connection has gone back to the pool
+        bdb.session.commit()
+        curr = bdb.session.execute(
+            text("SELECT current_setting('session.current_username', true)")
+        ).scalar()
+        assert curr == username
+        bdb.close()
+
+
+def test_sessions_go_back_to_the_pool():
+    # closed at the end of the block, including ones made in a thread started with the context (run_in_threadpool)
+    in_thread = []
+    with close_bloomdb_sessions():
+        bdb = BLOOMdb3(app_username="test_user_a")
+        bdb.session.execute(text("SELECT 1"))
+        ctx = contextvars.copy_context()
+        t = threading.Thread(target=ctx.run, args=(lambda: in_thread.append(BLOOMdb3(app_username="test_user_b")),))
+        t.start()
+        t.join()
+        in_thread[0].session.execute(text("SELECT 1"))
+        assert bdb.session.in_transaction()
+    assert not bdb.session.in_transaction()
+    assert not in_thread[0].session.in_transaction()
+
+    # the session's listeners do not hold on to the BLOOMdb3, it is freed by refcounting alone
+    gc.disable()
+    try:
+        bdb = BLOOMdb3(app_username="test_user_a")
+        bdb.session.execute(text("SELECT 1"))
+        bdb_ref = weakref.ref(bdb)
+        del bdb
+        assert bdb_ref() is None
+    finally:
+        gc.enable()
+
+
+def test_audit_log_records_app_username():
+    bdb = BLOOMdb3(app_username="test_audit_user")
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "tube", "tube-generic-10ml", "1.0")[0]
+    tube = bob.create_instance(template.euid)
+    tube.json_addl["properties"]["comments"] = "audit user test"
+    flag_modified(tube, "json_addl")
+    bdb.session.commit()
+
+    changed_by = {a.changed_by for a in bob.query_audit_log_by_euid(tube.euid)}
+    assert changed_by == {"test_audit_user"}
+    bdb.close()
+
+
+def test_statement_level_audit_triggers():
+    import json
+
+    bdb = BLOOMdb3(app_username="test_audit_stmt")
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "plate", "fixed-plate-96", "1.0")[0]
+    plate, wells = bob.create_instances(template.euid)
+    euids = [w.euid for w in wells]
+    old_status = wells[0].bstatus
+
+    def audit(op):
+        return bdb.session.execute(
+            text(
+                "SELECT rel_table_euid_fk, column_name, old_value, new_value, changed_by, json_addl FROM audit_log "
+                "WHERE rel_table_euid_fk = ANY(:euids) AND operation_type = :op"
+            ),
+            {"euids": euids, "op": op},
+        ).all()
+
+    # one INSERT row per well, written by the one statement which inserted them all
+    assert sorted(r[0] for r in audit("INSERT")) == sorted(euids)
+
+    # one set based UPDATE, one audit row per changed column of each row, unchanged columns are left out
+    bdb.session.execute(
+        text(
+            "UPDATE generic_instance SET bstatus = 'audited', json_addl = jsonb_set(json_addl, '{properties,comments}', '\"stmt\"') "
+            "WHERE euid = ANY(:euids)"
+        ),
+        {"euids": euids},
+    )
+    bdb.session.commit()
+    updates = audit("UPDATE")
+    assert len(updates) == 3 * len(euids)
+    assert {r[1] for r in updates} == {"bstatus", "json_addl", "modified_dt"}
+    assert {r[4] for r in updates} == {"test_audit_stmt"}
+    status = [r for r in updates if r[1] == "bstatus"]
+    assert {(r[2], r[3]) for r in status} == {(old_status, "audited")}
+    # json_addl is stored as a patch of just the changed path
+    json_addl = next(r for r in updates if r[1] == "json_addl")
+    assert json_addl[2] is None and json_addl[3] is None
+    assert [(p["path"], p["new"]) for p in json_addl[5]] == [(["properties", "comments"], "stmt")]
+    assert json_addl[5][0].get("old") != "stmt"
+    bdb.close()
+
+
+def test_json_addl_patches():
+    bdb = BLOOMdb3(app_username="test_json_patch")
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "tube", "tube-generic-10ml", "1.0")[0]
+    tube = bob.create_instance(template.euid)
+    bdb.session.commit()
+    versions = [copy.deepcopy(tube.json_addl)]
+
+    # several edits in one transaction share a changed_at, so take each version's time from its own transaction
+    def edit(change):
+        change(tube.json_addl)
+        flag_modified(tube, "json_addl")
+        bdb.session.commit()
+        versions.append(copy.deepcopy(tube.json_addl))
+
+    edit(lambda j: j["properties"].update({"comments": "v1", "added": {"a": [1, 2]}}))
+    edit(lambda j: j["properties"]["added"]["a"].extend([3, 4, None]))
+    edit(lambda j: (j["properties"].pop("added"), j.update({"list": ["x", {"y": 1}]})))
+    edit(lambda j: j["list"].pop(0))
+
+    # two edits flushed in one transaction are undone in the order they were written
+    tube.json_addl["list"].append("z")
+    flag_modified(tube, "json_addl")
+    bdb.session.flush()
+    tube.json_addl["list"][0] = "y"
+    flag_modified(tube, "json_addl")
+    bdb.session.commit()
+    versions.append(copy.deepcopy(tube.json_addl))
+
+    patches = bdb.session.execute(
+        text(
+            "SELECT changed_at, old_value, new_value, json_addl FROM audit_log "
+            "WHERE rel_table_euid_fk = :euid AND column_name = 'json_addl' ORDER BY seq"
+        ),
+        {"euid": tube.euid},
+    ).all()
+    assert len(patches) == 6
+    assert all(p[1] is None and p[2] is None for p in patches)
+    # the append is two small entries, not the document twice
+    assert patches[1][3] == [
+        {"path": ["properties", "added", "a", "2"], "new": 3},
+        {"path": ["properties", "added", "a", "3"], "new": 4},
+        {"path": ["properties", "added", "a", "4"], "new": None},
+    ]
+
+    # each version back from its changed_at, and the first from just before the first edit
+    changed_at = [p[0] for p in patches]
+    assert bob.get_json_addl_as_of(tube.euid, changed_at[0] - timedelta(microseconds=1)) == versions[0]
+    for i, at in enumerate(changed_at[:4]):
+        assert bob.get_json_addl_as_of(tube.euid, at) == versions[i + 1]
+    assert changed_at[4] == changed_at[5]
+    assert bob.get_json_addl_as_of(tube.euid, changed_at[5]) == versions[-1]
+    assert bob.get_json_addl_as_of(tube.euid, changed_at[3]) == versions[4]
+    bdb.close()
+
+
+def test_refresh_reflected_metadata():
+    bdb = BLOOMdb3()
+    BLOOMdb3.refresh_reflected_metadata()
+    bdb2 = BLOOMdb3()
+
+    assert bdb.Base is not bdb2.Base
+    assert hasattr(bdb2.Base.classes, "audit_log")
+    assert bdb2.Base.classes.generic_instance is bdb.Base.classes.generic_instance
+
+
+def test_euid_read_cache():
+    from bloom_lims.bdb import get_euid_cache
+
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "tube", "tube-generic-10ml", "1.0")[0]
+    tube = bob.create_instance(template.euid)
+    bdb.session.commit()
+    euid = tube.euid
+    bdb.close()
+
+    cache = get_euid_cache(bdb.engine)
+    cache.clear()
+    cache.check_sec = 0
+
+    bdb2 = BLOOMdb3()
+    bob2 = BloomObj(bdb2)
+    assert bob2.get_by_euid(euid, use_cache=True).euid == euid
+    bdb2.close()
+
+    # a hit is merged into the new session and behaves like a queried object
+    hits = cache.hits
+    bdb3 = BLOOMdb3()
+    bob3 = BloomObj(bdb3)
+    cached_tube = bob3.get_by_euid(euid, use_cache=True)
+    assert cache.hits == hits + 1
+    assert cached_tube in bdb3.session
+    assert cached_tube.uuid == tube.uuid
+    cached_tube.json_addl["properties"]["comments"] = "cache test"
+    flag_modified(cached_tube, "json_addl")
+    bdb3.session.commit()
+    bdb3.close()
+
+    # the flush evicted it
+    bdb4 = BLOOMdb3()
+    bob4 = BloomObj(bdb4)
+    assert bob4.get_by_euid(euid, use_cache=True).json_addl["properties"]["comments"] == "cache test"
+
+    # changes made outside this process show up in audit_log
+    bdb4.session.execute(
+        text("UPDATE generic_instance SET bstatus = 'cache_test' WHERE euid = :euid"),
+        {"euid": euid},
+    )
+    bdb4.session.commit()
+    bdb4.close()
+
+    bdb5 = BLOOMdb3()
+    assert BloomObj(bdb5).get_by_euid(euid, use_cache=True).bstatus == "cache_test"
+    bdb5.close()
+
+
+def test_named_sql_statements(monkeypatch):
+    import pytest
+    from bloom_lims.bdb import NamedStatement, get_sql_stats, reset_sql_stats
+
+    with pytest.raises(ValueError):
+        NamedStatement("untyped", "SELECT * FROM generic_instance WHERE euid = :euid::text")
+
+    stmt = NamedStatement(
+        "test_named",
+        "SELECT count(*) FROM generic_instance WHERE euid = ANY(:euids) AND is_deleted = :d",
+        {"euids": "text[]", "d": "boolean"},
+    )
+    assert stmt.prepare_sql.startswith("PREPARE bloom_test_named (text[], boolean) AS ")
+    assert "ANY($1) AND is_deleted = $2" in stmt.prepare_sql
+
+    reset_sql_stats()
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "tube", "tube-generic-10ml", "1.0")[0]
+    tube = bob.create_instance(template.euid, {"cogs": {"cost": "5", "state": "active"}})
+    bdb.session.commit()
+
+    # prepared on the first call, executed after that, on every connection the pool hands out
+    for i in range(3):
+        assert bob.get_costs_of_children([tube.euid]) == {tube.euid: 5.0}
+        bdb.session.commit()
+    stats = get_sql_stats()["costs_of_children"]
+    assert stats["calls"] == 3
+    assert 1 <= stats["prepares"] < 3
+    assert stats["total_ms"] >= stats["max_ms"] > 0
+
+    # the same results from the plain statements
+    def run():
+        graph = bob.fetch_graph_neighbourhood(tube.euid, 2)
+        return bob.query_generic_instance_and_lin_stats(), graph
+
+    prepared = run()
+    monkeypatch.setenv("BLOOM_SQL_PREPARE", "0")
+    plain = run()
+    assert prepared == plain
+    assert get_sql_stats()["graph_node"]["calls"] == 2
+    bdb.close()
+
+
+def test_dag_cache():
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+    from bloom_lims.bdb import DagCache
+
+    cache = DagCache(max_entries=2)
+    builds = []
+
+    def build(key):
+        def _build():
+            builds.append(key)
+            time.sleep(0.05)
+            return {"elements": {"nodes": [{"id": key[0]}], "edges": []}}
+
+        return _build
+
+    key = ("AY1", 6, "2024-01-01T00:00:00")
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda i: cache.get(key, build(key)), range(8)))
+
+    # one build, shared by everyone asking at once, as compact json
+    assert builds == [key]
+    assert set(results) == {'{"elements":{"nodes":[{"id":"AY1"}],"edges":[]}}'}
+    assert json.loads(results[0])["elements"]["nodes"][0]["id"] == "AY1"
+    assert cache.misses == 1 and cache.hits == 7
+
+    # least recently used goes first
+    cache.get(("AY2", 6, "t"), build(("AY2", 6, "t")))
+    cache.get(key, build(key))
+    cache.get(("AY3", 6, "t"), build(("AY3", 6, "t")))
+    assert len(cache) == 2
+    cache.get(key, build(key))
+    assert builds == [key, ("AY2", 6, "t"), ("AY3", 6, "t")]
+    cache.get(("AY2", 6, "t"), build(("AY2", 6, "t")))
+    assert builds[-1] == ("AY2", 6, "t")
+
+
+def test_audit_log_partitions(tmp_path):
+    import csv
+    import gzip
+    from datetime import datetime
+
+    import boto3
+    import pytest
+    import pytz
+    from moto import mock_aws
+
+    bdb = BLOOMdb3(app_username="test_audit_partitions")
+    bob = BloomObj(bdb)
+    this_month = datetime.now(pytz.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    bob.ensure_audit_log_partitions(2)
+    assert bob.ensure_audit_log_partitions(2) == []
+    names = [p[0] for p in bob.list_audit_log_partitions()]
+    assert f"audit_log_p{this_month:%Y%m}" in names
+
+    # three old months, five rows each
+    for month in [1, 2, 3]:
+        start = datetime(2020, month, 1, tzinfo=pytz.utc)
+        bdb.session.execute(
+            text(
+                f"CREATE TABLE audit_log_p2020{month:02d} PARTITION OF audit_log "
+                f"FOR VALUES FROM ('2020-{month:02d}-01 00:00+00') TO ('2020-{month + 1:02d}-01 00:00+00')"
+            )
+        )
+        bdb.session.execute(
+            text(
+                "INSERT INTO audit_log (rel_table_name, column_name, rel_table_uuid_fk, rel_table_euid_fk, old_value, "
+                "new_value, json_addl, changed_by, changed_at, operation_type) "
+                "SELECT 'generic_instance', 'bstatus', gen_random_uuid(), 'CX' || i, 'a', 'b', "
+                "'[{\"path\": [\"x\"], \"new\": 1}]', 'test_audit_partitions', CAST(:start AS TIMESTAMPTZ) + i * INTERVAL '1 day', 'UPDATE' "
+                "FROM generate_series(1, 5) AS i"
+            ),
+            {"start": start},
+        )
+    bdb.session.commit()
+
+    # queries with a range only read those months
+    jan = (datetime(2020, 1, 1, tzinfo=pytz.utc), datetime(2020, 2, 1, tzinfo=pytz.utc))
+    assert len(bob.query_user_audit_logs("test_audit_partitions", *jan)) == 5
+    assert len(bob.query_audit_log_by_euid("CX1", *jan)) == 1
+    plan = "\n".join(
+        bdb.session.execute(
+            text("EXPLAIN SELECT * FROM audit_log WHERE changed_at >= :since AND changed_at < :until"),
+            {"since": jan[0], "until": jan[1]},
+        ).scalars()
+    )
+    assert "audit_log_p202001" in plan and "audit_log_p202002" not in plan
+
+    # kept 1 month back from 2020-03: only January goes
+    assert [p[0] for p in bob.audit_log_partitions_to_archive(1, now=datetime(2020, 3, 15, tzinfo=pytz.utc))] == ["audit_log_p202001"]
+    archived = bob.archive_audit_log_partitions(
+        str(tmp_path / "archive"), keep_months=1, now=datetime(2020, 3, 15, tzinfo=pytz.utc)
+    )
+    assert [(a["partition_name"], a["n_rows"]) for a in archived] == [("audit_log_p202001", 5)]
+    with gzip.open(archived[0]["location"], "rt") as f:
+        rows = list(csv.DictReader(f))
+    assert sorted(r["rel_table_euid_fk"] for r in rows) == [f"CX{i}" for i in range(1, 6)]
+    assert rows[0]["json_addl"] == '[{"new": 1, "path": ["x"]}]'
+    assert "audit_log_p202001" not in [p[0] for p in bob.list_audit_log_partitions()]
+    assert bob.query_user_audit_logs("test_audit_partitions", *jan) == []
+    assert bdb.session.execute(
+        text("SELECT n_rows, location FROM audit_log_archive WHERE partition_name = 'audit_log_p202001'")
+    ).one() == (5, archived[0]["location"])
+
+    # February to S3
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="bloom-audit-archive")
+        archived = bob.archive_audit_log_partitions(
+            "s3://bloom-audit-archive/audit_log/", keep_months=1, now=datetime(2020, 4, 1, tzinfo=pytz.utc)
+        )
+        assert [a["location"] for a in archived] == ["s3://bloom-audit-archive/audit_log/audit_log_p202002.csv.gz"]
+        body = s3.get_object(Bucket="bloom-audit-archive", Key="audit_log/audit_log_p202002.csv.gz")["Body"].read()
+        assert len(gzip.decompress(body).decode().strip().splitlines()) == 6
+
+    # March as parquet, left in place
+    pq = pytest.importorskip("pyarrow.parquet")
+    archived = bob.archive_audit_log_partitions(
+        str(tmp_path), keep_months=1, fmt="parquet", drop=False, now=datetime(2020, 5, 1, tzinfo=pytz.utc)
+    )
+    table = pq.read_table(archived[0]["location"])
+    assert table.num_rows == 5
+    assert str(table.schema.field("changed_at").type) == "timestamp[us, tz=UTC]"
+    assert table.column("is_deleted").to_pylist() == [False] * 5
+    assert len(bob.query_user_audit_logs("test_audit_partitions", datetime(2020, 3, 1, tzinfo=pytz.utc))) >= 5
+    bdb.close()
+
+
+def test_user_audit_log_pages():
+    import json
+
+    bdb = BLOOMdb3(app_username="test_audit_pages")
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "plate", "fixed-plate-96", "1.0")[0]
+    plate, wells = bob.create_instances(template.euid)
+    bdb.session.execute(
+        text("UPDATE generic_instance SET bstatus = 'paged' WHERE euid = ANY(:euids)"),
+        {"euids": [w.euid for w in wells[:10]]},
+    )
+    bdb.session.commit()
+
+    everything = bob.query_user_audit_logs("test_audit_pages")
+    assert len(everything) > 200
+    keys = [(r.changed_at, r.uuid) for r in everything]
+    assert keys == sorted(keys, reverse=True)
+
+    # the pages, together, are everything once and in order
+    pages = []
+    after = None
+    while True:
+        rows, after = bob.query_user_audit_log_page("test_audit_pages", page_size=50, after=after)
+        pages.append(rows)
+        if after is None:
+            break
+    assert len(pages) == (len(everything) + 49) // 50
+    assert [r.uuid for page in pages for r in page] == [r.uuid for r in everything]
+
+    # the related object comes from the table named in rel_table_name
+    by_table = {}
+    for r in everything:
+        by_table.setdefault(r.rel_table_name, []).append(r)
+    assert set(by_table) == {"generic_instance", "generic_instance_lineage"}
+    assert all(r.name is not None for r in everything)
+    assert {r.status for r in by_table["generic_instance"] if r.column_name == "bstatus"} == {"paged"}
+
+    lineages = bob.query_user_audit_logs("test_audit_pages", tables=["generic_instance_lineage"])
+    assert [r.uuid for r in lineages] == [r.uuid for r in by_table["generic_instance_lineage"]]
+    assert bob.query_user_audit_logs("test_audit_pages", until=everything[-1].changed_at) == []
+
+    # exports
+    chunks = list(bob.stream_user_audit_logs("test_audit_pages", fmt="csv", page_size=50))
+    assert len(chunks) == len(pages) + 1
+    lines = "".join(chunks).strip().splitlines()
+    assert lines[0].startswith("euid,changed_by,operation_type,changed_at,name,")
+    assert len(lines) == len(everything) + 1
+    records = [
+        json.loads(line)
+        for chunk in bob.stream_user_audit_logs("test_audit_pages", fmt="ndjson", tables=["generic_instance"])
+        for line in chunk.splitlines()
+    ]
+    assert [r["uuid"] for r in records] == [str(r.uuid) for r in by_table["generic_instance"]]
+    assert records[0]["changed_at"] == by_table["generic_instance"][0].changed_at.isoformat()
+    bdb.close()
+
+
+def test_user_audit_logs_route_bad_params(bloom_app, session_cookies):
+    import base64
+    from fastapi.testclient import TestClient
+
+    client = TestClient(bloom_app, cookies=session_cookies)
+    assert client.get("/user_audit_logs", params={"username": "test_audit_pages"}).status_code == 200
+
+    bad_cursors = [
+        "not base64!",
+        base64.urlsafe_b64encode(b"no separator").decode(),
+        base64.urlsafe_b64encode(b"not a date|" + b"0" * 32).decode(),
+        base64.urlsafe_b64encode(b"2024-01-01T00:00:00+00:00|not-a-uuid").decode(),
+    ]
+    for params in [{"since": "yesterday"}, {"until": "2024-13-01"}] + [{"after": c} for c in bad_cursors]:
+        resp = client.get("/user_audit_logs", params={"username": "test_audit_pages", **params})
+        assert resp.status_code == 400, params
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import anyio
+import boto3
+import httpx
+from moto import mock_aws
+from sqlalchemy import event
+
+from bloom_lims.bdb import BLOOMdb3
+from bloom_lims.bdb import BloomObj
+
+# A small load test of main.py's routes, run in-process through httpx's ASGI transport on one event loop, as
+# uvicorn would.  Every statement sent to postgres is made DB_LATENCY_SEC slower (as if the database were across
+# a network).  N_REQUESTS concurrent /workflow_step_action or /create_file requests must then finish well inside
+# the time the same requests take one after the other, and /dewey must keep answering quickly while they run:
+# the ORM / S3 work is in worker threads and does not hold up the event loop.
+N_REQUESTS = 8
+DB_LATENCY_SEC = 0.02
+
+
+def _add_db_latency(conn, cursor, statement, parameters, context, executemany):
+    time.sleep(DB_LATENCY_SEC)
+
+
+def _set_status_body(step):
+    action = "action/core/set_object_status/1.0"
+    ds = step.json_addl["action_groups"]["core"]["actions"][action]
+    ds["captured_data"]["object_status"] = "in_progress"
+    return {"euid": step.euid, "action": action, "action_group": "core", "ds": ds}
+
+
+def _route_calls():
+    # {route: [2 * N_REQUESTS calls]}, each call makes one request with the client it is given
+    bob = BloomObj(BLOOMdb3(app_username="load_test"))
+    template = bob.query_template_by_component_v2("workflow_step", "accessioning-steps", "package-generated", "1.0")[0]
+    steps = [bob.create_instances(template.euid)[0][0] for i in range(2 * N_REQUESTS)]
+    step_actions = [_set_status_body(step) for step in steps]
+    bob.session.commit()
+    bob.session.close()
+
+    return {
+        "/workflow_step_action": [
+            lambda client, body=body: client.post("/workflow_step_action", json=body) for body in step_actions
+        ],
+        "/create_file": [
+            lambda client, i=i: client.post(
+                "/create_file",
+                data={"name": f"load test {i}", "upload_group_key": f"load-test-{i}"},
+                files=[("file_data", (f"load_{i}.txt", b"load test", "text/plain"))],
+            )
+            for i in range(2 * N_REQUESTS)
+        ],
+    }
+
+
+async def _one_at_a_time(client, calls):
+    t_start = time.monotonic()
+    responses = [await call(client) for call in calls]
+    return time.monotonic() - t_start, responses
+
+
+async def _concurrent(client, calls):
+    t_start = time.monotonic()
+    responses = await asyncio.gather(*[call(client) for call in calls])
+    return time.monotonic() - t_start, responses
+
+
+async def _dewey_latencies(client):
+    latencies = []
+    for i in range(N_REQUESTS):
+        t_start = time.monotonic()
+        resp = await client.get("/dewey")
+        assert resp.status_code == 200
+        latencies.append(time.monotonic() - t_start)
+    return latencies
+
+
+def test_routes_serve_concurrent_requests(bloom_app, session_cookies, monkeypatch):
+    monkeypatch.setenv("BLOOM_DEWEY_S3_BUCKET_PREFIX", "daylily-dewey-")
+
+    async def run(route_calls):
+        transport = httpx.ASGITransport(app=bloom_app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver", cookies=session_cookies) as client:
+            await _dewey_latencies(client)  # warm the shared engine and caches
+            timings = {}
+            for route, calls in route_calls.items():
+                serial = await _one_at_a_time(client, calls[:N_REQUESTS])
+                concurrent, dewey = await asyncio.gather(
+                    _concurrent(client, calls[N_REQUESTS:]), _dewey_latencies(client)
+                )
+                timings[route] = (serial, concurrent, dewey)
+            return timings
+
+    with mock_aws():
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="daylily-dewey-0")
+        route_calls = _route_calls()
+        engine = BLOOMdb3().engine
+        event.listen(engine, "before_cursor_execute", _add_db_latency)
+        try:
+            timings = anyio.run(run, route_calls)
+        finally:
+            event.remove(engine, "before_cursor_execute", _add_db_latency)
+
+    for route, ((serial_sec, serial_res), (concurrent_sec, concurrent_res), dewey) in timings.items():
+        assert [r.status_code for r in serial_res + concurrent_res] == [200] * (2 * N_REQUESTS), route
+        # throughput: the requests overlap rather than queue
+        assert concurrent_sec < serial_sec / 2, (route, serial_sec, concurrent_sec)
+        # latency: a cheap page is not stuck behind them
+        assert max(dewey) < concurrent_sec / 2, (route, concurrent_sec, dewey)
+    assert not any("Failed" in r.text for r in timings["/create_file"][1][1])
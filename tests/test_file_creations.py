@@ -1,7 +1,9 @@
+import concurrent.futures
 import sys
 import os
 import pytest
 import boto3
+import requests
 import requests_mock
 from moto import mock_aws
 from pathlib import Path
@@ -71,5 +73,434 @@ def test_create_file_with_url(bloom_file_instance):
         assert new_file.json_addl['properties']['description'] == "URL test"
         assert new_file.json_addl['properties']['original_file_size_bytes'] == len(b"test content")
 
+def test_streaming_multipart_upload(bloom_file_instance, monkeypatch):
+    import hashlib
+
+    monkeypatch.setenv("BLOOM_S3_MULTIPART_THRESHOLD_MB", "5")
+    monkeypatch.setenv("BLOOM_S3_MULTIPART_CHUNKSIZE_MB", "5")
+    payload = os.urandom(11 * 1024 * 1024)
+
+    new_file = bloom_file_instance.create_file(
+        file_metadata={"description": "Multipart test"},
+        file_data=BytesIO(payload),
+        file_name="big.fastq",
+    )
+    props = new_file.json_addl['properties']
+    assert props['original_file_size_bytes'] == len(payload)
+    assert props['original_file_sha256'] == hashlib.sha256(payload).hexdigest()
+
+    s3 = bloom_file_instance.s3_client
+    head = s3.head_object(Bucket=props['current_s3_bucket_name'], Key=props['current_s3_key'])
+    assert head['ContentLength'] == len(payload)
+    assert head['ETag'].strip('"').endswith("-3")  # three 5MB parts
+
+
+def test_streaming_url_upload_tags_size(bloom_file_instance):
+    url = "https://example.com/data/reads.fastq"
+    with requests_mock.Mocker() as m:
+        m.get(url, content=b"@r1\nACGT\n+\nIIII\n")
+        new_file = bloom_file_instance.create_file(file_metadata={}, url=url)
+
+    props = new_file.json_addl['properties']
+    assert props['original_file_size_bytes'] == 16
+    tags = bloom_file_instance.s3_client.get_object_tagging(
+        Bucket=props['current_s3_bucket_name'], Key=props['current_s3_key']
+    )['TagSet']
+    tags = {t['Key']: t['Value'] for t in tags}
+    assert tags['original_file_size_bytes'] == "16"
+    assert tags['original_url'] == url
+
+
+def test_s3_routing_table(s3_bucket):
+    from bloom_lims.bdb import S3RoutingTable
+
+    s3 = boto3.client('s3', region_name='us-east-1')
+    for name in ["route-test-100", "route-test-500", "other-7"]:
+        s3.create_bucket(Bucket=name)
+
+    calls = []
+    s3.meta.events.register('before-call.s3.ListBuckets', lambda **kw: calls.append(1))
+
+    table = S3RoutingTable("route-test-", ttl_sec=600)
+    assert table.bucket_for(s3, 100) == "route-test-100"
+    assert table.bucket_for(s3, 499) == "route-test-100"
+    assert table.bucket_for(s3, 10**9) == "route-test-500"
+    assert len(calls) == 1
+
+    # below the lowest suffix the table is reloaded before giving up
+    with pytest.raises(Exception):
+        table.bucket_for(s3, 50)
+    assert len(calls) == 2
+    s3.create_bucket(Bucket="route-test-10")
+    assert table.bucket_for(s3, 50) == "route-test-10"
+
+    s3.put_object(Bucket="route-test-500", Key="1000/x.txt", Body=b"")
+    s3.put_object(Bucket="route-test-500", Key="2000/x.txt", Body=b"")
+    assert table.folder_for(s3, "route-test-500", 1500) == 1000
+    assert table.folder_for(s3, "route-test-500", 2500) == 2000
+    assert table.folder_for(s3, "route-test-500", 5) == 0
+
+    # an empty bucket gets a 0/ folder
+    assert table.folder_for(s3, "route-test-100", 123) == 0
+    assert s3.list_objects_v2(Bucket="route-test-100")['Contents'][0]['Key'] == "0/"
+
+    # S3 is called without holding the table lock, other threads keep routing while a listing is slow
+    def lock_is_free(**kw):
+        with concurrent.futures.ThreadPoolExecutor(1) as pool:
+            assert pool.submit(table._lock.acquire, timeout=1).result()
+        table._lock.release()
+
+    s3.meta.events.register('before-call.s3.ListBuckets', lock_is_free)
+    s3.meta.events.register('before-call.s3.ListObjectsV2', lock_is_free)
+    table.clear()
+    assert table.bucket_for(s3, 10**9) == "route-test-500"
+    assert table.folder_for(s3, "route-test-500", 1500) == 1000
+
+
+def test_create_files_batch(bloom_file_instance, db_session):
+    from bloom_lims.bdb import BloomFileSet
+
+    bfs = BloomFileSet(db_session)
+    file_set = bfs.create_file_set(file_set_metadata={"name": "batch test"})
+
+    url = "https://example.com/data/batch.txt"
+    sources = [
+        {"file_data": BytesIO(b"one"), "file_name": "one.txt"},
+        {"file_data": BytesIO(b"two two"), "file_name": "two.txt"},
+        {"url": url},
+        {"s3_uri": "s3://daylily-dewey-0/does/not/exist.txt"},
+    ]
+    with requests_mock.Mocker() as m:
+        m.get(url, content=b"three")
+        results = bloom_file_instance.create_files(
+            sources, file_metadata={"description": "batch"}, file_set_euid=file_set.euid, max_workers=3
+        )
+        # the rows exist before anything is uploaded
+        file_set = bfs.get_by_euid(file_set.euid)
+        assert file_set.parent_of_lineages.count() == 4
+        results = list(results)
+
+    assert len(results) == 4
+    by_original = {r["original"]: r for r in results}
+    assert by_original["two.txt"]["status"] == "Success"
+    assert by_original[url]["status"] == "Success"
+    assert by_original["s3://daylily-dewey-0/does/not/exist.txt"]["status"].startswith("Failed")
+
+    two = bloom_file_instance.get_by_euid(by_original["two.txt"]["identifier"])
+    assert two.json_addl["properties"]["original_file_size_bytes"] == 7
+    assert two.json_addl["properties"]["description"] == "batch"
+    assert two.json_addl["properties"]["current_s3_uri"] == by_original["two.txt"]["current_s3_uri"]
+    failed = bloom_file_instance.get_by_euid(by_original["s3://daylily-dewey-0/does/not/exist.txt"]["identifier"])
+    assert failed.bstatus == "error"
+
+
+def test_create_files_empty_batch(bloom_file_instance):
+    # no files, no rows, and no patient actor created for the patient_id they would have belonged to
+    def patients():
+        return bloom_file_instance.search_objs_by_addl_metadata(
+            {"properties": {"patient_id": "empty-batch-patient"}},
+            True,
+            super_type="actor",
+            btype="generic",
+            b_sub_type="patient",
+        )
+
+    results = bloom_file_instance.create_files([], file_metadata={"patient_id": "empty-batch-patient"})
+    assert list(results) == []
+    missing = ["s3://daylily-dewey-0/does/not/exist.txt"]
+    results = list(bloom_file_instance.import_s3_uris(missing, file_metadata={"patient_id": "empty-batch-patient"}))
+    assert [r["status"].startswith("Failed") for r in results] == [True]
+    assert patients() == []
+
+
+def test_create_file_route_uploads(s3_bucket, bloom_app, session_cookies, monkeypatch):
+    # the report is streamed after the route returns, when FastAPI has already closed the form's files
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setenv("BLOOM_DEWEY_S3_BUCKET_PREFIX", "daylily-dewey-")
+    client = TestClient(bloom_app, cookies=session_cookies)
+    resp = client.post(
+        "/create_file",
+        data={"name": "route upload", "upload_group_key": "route-upload-test"},
+        files=[
+            ("file_data", ("one.txt", b"one", "text/plain")),
+            ("file_data", ("two.txt", b"two two", "text/plain")),
+        ],
+    )
+    assert resp.status_code == 200
+    assert resp.text.count("<td>Success</td>") == 2
+    assert "Failed" not in resp.text
+
+    s3 = boto3.client("s3", region_name="us-east-1")
+    sizes = sorted(o["Size"] for o in s3.list_objects_v2(Bucket=s3_bucket)["Contents"] if o["Key"].endswith(".txt"))
+    assert sizes == [3, 7]
+
+
+def test_zero_disk_download(bloom_file_instance):
+    import yaml
+
+    new_file = bloom_file_instance.create_file(
+        file_metadata={"description": "Download test"},
+        file_data=BytesIO(b"0123456789"),
+        file_name="digits.txt",
+    )
+    euid = new_file.euid
+
+    url = bloom_file_instance.get_presigned_download_url(euid, save_pattern="hybrid")
+    assert new_file.json_addl['properties']['current_s3_key'] in url
+    assert f"{euid}.digits.txt" in requests.utils.unquote(url)
+
+    part = bloom_file_instance.get_s3_object(euid, byte_range="bytes=2-5")
+    assert part["Body"].read() == b"2345"
+    assert part["ContentRange"] == "bytes 2-5/10"
+    with pytest.raises(ValueError):
+        bloom_file_instance.get_s3_object(euid, byte_range="bytes=50-60")
+
+    sidecar = yaml.safe_load(bloom_file_instance.get_metadata_yaml(euid))
+    assert sidecar["description"] == "Download test"
+    assert sidecar["original_file_size_bytes"] == 10
+
+
+def test_download_file_route_delivery(bloom_file_instance, bloom_app, session_cookies, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setenv("BLOOM_DEWEY_S3_BUCKET_PREFIX", "daylily-dewey-")
+    monkeypatch.delenv("BLOOM_DEWEY_DOWNLOAD_MODE", raising=False)
+    euid = bloom_file_instance.create_file(
+        file_metadata={"description": "Delivery test"},
+        file_data=BytesIO(b"delivery"),
+        file_name="delivery.txt",
+    ).euid
+
+    client = TestClient(bloom_app, cookies=session_cookies)
+
+    def download_path(**form):
+        form.update({"euid": euid, "download_type": "dewey", "create_metadata_file": "no", "ret_json": "True"})
+        return client.post("/download_file", data=form).json()["file_download_path"]
+
+    # copied on the server unless presigned urls (which skip the app) are asked for
+    on_disk = download_path()
+    assert on_disk.startswith("./tmp/")
+    with open(on_disk, "rb") as f:
+        assert f.read() == b"delivery"
+    os.remove(on_disk)
+
+    assert download_path(delivery="presigned").startswith("https://")
+    monkeypatch.setenv("BLOOM_DEWEY_DOWNLOAD_MODE", "stream")
+    assert download_path().startswith("/stream_file?")
+
+
+@pytest.mark.parametrize("archive_format", ["zip", "tar"])
+def test_file_set_archive(bloom_file_instance, db_session, archive_format):
+    import io
+    import tarfile
+    import zipfile
+    from bloom_lims.bdb import BloomFileSet
+
+    bfs = BloomFileSet(db_session)
+    file_set = bfs.create_file_set(file_set_metadata={"name": "archive test"})
+    payloads = {"a.txt": b"alpha" * 1000, "b.txt": b"bravo", "c.txt": b""}
+    results = list(
+        bloom_file_instance.create_files(
+            [{"file_data": BytesIO(v), "file_name": k} for k, v in payloads.items()],
+            file_set_euid=file_set.euid,
+        )
+    )
+    euid_to_name = {r["identifier"]: r["original"] for r in results}
+
+    files = bfs.get_file_set_files(file_set.euid)
+    assert {f.euid for f in files} == set(euid_to_name)
+
+    chunks = list(
+        bloom_file_instance.stream_archive(
+            files, archive_format=archive_format, save_pattern="hybrid", prefetch=2, chunk_size=1024
+        )
+    )
+    assert len(chunks) > 3
+    data = b"".join(chunks)
+
+    if archive_format == "zip":
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            members = {n: zf.read(n) for n in zf.namelist()}
+    else:
+        with tarfile.open(fileobj=io.BytesIO(data)) as tf:
+            members = {m.name: tf.extractfile(m).read() for m in tf.getmembers()}
+
+    assert len(members) == 6
+    for euid, name in euid_to_name.items():
+        assert members[f"{euid}.{name}"] == payloads[name]
+        assert f"original_file_name: {name}".encode() in members[f"{euid}.{name}.dewey.yaml"]
+
+
+def test_file_set_archive_route(bloom_file_instance, db_session, bloom_app, session_cookies, monkeypatch):
+    from fastapi.testclient import TestClient
+    from bloom_lims.bdb import BloomFileSet
+
+    monkeypatch.setenv("BLOOM_DEWEY_S3_BUCKET_PREFIX", "daylily-dewey-")
+    file_set = BloomFileSet(db_session).create_file_set(file_set_metadata={"name": "route test"})
+    list(
+        bloom_file_instance.create_files(
+            [{"file_data": BytesIO(b"route"), "file_name": "route.txt"}], file_set_euid=file_set.euid
+        )
+    )
+
+    client = TestClient(bloom_app, cookies=session_cookies)
+    resp = client.get("/download_file_set", params={"euid": file_set.euid, "archive_format": "tar"})
+    assert resp.status_code == 200
+    assert resp.headers["content-disposition"] == f'attachment; filename="{file_set.euid}.tar"'
+
+    # rejected before any of the response is sent
+    resp = client.get("/download_file_set", params={"euid": file_set.euid, "archive_format": "rar"})
+    assert resp.status_code == 400
+    assert "content-disposition" not in resp.headers
+
+
+def test_import_s3_uris(bloom_file_instance, monkeypatch):
+    from botocore.exceptions import ClientError
+
+    monkeypatch.setenv("BLOOM_S3_RETRY_BASE_SEC", "0")
+    s3 = bloom_file_instance.s3_client
+    s3.create_bucket(Bucket="import-src")
+    listed = [f"s3://import-src/runs/a/r{i}.fastq" for i in range(4)]
+    headed = "s3://import-src/other/sample.bam"
+    for uri in listed + [headed]:
+        s3.put_object(Bucket="import-src", Key=uri.split("/", 3)[3], Body=uri.encode())
+    missing = ["s3://import-src/runs/a/nope.fastq", "s3://import-src/else/nope.bam"]
+
+    calls = []
+    s3.meta.events.register("provide-client-params.s3.HeadObject", lambda params, **kw: calls.append(("head", params["Key"])))
+    s3.meta.events.register("provide-client-params.s3.ListObjectsV2", lambda params, **kw: calls.append(("list", params["Bucket"])))
+
+    # the first head of sample.bam is throttled
+    real_head = s3.head_object
+    throttled = []
+
+    def head_object(**kwargs):
+        if kwargs["Key"] == "other/sample.bam" and not throttled:
+            throttled.append(1)
+            raise ClientError({"Error": {"Code": "SlowDown", "Message": "slow down"}}, "HeadObject")
+        return real_head(**kwargs)
+
+    monkeypatch.setattr(s3, "head_object", head_object)
+
+    results = list(
+        bloom_file_instance.import_s3_uris(listed + [headed] + missing, max_workers=4)
+    )
+    by_uri = {r["original"]: r for r in results}
+    assert len(results) == 7
+    for uri in listed + [headed]:
+        assert by_uri[uri]["status"] == "Success"
+        assert "head_seconds" in by_uri[uri] and "seconds" in by_uri[uri]
+    for uri in missing:
+        assert by_uri[uri]["status"].startswith("Failed")
+
+    # one listing for runs/a/ (6 members), heads for the two singletons (one retried); no head per copy
+    assert [c for c in calls if c == ("list", "import-src")] == [("list", "import-src")]
+    assert sorted(k for c, k in calls if c == "head") == ["else/nope.bam", "other/sample.bam"]
+    assert throttled == [1]
+
+    moved = bloom_file_instance.get_by_euid(by_uri[headed]["identifier"])
+    assert moved.json_addl["properties"]["original_file_size_bytes"] == len(headed.encode())
+    assert s3.get_object(Bucket="import-src", Key="other/sample.bam.dewey.moved")
+    assert len(bloom_file_instance.last_s3_import_timings) == 7
+
+
+def test_import_s3_uris_without_list_permission(bloom_file_instance, monkeypatch):
+    from botocore.exceptions import ClientError
+
+    monkeypatch.setenv("BLOOM_S3_RETRY_BASE_SEC", "0")
+    monkeypatch.setenv("BLOOM_S3_RETRY_ATTEMPTS", "2")
+    s3 = bloom_file_instance.s3_client
+    s3.create_bucket(Bucket="import-nolist")
+    ok = [f"s3://import-nolist/runs/r{i}.fastq" for i in range(3)]
+    for uri in ok:
+        s3.put_object(Bucket="import-nolist", Key=uri.split("/", 3)[3], Body=b"x")
+    denied = "s3://import-nolist/runs/secret.fastq"
+    slow = "s3://import-nolist/runs/slow.fastq"
+
+    real_list = s3.list_objects_v2
+    real_head = s3.head_object
+
+    def list_objects_v2(**kwargs):
+        if kwargs["Bucket"] == "import-nolist":
+            raise ClientError({"Error": {"Code": "AccessDenied", "Message": "Access Denied"}}, "ListObjectsV2")
+        return real_list(**kwargs)
+
+    def head_object(**kwargs):
+        if kwargs["Key"] == "runs/secret.fastq":
+            raise ClientError({"Error": {"Code": "403", "Message": "Forbidden"}}, "HeadObject")
+        if kwargs["Key"] == "runs/slow.fastq":
+            raise ClientError({"Error": {"Code": "SlowDown", "Message": "slow down"}}, "HeadObject")
+        return real_head(**kwargs)
+
+    monkeypatch.setattr(s3, "list_objects_v2", list_objects_v2)
+    monkeypatch.setattr(s3, "head_object", head_object)
+
+    # the folder cannot be listed, its objects are headed instead
+    by_uri = {r["original"]: r for r in bloom_file_instance.import_s3_uris(ok + [denied, slow], max_workers=2)}
+    assert [by_uri[uri]["status"] for uri in ok] == ["Success"] * 3
+    assert by_uri[denied]["status"].startswith("Failed") and "403" in by_uri[denied]["status"]
+    assert "does not exist" not in by_uri[slow]["status"] and "SlowDown" in by_uri[slow]["status"]
+
+
+def test_search_addl_metadata(bloom_file_instance, db_session):
+    from uuid import uuid4
+    from sqlalchemy import text
+
+    bfi = bloom_file_instance
+    study = f"study-{uuid4().hex[:8]}"
+    files = [
+        bfi.create_file(
+            file_metadata={"study_id": study, "upload_group_key": f"{study}-g{i % 2}", "description": f"{study} {i}"}
+        )
+        for i in range(7)
+    ]
+    newest_first = [f.euid for f in sorted(files, key=lambda f: (f.created_dt, f.uuid), reverse=True)]
+    by_study = {"properties": {"study_id": study}}
+
+    # keyset pages, each with the total
+    pages = []
+    after = None
+    while True:
+        found = bfi.search_addl_metadata(by_study, btype="file", super_type="file", limit=3, after=after)
+        assert found["total"] == 7
+        pages.append([r["euid"] for r in found["rows"]])
+        after = found["next_after"]
+        if after is None:
+            break
+    assert [len(p) for p in pages] == [3, 3, 1]
+    assert [e for p in pages for e in p] == newest_first
+
+    # offset pages, and past the end
+    found = bfi.search_addl_metadata(by_study, limit=3, offset=6)
+    assert [r["euid"] for r in found["rows"]] == newest_first[6:]
+    assert found["next_after"] is None
+    assert bfi.search_addl_metadata(by_study, limit=3, offset=10) == {"rows": [], "total": 7, "next_after": None}
+
+    row = bfi.search_addl_metadata(euids=[files[0].euid])["rows"][0]
+    assert row["bstatus"] == files[0].bstatus and row["created_dt"] == files[0].created_dt
+    assert row["properties"]["description"] == f"{study} 0"
+
+    # all terms, any term (an indexed property or'd with a @> one), and the older euid search agrees
+    both = {"properties": {"study_id": study, "upload_group_key": f"{study}-g1"}}
+    assert bfi.search_addl_metadata(both, search_greedy=False)["total"] == 3
+    either = {"properties": {"upload_group_key": f"{study}-g1", "description": f"{study} 0"}}
+    found = bfi.search_addl_metadata(either)
+    assert found["total"] == 4
+    assert sorted(r["euid"] for r in found["rows"]) == sorted(bfi.search_objs_by_addl_metadata(either))
+
+    # the indexed properties are looked up on their expression index
+    from sqlalchemy.dialects import postgresql
+
+    session = db_session.session
+    gi = bfi.Base.classes.generic_instance
+    query = session.query(gi.euid).filter(bfi._addl_metadata_condition(gi, by_study))
+    sql = str(query.statement.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+    session.execute(text("SET LOCAL enable_seqscan = off"))
+    plan = "\n".join(session.execute(text(f"EXPLAIN {sql}")).scalars())
+    assert "idx_generic_instance_study_id" in plan
+    session.rollback()
+
+
 if __name__ == "__main__":
     pytest.main()
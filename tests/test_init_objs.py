@@ -1,4 +1,5 @@
 import json
+from sqlalchemy.orm.attributes import flag_modified
 from bloom_lims.bdb import BLOOMdb3
 from bloom_lims.bdb import BloomObj
 from bloom_lims.bdb import (
@@ -81,3 +82,348 @@ def test_create_instances_from_instance_templates():
         )
     else:
         assert 1 == 1
+
+
+def test_hardware_integrations_are_lazy_and_shared():
+    from bloom_lims import bdb as bdb_module
+
+    bdb_module.reset_hardware_integrations()
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    bob2 = BloomWorkflow(bdb)
+    assert "zpld" not in bdb_module._HW_CACHE
+    assert "track_fedex" not in bdb_module._HW_CACHE
+
+    assert len(bob.printer_labs) > 0
+    assert bob.zpld is bob2.zpld
+    assert bob.zpl_label_styles == bob2.zpl_label_styles
+
+    bob.set_printers_lab(sorted(bob.printer_labs)[-1])
+    assert bob.selected_lab != bob2.selected_lab or len(bob.printer_labs) == 1
+
+
+def test_slow_hardware_integration_does_not_block_others():
+    import threading
+    from bloom_lims import bdb as bdb_module
+
+    bdb_module.reset_hardware_integrations()
+    release = threading.Event()
+    loads = []
+
+    def slow_loader():
+        loads.append("slow")
+        release.wait(10)
+        return "slow printer"
+
+    threads = [
+        threading.Thread(target=bdb_module._get_cached_integration, args=("test_slow", slow_loader))
+        for i in range(2)
+    ]
+    for t in threads:
+        t.start()
+    try:
+        # the slow one is still loading, others load (and are served) meanwhile
+        assert bdb_module._get_cached_integration("test_fast", lambda: "fast") == "fast"
+        assert not release.is_set()
+    finally:
+        release.set()
+        for t in threads:
+            t.join()
+    assert loads == ["slow"]
+    assert bdb_module._get_cached_integration("test_slow", slow_loader) == "slow printer"
+    bdb_module.reset_hardware_integrations()
+
+
+def test_get_by_euid_routing_and_bulk_get():
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "tube", "tube-generic-10ml", "1.0")[0]
+    tubes = [bob.create_instance(template.euid) for i in range(3)]
+    lin = bob.create_generic_instance_lineage_by_euids(tubes[0].euid, tubes[1].euid)
+    bdb.session.commit()
+
+    assert bob._route_euid(template.euid) == "generic_template"
+    assert bob._route_euid(lin.euid) == "generic_instance_lineage"
+    assert bob._route_euid(tubes[0].euid) == "generic_instance"
+    assert bob.get_by_euid(template.euid).uuid == template.uuid
+    assert bob.get_by_euid(lin.euid).uuid == lin.uuid
+    assert bob.get(tubes[2].uuid).euid == tubes[2].euid
+
+    euids = [tubes[2].euid, template.euid, tubes[0].euid, tubes[2].euid]
+    assert [o.euid for o in bob.get_many_by_euid(euids)] == [tubes[2].euid, template.euid, tubes[0].euid]
+
+    try:
+        bob.get_many_by_euid([tubes[0].euid, "CX999999999"])
+        assert False
+    except Exception as e:
+        assert "CX999999999" in str(e)
+
+
+def test_bulk_plate_instantiation():
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "plate", "fixed-plate-96", "1.0")[0]
+    plate, wells = bob.create_instances(template.euid)
+
+    assert len(wells) == 96
+    assert len({w.euid for w in wells}) == 96
+    assert wells[0].json_addl["cont_address"]["name"] == "A1"
+    assert {lin.child_instance.euid for lin in plate[0].parent_of_lineages} == {w.euid for w in wells}
+    assert bob.last_instantiation_timing["n_children"] == 96
+    assert bob.last_instantiation_timing["euid"] == plate[0].euid
+
+
+def test_plate_instantiation_uses_template_catalog():
+    from sqlalchemy import event
+
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    template_euid = bob.query_template_by_component_v2("container", "plate", "fixed-plate-96", "1.0")[0].euid
+    bob.create_instances(template_euid)  # warms the catalog and the action imports
+
+    template_queries = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if "FROM generic_template" in statement:
+            template_queries.append(statement)
+
+    event.listen(bdb.engine, "before_cursor_execute", count)
+    try:
+        plate, wells = bob.create_instances(template_euid)
+    finally:
+        event.remove(bdb.engine, "before_cursor_execute", count)
+    assert len(wells) == 96
+    assert template_queries == []
+
+
+def test_template_catalog():
+    from bloom_lims.bdb import get_template_catalog
+
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    catalog = get_template_catalog(bdb.engine)
+    catalog.clear()
+
+    # the catalog lock is free while it queries the database
+    from sqlalchemy import event
+    import threading
+
+    lock_free = []
+
+    def try_lock(conn, cursor, statement, parameters, context, executemany):
+        def _try():
+            got = catalog._lock.acquire(blocking=False)
+            if got:
+                catalog._lock.release()
+            lock_free.append(got)
+
+        t = threading.Thread(target=_try)
+        t.start()
+        t.join()
+
+    event.listen(bdb.engine, "before_cursor_execute", try_lock)
+    try:
+        bob.query_template_by_component_v2("container", "tube", "tube-generic-10ml", "1.0")
+    finally:
+        event.remove(bdb.engine, "before_cursor_execute", try_lock)
+    assert lock_free and all(lock_free)
+
+    gt = bdb.Base.classes.generic_template
+    for pattern in [
+        ("container", None, None, None),
+        ("workflow", "assay", None, "1.0"),
+        ("container", "plate", "fixed-plate-96", "1.0"),
+        ("container", "plate", "no-such-plate", "1.0"),
+        (None, None, None, None),
+    ]:
+        from_db = bob.session.query(gt).filter(gt.is_deleted == False)
+        for col, val in zip(["super_type", "btype", "b_sub_type", "version"], pattern):
+            if val is not None:
+                from_db = from_db.filter(getattr(gt, col) == val)
+        assert {t.euid for t in bob.query_template_by_component_v2(*pattern)} == {t.euid for t in from_db.all()}
+
+    template = bob.query_template_by_component_v2("container", "tube", "tube-generic-10ml", "1.0")[0]
+    assert bob.get_by_euid(template.euid) is template
+
+    # a flushed template change drops the catalog
+    template.json_addl["properties"]["comments"] = "catalog test"
+    flag_modified(template, "json_addl")
+    bdb.session.commit()
+    assert catalog._templates is None
+    bdb2 = BLOOMdb3()
+    assert BloomObj(bdb2).get_by_euid(template.euid).json_addl["properties"]["comments"] == "catalog test"
+
+
+def test_lineage_traversal():
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    plate_t = bob.query_template_by_component_v2("container", "plate", "fixed-plate-96", "1.0")[0]
+    sample_t = bob.query_template_by_component_v2("content", "sample", "gdna", "1.0")[0]
+    plate, wells = bob.create_instances(plate_t.euid)
+    plate = plate[0]
+    sample = bob.create_instance(sample_t.euid)
+    bob.create_generic_instance_lineage_by_euids(wells[0].euid, sample.euid)
+    bdb.session.commit()
+
+    well_lins = bob.get_lineage_children(plate, btype="well")
+    assert {lin.child_instance.euid for lin in well_lins} == {w.euid for w in wells}
+    assert bob.get_lineage_children(plate, super_type="content") == []
+    assert [lin.child_instance.euid for lin in bob.get_lineage_children(plate, depth=2, super_type=["container", "content"])][-1] == sample.euid
+    assert [lin.parent_instance.euid for lin in bob.get_lineage_parents(sample, depth=2)] == [wells[0].euid, plate.euid]
+
+    plate_wells = bob.ret_plate_wells_dict(plate)
+    assert len(plate_wells) == 96
+    assert plate_wells["A1"][1].euid == sample.euid
+    assert plate_wells["B1"][1] is None
+
+    # soft deleted lineages are skipped by default, the plate helpers still see them (as the relationships do)
+    sample_lin = bob.get_lineage_parents(sample)[0]
+    bob.delete_obj(sample_lin)
+    bdb.session.commit()
+    assert bob.get_lineage_parents(sample) == []
+    assert [lin.euid for lin in bob.get_lineage_parents(sample, include_deleted=True)] == [sample_lin.euid]
+    assert bob.ret_plate_wells_dict(plate)["A1"][1].euid == sample.euid
+
+
+def test_batch_lineage_creation():
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "tube", "tube-generic-10ml", "1.0")[0]
+    tubes = [bob.create_instance(template.euid) for i in range(4)]
+
+    lins = bob.create_generic_instance_lineages(
+        [
+            (tubes[0].euid, tubes[1].euid),
+            (tubes[0], tubes[2]),
+            (tubes[0].euid, tubes[1]),  # repeated in the batch
+            (tubes[0], tubes[1], "other"),
+        ]
+    )
+    bdb.session.commit()
+    assert [(lin.parent_instance.euid, lin.child_instance.euid, lin.relationship_type) for lin in lins] == [
+        (tubes[0].euid, tubes[1].euid, "generic"),
+        (tubes[0].euid, tubes[2].euid, "generic"),
+        (tubes[0].euid, tubes[1].euid, "other"),
+    ]
+
+    # already existing edges are skipped
+    lins = bob.create_generic_instance_lineages([(tubes[0], tubes[1]), (tubes[0], tubes[3])])
+    bdb.session.commit()
+    assert [lin.child_instance.euid for lin in lins] == [tubes[3].euid]
+    assert len(bob.get_lineage_children(tubes[0])) == 4
+
+
+def test_cogs_rollups():
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "tube", "tube-generic-10ml", "1.0")[0]
+
+    def tube(cost, state="active"):
+        return bob.create_instance(template.euid, {"cogs": {"cost": cost, "state": state}})
+
+    a, b, c, d, gone, idle = tube("1"), tube("2"), tube("3"), tube("4"), tube("100"), tube("50", "inactive")
+    # a diamond: d is reachable from a through b and through c
+    bob.create_generic_instance_lineages([(a, b), (a, c), (b, d), (c, d), (a, gone)])
+    bob.delete_obj(gone)
+    bdb.session.commit()
+
+    costs = bob.get_costs_of_children([a.euid, d.euid, idle.euid, "XX0"])
+    assert costs == {a.euid: 10.0, d.euid: 4.0, idle.euid: 50.0, "XX0": "na"}
+    assert bob.get_cost_of_euid_children(a.euid) == 10.0
+
+    # d: 4 split over its 2 active parent lineages, b: 2, c: 3, a: 1 (counted once)
+    cogs = bob.get_cogs_to_produce([d.euid, b.euid, idle.euid])
+    assert cogs == {d.euid: 8.0, b.euid: 3.0, idle.euid: 0.0}
+    assert bob.get_cogs_to_produce_euid(d.euid) == 8.0
+
+
+def test_assay_metrics():
+    from sqlalchemy import text
+
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    bdb.session.execute(text("DELETE FROM assay_dashboard_metrics"))
+    bdb.session.commit()
+
+    metrics = bob.refresh_assay_metrics()
+    assays = [a.euid for a in bob._query_assays()]
+    assert len(assays) > 0
+    assert sorted(metrics.keys()) == sorted(assays)
+    for m in metrics.values():
+        assert m["tot"] == sum(q["n_worksets"] for q in m["queues"])
+        for q in m["queues"]:
+            assert {"euid", "name", "btype", "b_sub_type", "n_worksets"} <= set(q.keys())
+
+    n_rows = bdb.session.execute(text("SELECT count(*) FROM assay_dashboard_metrics")).scalar()
+    assert n_rows == len(assays)
+
+    # fresh rows are read back as stored, not recomputed
+    ay = assays[0]
+    bdb.session.execute(
+        text("UPDATE assay_dashboard_metrics SET metrics = jsonb_set(metrics, '{tot}', '-1') WHERE assay_euid = :euid"),
+        {"euid": ay},
+    )
+    bdb.session.commit()
+    assert bob.get_assay_metrics([ay])[ay]["tot"] == -1
+
+    # stale and missing rows are
+    assert bob.get_assay_metrics([ay], max_age_sec=-1)[ay]["tot"] == metrics[ay]["tot"]
+    bdb.session.execute(text("DELETE FROM assay_dashboard_metrics WHERE assay_euid = :euid"), {"euid": ay})
+    bdb.session.commit()
+    assert bob.get_assay_metrics([ay])[ay] == metrics[ay]
+    bdb.close()
+
+
+def test_graph_neighbourhood():
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "tube", "tube-generic-10ml", "1.0")[0]
+    a, b, c, d, e, gone = [bob.create_instance(template.euid) for i in range(6)]
+    # a -> b -> d, a -> c -> d, e -> c, and a cycle back d -> a
+    lins = bob.create_generic_instance_lineages([(a, b), (a, c), (b, d), (c, d), (e, c), (d, a), (b, gone)])
+    bob.delete_obj(gone)
+    bdb.session.commit()
+
+    graph = bob.fetch_graph_neighbourhood(c.euid, 1)
+    assert {n["euid"]: n["depth"] for n in graph["nodes"]} == {c.euid: 0, a.euid: 1, d.euid: 1, e.euid: 1}
+    assert {(x["parent_euid"], x["child_euid"]) for x in graph["edges"]} == {
+        (a.euid, c.euid),
+        (c.euid, d.euid),
+        (e.euid, c.euid),
+    }
+    assert graph["truncated"] is False
+
+    # each node is reached once, at its shortest distance, and the cycle does not run away
+    graph = bob.fetch_graph_neighbourhood(c.euid, 6)
+    assert {n["euid"]: n["depth"] for n in graph["nodes"]} == {c.euid: 0, a.euid: 1, d.euid: 1, e.euid: 1, b.euid: 2}
+    assert len(graph["edges"]) == 6
+    assert {x["lineage_euid"] for x in graph["edges"]} == {lin.euid for lin in lins if lin.child_instance_uuid != gone.uuid}
+
+    graph = bob.fetch_graph_neighbourhood(c.euid, 6, max_nodes=3)
+    assert len(graph["nodes"]) == 3 and graph["truncated"] is True
+    node_euids = {n["euid"] for n in graph["nodes"]}
+    assert all(x["parent_euid"] in node_euids and x["child_euid"] in node_euids for x in graph["edges"])
+
+    assert bob.fetch_graph_neighbourhood("GX0", 2) == {"nodes": [], "edges": [], "truncated": False}
+    bdb.close()
+
+
+def test_get_dagv2_reports_truncation(bloom_app, session_cookies, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    bdb = BLOOMdb3()
+    bob = BloomObj(bdb)
+    template = bob.query_template_by_component_v2("container", "tube", "tube-generic-10ml", "1.0")[0]
+    a, b, c = [bob.create_instance(template.euid) for i in range(3)]
+    bob.create_generic_instance_lineages([(a, b), (b, c)])
+    bdb.session.commit()
+    euid = a.euid
+    bdb.close()
+
+    client = TestClient(bloom_app, cookies=session_cookies)
+    dag = client.get("/get_dagv2", params={"euid": euid, "depth": 2}).json()
+    assert len(dag["elements"]["nodes"]) == 3 and dag["truncated"] is False
+
+    monkeypatch.setenv("BLOOM_DAG_MAX_NODES", "2")
+    dag = client.get("/get_dagv2", params={"euid": euid, "depth": 3}).json()
+    assert len(dag["elements"]["nodes"]) == 2 and dag["truncated"] is True